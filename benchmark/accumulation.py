@@ -0,0 +1,71 @@
+"""
+benchmark of the accumulation_steps option of train
+
+for a fixed effective batch size, each case splits it into accumulation_steps batches,
+the time of an update is reported in ms, with the peak resident memory of the process in MB,
+each case runs in its own process, accumulation_steps = 1 uses model.fit
+
+usage: python benchmark/accumulation.py
+"""
+import copy
+import resource
+import subprocess
+import sys
+from time import time
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+from deepreg.train import fit_with_accumulation
+
+EFFECTIVE_BATCH_SIZE = 4
+IMAGE_SIZES = [64, 96]
+ACCUMULATION_STEPS = [1, 2, 4]
+NUM_UPDATES = 3
+CONFIG_PATH = "deepreg/config/mr_us_ddf.yaml"
+
+
+def benchmark(size, accumulation_steps):
+    config = yaml.safe_load(open(CONFIG_PATH))["tf"]
+    tf_model_config = copy.deepcopy(config["model"])
+    tf_loss_config = config["loss"]
+    image_size = [size] * 3
+    batch_size = EFFECTIVE_BATCH_SIZE // accumulation_steps
+
+    model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=batch_size, tf_model_config=tf_model_config, tf_loss_config=tf_loss_config)
+    model.compile(optimizer=tf.keras.optimizers.Adam(), loss=lambda y_true, y_pred: tf.reduce_mean(y_pred))
+    x = tuple([np.random.rand(batch_size, *image_size).astype(np.float32) for _ in range(3)] + [
+        np.zeros((batch_size, 2), dtype=np.float32)])
+    y = np.random.rand(batch_size, *image_size).astype(np.float32)
+    dataset = tf.data.Dataset.from_tensors((x, y)).repeat()
+
+    # the first update is not timed as it traces the train step
+    update_times = []
+    timer = tf.keras.callbacks.LambdaCallback(on_train_batch_begin=lambda batch, logs: update_times.append(time()))
+    if accumulation_steps == 1:
+        model.fit(x=dataset, steps_per_epoch=NUM_UPDATES + 1, epochs=1, verbose=0, callbacks=[timer])
+    else:
+        fit_with_accumulation(model=model, dataset_train=dataset, dataset_val=None,
+                              steps_per_epoch=(NUM_UPDATES + 1) * accumulation_steps, validation_steps=0, epochs=1,
+                              accumulation_steps=accumulation_steps, callbacks=[timer], verbose=0)
+    update_time = (time() - update_times[1]) / NUM_UPDATES * 1000
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return update_time, memory
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print("%.1f, %.0f" % benchmark(int(sys.argv[1]), int(sys.argv[2])))
+    else:
+        print("size, " + ", ".join(["%d x %d (ms), %d x %d (MB)" % (EFFECTIVE_BATCH_SIZE // a, a,
+                                                                     EFFECTIVE_BATCH_SIZE // a, a)
+                                    for a in ACCUMULATION_STEPS]))
+        for size in IMAGE_SIZES:
+            # a case may be killed if it runs out of memory
+            results = [(subprocess.run([sys.executable, __file__, str(size), str(accumulation_steps)],
+                                       capture_output=True, text=True).stdout.strip().splitlines() or ["-, -"])[-1]
+                       for accumulation_steps in ACCUMULATION_STEPS]
+            print("%d, %s" % (size, ", ".join(results)))
@@ -0,0 +1,72 @@
+"""
+benchmark of the bending energy in loss.deform against the previous implementation with sliced finite differences
+
+for each volume size, forward+backward time is reported in ms per call
+
+usage: python benchmark/bending_energy.py [size ...]
+"""
+import sys
+import timeit
+
+import tensorflow as tf
+
+import deepreg.model.loss.deform as deform_loss
+
+BATCH_SIZE = 1
+IMAGE_SIZES = [64, 128, 256]
+NUM_RUNS = 2
+
+
+def bending_energy_slice(ddf):
+    """
+    previous implementation, each difference is computed per channel by slicing
+    """
+
+    def gradient_dx(fv):
+        return (fv[:, 2:, 1:-1, 1:-1] - fv[:, :-2, 1:-1, 1:-1]) / 2
+
+    def gradient_dy(fv):
+        return (fv[:, 1:-1, 2:, 1:-1] - fv[:, 1:-1, :-2, 1:-1]) / 2
+
+    def gradient_dz(fv):
+        return (fv[:, 1:-1, 1:-1, 2:] - fv[:, 1:-1, 1:-1, :-2]) / 2
+
+    def gradient_txyz(Txyz, fn):
+        return tf.stack([fn(Txyz[..., i]) for i in [0, 1, 2]], axis=4)
+
+    dTdx = gradient_txyz(ddf, gradient_dx)
+    dTdy = gradient_txyz(ddf, gradient_dy)
+    dTdz = gradient_txyz(ddf, gradient_dz)
+    dTdxx = gradient_txyz(dTdx, gradient_dx)
+    dTdyy = gradient_txyz(dTdy, gradient_dy)
+    dTdzz = gradient_txyz(dTdz, gradient_dz)
+    dTdxy = gradient_txyz(dTdx, gradient_dy)
+    dTdyz = gradient_txyz(dTdy, gradient_dz)
+    dTdxz = gradient_txyz(dTdx, gradient_dz)
+    return tf.reduce_mean(dTdxx ** 2 + dTdyy ** 2 + dTdzz ** 2 + 2 * dTdxy ** 2 + 2 * dTdxz ** 2 + 2 * dTdyz ** 2,
+                          [1, 2, 3, 4])
+
+
+def bending_energy_stencil(ddf):
+    return deform_loss.local_displacement_energy(ddf, energy_type="bending")
+
+
+def benchmark(size, fn):
+    ddf = tf.random.normal([BATCH_SIZE, size, size, size, 3])
+
+    @tf.function
+    def forward_backward(x):
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            loss = tf.reduce_sum(fn(x))
+        return tape.gradient(loss, x)
+
+    forward_backward(ddf)  # trace
+    return min(timeit.repeat(lambda: forward_backward(ddf), number=NUM_RUNS, repeat=3)) / NUM_RUNS * 1000
+
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or IMAGE_SIZES
+    print("size, slice (ms), stencil (ms)")
+    for size in sizes:
+        print("%d, %.1f, %.1f" % (size, benchmark(size, bending_energy_slice), benchmark(size, bending_energy_stencil)))
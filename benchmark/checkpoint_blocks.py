@@ -0,0 +1,56 @@
+"""
+benchmark of the checkpoint_blocks option of the backbones
+
+for each backbone, image size and batch size, the forward+backward time is reported in ms per call,
+with the peak resident memory of the process in MB, each case runs in its own process
+
+usage: python benchmark/checkpoint_blocks.py
+"""
+import resource
+import subprocess
+import sys
+import timeit
+
+import tensorflow as tf
+
+from deepreg.model.backbone.local_net import LocalNet
+from deepreg.model.backbone.u_net import UNet
+
+CASES = [("local", 64, 2), ("local", 96, 2), ("local", 128, 1), ("unet", 64, 2), ("unet", 96, 2), ("unet", 128, 1)]
+NUM_RUNS = 2
+
+
+def benchmark(name, size, batch_size, checkpoint_blocks):
+    image_size = [size] * 3
+    kwargs = dict(image_size=image_size, out_channels=3, num_channel_initial=4,
+                  out_kernel_initializer="glorot_uniform", out_activation=None, checkpoint_blocks=checkpoint_blocks)
+    if name == "local":
+        model = LocalNet(extract_levels=[0, 1, 2, 3, 4], **kwargs)
+    else:
+        model = UNet(depth=3, **kwargs)
+    x = tf.random.uniform([batch_size, *image_size, 2])
+    model(x)  # build
+
+    @tf.function
+    def forward_backward(y):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(model(y, training=True) ** 2)
+        return tape.gradient(loss, model.trainable_variables)
+
+    forward_backward(x)  # trace
+    time = min(timeit.repeat(lambda: forward_backward(x), number=NUM_RUNS, repeat=2)) / NUM_RUNS * 1000
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return time, memory
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5:
+        print("%.1f, %.0f" % benchmark(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] == "true"))
+    else:
+        print("backbone, size, batch, default (ms), default (MB), checkpoint (ms), checkpoint (MB)")
+        for name, size, batch_size in CASES:
+            # a case may be killed if it runs out of memory
+            results = [(subprocess.run([sys.executable, __file__, name, str(size), str(batch_size), flag],
+                                       capture_output=True, text=True).stdout.strip().splitlines() or ["-, -"])[-1]
+                       for flag in ["false", "true"]]
+            print("%s, %d, %d, %s" % (name, size, batch_size, ", ".join(results)))
@@ -0,0 +1,60 @@
+"""
+benchmark of the conv_type option of the backbones
+
+for each backbone, image size and conv type, the number of weights, the GFLOPs of the forward pass
+and the inference time in ms per call with batch size 1 are reported,
+with the peak resident memory of the process in MB, each case runs in its own process
+
+usage: python benchmark/conv_type.py
+"""
+import resource
+import subprocess
+import sys
+import timeit
+
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+from deepreg.model.backbone.local_net import LocalNet
+from deepreg.model.backbone.u_net import UNet
+
+CASES = [("local", 64), ("local", 128), ("unet", 64), ("unet", 128)]
+CONV_TYPES = ["dense", "separable", "pointwise_bottleneck"]
+NUM_RUNS = 5
+
+
+def benchmark(name, size, conv_type):
+    image_size = [size] * 3
+    kwargs = dict(image_size=image_size, out_channels=3, num_channel_initial=16,
+                  out_kernel_initializer="glorot_uniform", out_activation=None, conv_type=conv_type)
+    if name == "local":
+        model = LocalNet(extract_levels=[0, 1, 2, 3], **kwargs)
+    else:
+        model = UNet(depth=3, **kwargs)
+    x = tf.random.uniform([1, *image_size, 2])
+    model(x)  # build
+
+    forward = tf.function(lambda y: model(y, training=False))
+    graph = convert_variables_to_constants_v2(forward.get_concrete_function(x)).graph
+    options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    options["output"] = "none"
+    flops = tf.compat.v1.profiler.profile(graph, options=options).total_float_ops
+
+    forward(x)  # trace
+    time = min(timeit.repeat(lambda: forward(x), number=NUM_RUNS, repeat=2)) / NUM_RUNS * 1000
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return model.count_params(), flops / 1e9, time, memory
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4:
+        print("%d, %.1f, %.1f, %.0f" % benchmark(sys.argv[1], int(sys.argv[2]), sys.argv[3]))
+    else:
+        print("backbone, size, conv_type, weights, GFLOPs, inference (ms), memory (MB)")
+        for name, size in CASES:
+            for conv_type in CONV_TYPES:
+                # a case may be killed if it runs out of memory
+                output = subprocess.run([sys.executable, __file__, name, str(size), conv_type],
+                                        capture_output=True, text=True).stdout.strip().splitlines()
+                result = (output or ["-, -, -, -"])[-1]
+                print("%s, %d, %s, %s" % (name, size, conv_type, result))
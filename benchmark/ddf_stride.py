@@ -0,0 +1,62 @@
+"""
+benchmark of the ddf_stride option of the ddf and dvf models
+
+for each image size, method and stride, the time of a training step is reported in ms,
+with the peak resident memory of the process in MB, each case runs in its own process.
+the extract levels of the local net start at log2(ddf_stride) so that the decoder stops at the ddf resolution
+
+usage: python benchmark/ddf_stride.py
+"""
+import copy
+import resource
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+
+BATCH_SIZE = 2
+IMAGE_SIZES = [64, 96]
+METHODS = ["ddf", "dvf"]
+STRIDES = [1, 2, 4]
+NUM_RUNS = 3
+CONFIG_PATH = "deepreg/config/mr_us_dvf.yaml"
+
+
+def benchmark(size, method, stride):
+    config = yaml.safe_load(open(CONFIG_PATH))["tf"]
+    tf_model_config = copy.deepcopy(config["model"])
+    tf_model_config["method"] = method
+    tf_model_config["ddf_stride"] = stride
+    tf_model_config["local"]["extract_levels"] = [level for level in [0, 1, 2, 3, 4] if 2 ** level >= stride]
+    tf_loss_config = config["loss"]
+    image_size = [size] * 3
+
+    model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=BATCH_SIZE, tf_model_config=tf_model_config, tf_loss_config=tf_loss_config)
+    model.compile(optimizer=tf.keras.optimizers.Adam(), loss=lambda y_true, y_pred: tf.reduce_mean(y_pred))
+    x = [np.random.rand(BATCH_SIZE, *image_size).astype(np.float32) for _ in range(3)] + [
+        np.zeros((BATCH_SIZE, 2), dtype=np.float32)]
+    y = np.random.rand(BATCH_SIZE, *image_size).astype(np.float32)
+    model.train_on_batch(x=x, y=y)  # trace
+    time = min(timeit.repeat(lambda: model.train_on_batch(x=x, y=y), number=NUM_RUNS, repeat=2)) / NUM_RUNS * 1000
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return time, memory
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4:
+        print("%.1f, %.0f" % benchmark(int(sys.argv[1]), sys.argv[2], int(sys.argv[3])))
+    else:
+        print("size, method, " + ", ".join(["stride %d (ms), stride %d (MB)" % (s, s) for s in STRIDES]))
+        for size in IMAGE_SIZES:
+            for method in METHODS:
+                # a case may be killed if it runs out of memory
+                results = [(subprocess.run([sys.executable, __file__, str(size), method, str(stride)],
+                                           capture_output=True, text=True).stdout.strip().splitlines() or ["-, -"])[-1]
+                           for stride in STRIDES]
+                print("%d, %s, %s" % (size, method, ", ".join(results)))
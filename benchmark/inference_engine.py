@@ -0,0 +1,54 @@
+"""
+benchmark of the inference engine of predict
+
+for each image size, the time of the first batch (tracing) is reported in s, followed by the time per batch in ms
+of model.predict, which predict used before, and of the engine, over a stream of batches,
+both return the predicted label and the ddf, each case runs in its own process
+
+usage: python benchmark/inference_engine.py
+"""
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+from deepreg.predict import InferenceEngine
+
+BATCH_SIZE = 1
+IMAGE_SIZES = [16, 32, 64]
+NUM_BATCHES = 20
+CONFIG_PATH = "deepreg/config/mr_us_ddf.yaml"
+
+
+def benchmark(image_size, mode):
+    config = yaml.safe_load(open(CONFIG_PATH))["tf"]
+    image_size = [image_size] * 3
+    model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=BATCH_SIZE, tf_model_config=config["model"], tf_loss_config=config["loss"])
+    batches = [tuple([tf.random.uniform([BATCH_SIZE, *image_size]) for _ in range(3)] + [tf.zeros([BATCH_SIZE, 2])])
+               for _ in range(NUM_BATCHES)]
+    if mode == "keras":
+        model_pred = tf.keras.Model(inputs=model.inputs, outputs=model.outputs + [model.ddf])
+        predict_fn = model_pred.predict
+    else:
+        predict_fn = InferenceEngine(model=model)
+
+    first_time = timeit.timeit(lambda: predict_fn(batches[0]), number=1)
+    time = timeit.timeit(lambda: [predict_fn(x) for x in batches[1:]], number=1) / (NUM_BATCHES - 1)
+    return first_time, time * 1000
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print("%.2f, %.1f" % benchmark(int(sys.argv[1]), sys.argv[2]))
+    else:
+        print("size, keras first (s), keras (ms), engine first (s), engine (ms)")
+        for image_size in IMAGE_SIZES:
+            results = [(subprocess.run([sys.executable, __file__, str(image_size), mode],
+                                       capture_output=True, text=True).stdout.strip().splitlines() or ["-, -"])[-1]
+                       for mode in ["keras", "engine"]]
+            print("%d, %s" % (image_size, ", ".join(results)))
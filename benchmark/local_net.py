@@ -0,0 +1,53 @@
+"""
+benchmark of the extraction modes of LocalNet
+
+for each image size and mode, the forward+backward time of a training step is reported in ms per call,
+with the peak resident memory of the process in MB, each case runs in its own process
+
+usage: python benchmark/local_net.py
+"""
+import resource
+import subprocess
+import sys
+import timeit
+
+import tensorflow as tf
+
+from deepreg.model.backbone.local_net import LocalNet
+
+BATCH_SIZE = 2
+IMAGE_SIZES = [64, 96, 128]
+MODES = ["default", "fused"]
+NUM_RUNS = 3
+
+
+def benchmark(size, mode):
+    image_size = [size] * 3
+    model = LocalNet(image_size=image_size, out_channels=3, num_channel_initial=4, extract_levels=[0, 1, 2, 3, 4],
+                     out_kernel_initializer="glorot_uniform", out_activation=None,
+                     fused_extraction=mode == "fused")
+    x = tf.random.uniform([BATCH_SIZE, *image_size, 2])
+    model(x)  # build
+
+    @tf.function
+    def forward_backward(y):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(model(y, training=True) ** 2)
+        return tape.gradient(loss, model.trainable_variables)
+
+    forward_backward(x)  # trace
+    time = min(timeit.repeat(lambda: forward_backward(x), number=NUM_RUNS, repeat=3)) / NUM_RUNS * 1000
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return time, memory
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print("%.1f, %.0f" % benchmark(int(sys.argv[1]), sys.argv[2]))
+    else:
+        print("size, " + ", ".join(["%s (ms), %s (MB)" % (m, m) for m in MODES]))
+        for size in IMAGE_SIZES:
+            results = [subprocess.run([sys.executable, __file__, str(size), mode],
+                                      capture_output=True, text=True).stdout.strip().splitlines()[-1]
+                       for mode in MODES]
+            print("%d, %s" % (size, ", ".join(results)))
@@ -0,0 +1,53 @@
+"""
+benchmark of the metrics of predict
+
+for each image size and batch size, the dice score and the centroid distance of a batch of labels
+are computed per sample, as predict did before, and for the whole batch in a tf.function,
+the time per batch is reported in ms
+
+usage: python benchmark/metrics.py
+"""
+import timeit
+
+import tensorflow as tf
+
+import deepreg.model.layer_util as layer_util
+import deepreg.model.loss.label as label_loss
+
+CASES = [(32, 1), (32, 8), (64, 1), (64, 8), (128, 2)]
+NUM_RUNS = 5
+
+
+def benchmark(size, batch_size):
+    grid = layer_util.get_reference_grid(grid_size=[size] * 3)
+    y_true = tf.cast(tf.random.uniform([batch_size, size, size, size]) > 0.5, tf.float32)
+    y_pred = tf.random.uniform([batch_size, size, size, size]).numpy()
+
+    def per_sample():
+        result = []
+        for sample_index in range(batch_size):
+            label = y_true[sample_index:(sample_index + 1)]
+            pred = y_pred[sample_index:(sample_index + 1)]
+            dice = label_loss.dice_score(y_true=label, y_pred=pred, binary=True)
+            dist = label_loss.compute_centroid_distance(y_true=label, y_pred=pred, grid=grid)
+            result.append((dice.numpy()[0], dist.numpy()[0]))
+        return result
+
+    @tf.function
+    def compute_metrics(label, pred):
+        return dict(dice=label_loss.dice_score(y_true=label, y_pred=pred, binary=True),
+                    dist=label_loss.compute_centroid_distance(y_true=label, y_pred=pred, grid=grid))
+
+    def batched():
+        return {name: value.numpy() for name, value in compute_metrics(y_true, y_pred).items()}
+
+    per_sample()
+    batched()  # trace
+    times = [min(timeit.repeat(fn, number=NUM_RUNS, repeat=2)) / NUM_RUNS * 1000 for fn in [per_sample, batched]]
+    return tuple(times)
+
+
+if __name__ == "__main__":
+    print("size, batch, per sample (ms), batched (ms)")
+    for size, batch_size in CASES:
+        print("%d, %d, %.1f, %.1f" % (size, batch_size, *benchmark(size, batch_size)))
@@ -0,0 +1,78 @@
+"""
+benchmark of the output formats of predict
+
+for each image size, format and precision, one sample with a smooth warped image, a nearly binary label
+and a smooth ddf is saved, the writing time in ms, the size in KB, the number of files, and the time
+to read the predictions back in ms are reported, the files are written in the main thread,
+png also saves the slices of the fixed and moving images and labels, as predict does
+
+usage: python benchmark/output_format.py
+"""
+import glob
+import os
+import tempfile
+import timeit
+
+import h5py
+import matplotlib.pyplot as plt
+import nibabel as nib
+import numpy as np
+
+from deepreg.predict import save_sample, save_sample_volumes
+
+IMAGE_SIZES = [64, 128]
+CASES = [("png", False, False), ("nifti", False, True), ("nifti", True, True), ("npz", False, False),
+         ("npz", False, True), ("npz", True, True), ("chunked", False, True), ("chunked", True, True)]
+
+
+def get_sample(size):
+    grid = np.stack(np.meshgrid(*[np.linspace(0, 2 * np.pi, size)] * 3, indexing="ij"), axis=3)
+    smooth = np.sin(grid[..., 0] * 2) * np.cos(grid[..., 1] * 3) + np.sin(grid[..., 2])
+    rng = np.random.RandomState(0)
+    image = (smooth + 0.1 * rng.randn(size, size, size)).astype(np.float32)
+    label = (1 / (1 + np.exp(-10 * smooth))).astype(np.float32)
+    ddf = np.stack([smooth, np.roll(smooth, 7, axis=0), np.roll(smooth, 7, axis=1)], axis=3).astype(np.float32)
+    return image, label, ddf
+
+
+def read(save_dir, output_format):
+    if output_format == "png":
+        return [plt.imread(path) for path in glob.glob(save_dir + "/*pred*.png") + glob.glob(save_dir + "/*ddf.png")]
+    elif output_format == "nifti":
+        return [np.asarray(nib.load(path).dataobj) for path in glob.glob(save_dir + "/*.nii*")]
+    elif output_format == "npz":
+        return [np.load(path)["volume"] for path in glob.glob(save_dir + "/*.npz")]
+    else:
+        result = []
+        for path in glob.glob(save_dir + "/*.h5"):
+            with h5py.File(path, "r") as f:
+                result.append(f["volume"][()])
+        return result
+
+
+def benchmark(size, output_format, float16, compress):
+    image, label, ddf = get_sample(size)
+    with tempfile.TemporaryDirectory() as save_dir:
+        if output_format == "png":
+            def write():
+                save_sample(image_dir=save_dir, fixed_image=image, fixed_label=label, pred_fixed_label=label,
+                            pred_fixed_image=image, moving_image=image, moving_label=label, ddf=ddf,
+                            control_points=None)
+        else:
+            def write():
+                save_sample_volumes(image_dir=save_dir, volumes=dict(pred_fixed_label=label, pred_fixed_image=image,
+                                                                     ddf=ddf),
+                                    output_format=output_format, float16=float16, compress=compress)
+        write_time = timeit.timeit(write, number=1)
+        paths = os.listdir(save_dir)
+        size_kb = sum(os.path.getsize(os.path.join(save_dir, path)) for path in paths) / 1024
+        read_time = timeit.timeit(lambda: read(save_dir, output_format), number=1)
+    return write_time * 1000, size_kb, len(paths), read_time * 1000
+
+
+if __name__ == "__main__":
+    print("size, format, float16, compress, write (ms), size (KB), files, read (ms)")
+    for size in IMAGE_SIZES:
+        for output_format, float16, compress in CASES:
+            result = benchmark(size, output_format, float16, compress)
+            print("%d, %s, %s, %s, %.0f, %.0f, %d, %.0f" % (size, output_format, float16, compress, *result))
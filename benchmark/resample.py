@@ -0,0 +1,49 @@
+"""
+benchmark of the implementations of layer_util.resample
+
+for each volume size, a random ddf is used to warp a volume
+and the forward and forward+backward time are reported in ms per call
+
+usage: python benchmark/resample.py
+"""
+import timeit
+
+import tensorflow as tf
+
+import deepreg.model.layer_util as layer_util
+
+BATCH_SIZE = 2
+IMAGE_SIZES = [[32, 32, 32], [64, 64, 64], [96, 96, 96]]
+IMPLS = ["pyramid", "gather"]
+NUM_RUNS = 10
+
+
+def benchmark(image_size, impl):
+    grid = layer_util.get_reference_grid(grid_size=image_size)
+    vol = tf.random.uniform([BATCH_SIZE, *image_size])
+    ddf = tf.random.uniform([BATCH_SIZE, *image_size, 3], minval=-2, maxval=2)
+
+    @tf.function
+    def forward(x, d):
+        return layer_util.resample(vol=x, loc=grid + d, impl=impl)
+
+    @tf.function
+    def backward(x, d):
+        with tf.GradientTape() as tape:
+            tape.watch([x, d])
+            loss = tf.reduce_sum(layer_util.resample(vol=x, loc=grid + d, impl=impl))
+        return tape.gradient(loss, [x, d])
+
+    times = []
+    for fn in [forward, backward]:
+        fn(vol, ddf)  # trace
+        times.append(min(timeit.repeat(lambda: fn(vol, ddf), number=NUM_RUNS, repeat=3)) / NUM_RUNS * 1000)
+    return times
+
+
+if __name__ == "__main__":
+    print("size, impl, forward (ms), forward+backward (ms)")
+    for size in IMAGE_SIZES:
+        for impl_name in IMPLS:
+            t_forward, t_backward = benchmark(size, impl_name)
+            print("%s, %s, %.1f, %.1f" % ("x".join(map(str, size)), impl_name, t_forward, t_backward))
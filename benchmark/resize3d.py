@@ -0,0 +1,55 @@
+"""
+benchmark of layer_util.resize3d against the previous Resize3d implementation,
+which always resized dim2 and dim3 then dim1 and dim2
+
+for each input shape and output size, forward+backward time is reported in ms per call
+
+usage: python benchmark/resize3d.py
+"""
+import timeit
+
+import tensorflow as tf
+
+import deepreg.model.layer_util as layer_util
+
+# (input shape, output size), upsampling in the decoders, resize of the moving image
+CASES = [([2, 16, 16, 16, 32], [32, 32, 32]),
+         ([2, 32, 32, 32, 16], [64, 64, 64]),
+         ([2, 64, 64, 64, 8], [128, 128, 128]),
+         ([2, 60, 70, 50, 1], [64, 64, 64]),
+         ([2, 64, 64, 64, 1], [64, 64, 64])]
+NUM_RUNS = 3
+
+
+def resize3d_2d(image, size):
+    """
+    previous implementation
+    """
+    shape = image.shape
+    output = tf.reshape(image, [-1, shape[2], shape[3], shape[4]])
+    output = tf.image.resize(output, size=[size[1], size[2]])
+    output = tf.reshape(output, [-1, shape[1], size[1], size[2] * shape[4]])
+    output = tf.image.resize(output, size=[size[0], size[1]])
+    return tf.reshape(output, [-1, size[0], size[1], size[2], shape[4]])
+
+
+def benchmark(shape, size, fn):
+    x = tf.random.uniform(shape)
+
+    @tf.function
+    def forward_backward(y):
+        with tf.GradientTape() as tape:
+            tape.watch(y)
+            loss = tf.reduce_sum(fn(y, size) ** 2)
+        return tape.gradient(loss, y)
+
+    forward_backward(x)  # trace
+    return min(timeit.repeat(lambda: forward_backward(x), number=NUM_RUNS, repeat=3)) / NUM_RUNS * 1000
+
+
+if __name__ == "__main__":
+    print("input shape, output size, previous (ms), resize3d (ms)")
+    for shape, size in CASES:
+        print("%s, %s, %.1f, %.1f" % ("x".join(map(str, shape)), "x".join(map(str, size)),
+                                      benchmark(shape, size, resize3d_2d),
+                                      benchmark(shape, size, layer_util.resize3d)))
@@ -0,0 +1,43 @@
+"""
+benchmark of the conv and fft methods of loss.label.separable_filter3d
+
+for each volume size and gaussian kernel, forward+backward time is reported in ms per call,
+the crossover is used to set loss.label.FFT_KERNEL_SIZE_THRESHOLD
+
+usage: python benchmark/separable_filter3d.py
+"""
+import timeit
+
+import tensorflow as tf
+
+import deepreg.model.loss.label as label_loss
+
+BATCH_SIZE = 2
+IMAGE_SIZES = [[32, 32, 32], [64, 64, 64], [96, 96, 96], [128, 128, 128]]
+SIGMAS = [1, 2, 4, 8, 16, 32]
+METHODS = ["conv", "fft"]
+NUM_RUNS = 3
+
+
+def benchmark(image_size, kernel, method):
+    x = tf.random.uniform([BATCH_SIZE, *image_size])
+
+    @tf.function
+    def forward_backward(y):
+        with tf.GradientTape() as tape:
+            tape.watch(y)
+            loss = tf.reduce_sum(label_loss.separable_filter3d(y, kernel, method=method))
+        return tape.gradient(loss, y)
+
+    forward_backward(x)  # trace
+    return min(timeit.repeat(lambda: forward_backward(x), number=NUM_RUNS, repeat=3)) / NUM_RUNS * 1000
+
+
+if __name__ == "__main__":
+    print("size, sigma, kernel size, " + ", ".join(["%s (ms)" % m for m in METHODS]))
+    for size in IMAGE_SIZES:
+        for sigma in SIGMAS:
+            gauss_kernel = label_loss.gauss_kernel1d(sigma)
+            times = [benchmark(size, gauss_kernel, m) for m in METHODS]
+            print("%s, %d, %d, " % ("x".join(map(str, size)), sigma, gauss_kernel.shape[0])
+                  + ", ".join(["%.1f" % t for t in times]))
@@ -0,0 +1,73 @@
+"""
+benchmark of the registration server
+
+for each model batch size and latency budget, concurrent clients send registration requests
+to a server on a unix socket, the throughput in requests per second, the mean batch size
+and the latency percentiles in ms reported by the server metrics are reported,
+each case runs in its own process
+
+usage: python benchmark/serve.py
+"""
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import yaml
+
+import deepreg.model.network as network
+from deepreg.predict import InferenceEngine
+from deepreg.serve import DynamicBatcher, build_server, register
+
+IMAGE_SIZE = 32
+CASES = [(1, 0), (4, 5), (4, 20), (8, 20)]  # batch size, latency budget in ms
+NUM_CLIENTS = 8
+NUM_REQUESTS = 8  # per client
+CONFIG_PATH = "deepreg/config/mr_us_ddf.yaml"
+
+
+def benchmark(batch_size, max_latency_ms):
+    config = yaml.safe_load(open(CONFIG_PATH))["tf"]
+    image_size = [IMAGE_SIZE] * 3
+    model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=batch_size, tf_model_config=config["model"], tf_loss_config=config["loss"])
+    engine = InferenceEngine(model=model)
+    engine(tuple(np.zeros([batch_size, *shape], dtype=np.float32) for shape in [image_size] * 3 + [[2]]))  # trace
+    batcher = DynamicBatcher(engine=engine, batch_size=batch_size, moving_image_size=image_size,
+                             fixed_image_size=image_size, index_size=2, max_latency_ms=max_latency_ms)
+    sample = [np.random.rand(*image_size).astype(np.float32) for _ in range(3)]
+
+    with tempfile.TemporaryDirectory() as socket_dir:
+        unix_socket = socket_dir + "/serve.sock"
+        server = build_server(batcher=batcher, unix_socket=unix_socket)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def client():
+            for _ in range(NUM_REQUESTS):
+                register(*sample, unix_socket=unix_socket)
+
+        clients = [threading.Thread(target=client) for _ in range(NUM_CLIENTS)]
+        start = time.time()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        throughput = NUM_CLIENTS * NUM_REQUESTS / (time.time() - start)
+        server.shutdown()
+        server.server_close()
+    batcher.stop()
+    metrics = batcher.get_metrics()
+    return throughput, metrics["mean_batch_size"], metrics["latency_ms_p50"], metrics["latency_ms_p95"]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print("%.1f, %.1f, %.0f, %.0f" % benchmark(int(sys.argv[1]), float(sys.argv[2])))
+    else:
+        print("batch, budget (ms), requests/s, mean batch, p50 (ms), p95 (ms)")
+        for batch_size, max_latency_ms in CASES:
+            result = (subprocess.run([sys.executable, __file__, str(batch_size), str(max_latency_ms)],
+                                     capture_output=True, text=True).stdout.strip().splitlines() or ["-, -, -, -"])[-1]
+            print("%d, %s, %s" % (batch_size, max_latency_ms, result))
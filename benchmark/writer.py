@@ -0,0 +1,67 @@
+"""
+benchmark of the background writer of predict
+
+for each image size and number of writer threads, the ddf model predicts a stream of batches
+and the slices of every sample are saved as png as in predict, the time per sample is reported in ms,
+with 0 threads the files are written in the main thread as before, each case runs in its own process
+
+usage: python benchmark/writer.py
+"""
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+from deepreg.predict import InferenceEngine, save_sample
+from deepreg.writer import AsyncWriter
+
+BATCH_SIZE = 1
+IMAGE_SIZES = [32, 64, 128]
+NUM_WRITERS = [0, 1, 2, 4]
+NUM_BATCHES = 4
+CONFIG_PATH = "deepreg/config/mr_us_ddf.yaml"
+
+
+def benchmark(image_size, num_writers):
+    config = yaml.safe_load(open(CONFIG_PATH))["tf"]
+    image_size = [image_size] * 3
+    model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=BATCH_SIZE, tf_model_config=config["model"], tf_loss_config=config["loss"])
+    engine = InferenceEngine(model=model)
+    batches = [tuple([tf.random.uniform([BATCH_SIZE, *image_size]) for _ in range(3)] + [tf.zeros([BATCH_SIZE, 2])])
+               for _ in range(NUM_BATCHES)]
+    engine(batches[0])  # trace
+
+    def run(save_dir):
+        writer = AsyncWriter(num_workers=num_writers, max_queue_size=2 * max(num_writers, 1))
+        for i, inputs in enumerate(batches):
+            outputs = engine(inputs)
+            moving_image, fixed_image, moving_label, _ = [x.numpy() for x in inputs]
+            for sample_index in range(BATCH_SIZE):
+                writer.submit(save_sample, image_dir="%s/%d_%d" % (save_dir, i, sample_index),
+                              fixed_image=fixed_image[sample_index], fixed_label=moving_label[sample_index],
+                              pred_fixed_label=outputs["pred_fixed_label"][sample_index],
+                              pred_fixed_image=outputs["pred_fixed_image"][sample_index],
+                              moving_image=moving_image[sample_index], moving_label=moving_label[sample_index],
+                              ddf=outputs["ddf"][sample_index], control_points=None)
+        writer.shutdown()
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        time = timeit.timeit(lambda: run(save_dir), number=1)
+    return time / (NUM_BATCHES * BATCH_SIZE) * 1000
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print("%.0f" % benchmark(int(sys.argv[1]), int(sys.argv[2])))
+    else:
+        print("size, " + ", ".join("%d threads (ms)" % n for n in NUM_WRITERS))
+        for image_size in IMAGE_SIZES:
+            results = [(subprocess.run([sys.executable, __file__, str(image_size), str(num_writers)],
+                                       capture_output=True, text=True).stdout.strip().splitlines() or ["-"])[-1]
+                       for num_writers in NUM_WRITERS]
+            print("%d, %s" % (image_size, ", ".join(results)))
@@ -0,0 +1,69 @@
+"""
+benchmark of the xla option of train and predict
+
+for each model method and xla mode, the time of the first training step (tracing and compilation)
+is reported in s, followed by the time of a training step and of a prediction step in ms,
+each case runs in its own process
+
+usage: python benchmark/xla.py
+"""
+import copy
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+
+BATCH_SIZE = 2
+IMAGE_SIZE = 32
+METHODS = ["ddf", "dvf", "bspline", "conditional", "seg"]
+MODES = ["none", "warping", "all"]
+NUM_RUNS = 2
+CONFIG_PATH = "deepreg/config/mr_us_ddf.yaml"
+
+
+def benchmark(method, xla):
+    config = yaml.safe_load(open(CONFIG_PATH))["tf"]
+    tf_model_config = copy.deepcopy(config["model"])
+    tf_model_config["method"] = method
+    tf_model_config["xla"] = xla
+    if method == "conditional":
+        tf_model_config["backbone"]["out_activation"] = "sigmoid"
+    if method == "bspline":  # the decoder stops at the control point resolution
+        spacing = tf_model_config["bspline"]["control_point_spacing"]
+        tf_model_config["local"]["extract_levels"] = [
+            level for level in tf_model_config["local"]["extract_levels"] if 2 ** level >= spacing]
+    tf_loss_config = config["loss"]
+    image_size = [IMAGE_SIZE] * 3
+
+    model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=BATCH_SIZE, tf_model_config=tf_model_config, tf_loss_config=tf_loss_config)
+    model.compile(optimizer=tf.keras.optimizers.Adam(), loss=lambda y_true, y_pred: tf.reduce_mean(y_pred))
+    x = [np.random.rand(BATCH_SIZE, *image_size).astype(np.float32) for _ in range(3)] + [
+        np.zeros((BATCH_SIZE, 2), dtype=np.float32)]
+    y = np.random.rand(BATCH_SIZE, *image_size).astype(np.float32)
+    if xla == "all" and not network.set_jit_compile(model=model, inputs=x, labels=y):
+        return float("nan"), float("nan"), float("nan")
+
+    first_time = timeit.timeit(lambda: model.train_on_batch(x=x, y=y), number=1)
+    train_time = min(timeit.repeat(lambda: model.train_on_batch(x=x, y=y), number=NUM_RUNS, repeat=2)) / NUM_RUNS
+    model.predict_on_batch(x=x)  # trace
+    predict_time = min(timeit.repeat(lambda: model.predict_on_batch(x=x), number=NUM_RUNS, repeat=2)) / NUM_RUNS
+    return first_time, train_time * 1000, predict_time * 1000
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        print("%.1f, %.1f, %.1f" % benchmark(sys.argv[1], sys.argv[2]))
+    else:
+        print("method, " + ", ".join("%s first (s), %s train (ms), %s predict (ms)" % (m, m, m) for m in MODES))
+        for method in METHODS:
+            # a case may be killed if it runs out of memory
+            results = [(subprocess.run([sys.executable, __file__, method, mode],
+                                       capture_output=True, text=True).stdout.strip().splitlines() or ["-, -, -"])[-1]
+                       for mode in MODES]
+            print("%s, %s" % (method, ", ".join(results)))
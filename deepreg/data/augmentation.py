@@ -4,49 +4,66 @@ import deepreg.model.layer_util as layer_util
 
 
 class AffineTransformation3D:
-    def __init__(self, moving_image_size, fixed_image_size, batch_size, scale=0.1):
+    def __init__(self, moving_image_size, fixed_image_size, batch_size, scale=0.1, label_interpolation="linear"):
+        """
+        :param moving_image_size: [m_dim1, m_dim2, m_dim3]
+        :param fixed_image_size: [f_dim1, f_dim2, f_dim3]
+        :param batch_size:
+        :param scale: scale of the random affine noise
+        :param label_interpolation: "linear" or "nearest", nearest only works with binary labels
+        """
         self._batch_size = batch_size
         self._scale = scale
+        self._label_interpolation = label_interpolation
         self._moving_grid_ref = layer_util.get_reference_grid(grid_size=moving_image_size)
         self._fixed_grid_ref = layer_util.get_reference_grid(grid_size=fixed_image_size)
 
-    def _gen_transforms(self):
-        return layer_util.random_transform_generator(batch_size=self._batch_size, scale=self._scale)
+    def _gen_transforms(self, seed=None):
+        return layer_util.random_transform_generator(batch_size=self._batch_size, scale=self._scale, seed=seed)
 
     @staticmethod
-    def _transform(image, grid_ref, transforms):
+    def _transform(image, grid_ref, transforms, interpolation="linear"):
         """
 
-        :param image: shape = [batch, dim1, dim2, dim3]
+        :param image: shape = [batch, dim1, dim2, dim3] or [batch, dim1, dim2, dim3, ch]
         :param grid_ref: shape = [dim1, dim2, dim3, 3]
         :param transforms: shape = [batch, 4, 3]
-        :return: shape = [batch, dim1, dim2, dim3]
+        :param interpolation: "linear" or "nearest"
+        :return: shape = [batch, dim1, dim2, dim3] or [batch, dim1, dim2, dim3, ch]
         """
         transformed = layer_util.resample(vol=image,
-                                          loc=layer_util.warp_grid(grid_ref, transforms))
+                                          loc=layer_util.warp_grid(grid_ref, transforms),
+                                          interpolation=interpolation)
         return transformed
 
     @tf.function
-    def transform(self, inputs, labels):
+    def transform(self, inputs, labels, seed=None):
         """
+        the transforms are sampled in graph, so each call (batch) gets new transforms
+        and the function can be mapped on a dataset with num_parallel_calls
+
         :param inputs: (moving_image, fixed_image, moving_label)
                     moving_image, shape = [batch, m_dim1, m_dim2, m_dim3]
                     fixed_image, shape = [batch, f_dim1, f_dim2, f_dim3]
                     moving_label, shape = [batch, m_dim1, m_dim2, m_dim3]
         :param labels: fixed_label, shape = [batch, f_dim1, f_dim2, f_dim3]
         :param indices: a 2 element array, [sample_index, label_index]
+        :param seed: shape = [2, 2], seeds for moving and fixed transforms, random if None
         :return:
         """
 
         moving_image, fixed_image, moving_label, indices = inputs
         fixed_label = labels
 
-        moving_transforms = self._gen_transforms()
-        fixed_transforms = self._gen_transforms()
+        moving_seed, fixed_seed = (None, None) if seed is None else (seed[0], seed[1])
+        moving_transforms = self._gen_transforms(seed=moving_seed)
+        fixed_transforms = self._gen_transforms(seed=fixed_seed)
 
         moving_image = self._transform(moving_image, self._moving_grid_ref, moving_transforms)
-        moving_label = self._transform(moving_label, self._moving_grid_ref, moving_transforms)
+        moving_label = self._transform(moving_label, self._moving_grid_ref, moving_transforms,
+                                       interpolation=self._label_interpolation)
         fixed_image = self._transform(fixed_image, self._fixed_grid_ref, fixed_transforms)
-        fixed_label = self._transform(fixed_label, self._fixed_grid_ref, fixed_transforms)
+        fixed_label = self._transform(fixed_label, self._fixed_grid_ref, fixed_transforms,
+                                      interpolation=self._label_interpolation)
 
         return (moving_image, fixed_image, moving_label, indices), fixed_label
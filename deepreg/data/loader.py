@@ -21,14 +21,16 @@ class DataLoader:
     def get_dataset(self):
         raise NotImplementedError
 
-    def get_dataset_and_preprocess(self, training, batch_size, repeat: bool, shuffle_buffer_num_batch):
+    def get_dataset_and_preprocess(self, training, batch_size, repeat: bool, shuffle_buffer_num_batch,
+                                   label_interpolation="linear"):
         dataset = preprocess(dataset=self.get_dataset(),
                              moving_image_shape=self.moving_image_shape,
                              fixed_image_shape=self.fixed_image_shape,
                              training=training,
                              shuffle_buffer_num_batch=shuffle_buffer_num_batch,
                              repeat=repeat,
-                             batch_size=batch_size)
+                             batch_size=batch_size,
+                             label_interpolation=label_interpolation)
         return dataset
 
     def split_indices(self, indices: list):
@@ -71,7 +73,8 @@ class GeneratorDataLoader(DataLoader):
 def preprocess(dataset,
                moving_image_shape, fixed_image_shape,
                training,
-               shuffle_buffer_num_batch, repeat: bool, batch_size):
+               shuffle_buffer_num_batch, repeat: bool, batch_size,
+               label_interpolation="linear"):
     """
     shuffle, repeat, batch, augmentation
     :param dataset:
@@ -81,6 +84,7 @@ def preprocess(dataset,
     :param batch_size:
     :param repeat:
     :param shuffle_buffer_num_batch:
+    :param label_interpolation: "linear" or "nearest", interpolation of the labels in the training augmentation
     :return:
     """
     # shuffle / repeat / batch / preprocess
@@ -95,6 +99,7 @@ def preprocess(dataset,
         # TODO add cropping, but crop first or rotation first?
         affine_transform = aug.AffineTransformation3D(moving_image_size=moving_image_shape,
                                                       fixed_image_size=fixed_image_shape,
-                                                      batch_size=batch_size)
-        dataset = dataset.map(affine_transform.transform)
+                                                      batch_size=batch_size,
+                                                      label_interpolation=label_interpolation)
+        dataset = dataset.map(affine_transform.transform, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return dataset
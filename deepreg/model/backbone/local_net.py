@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 from deepreg.model import layer as layer
+from deepreg.model import layer_util as layer_util
 
 
 class LocalNet(tf.keras.Model):
@@ -8,7 +9,7 @@ class LocalNet(tf.keras.Model):
                  image_size, out_channels,
                  num_channel_initial, extract_levels,
                  out_kernel_initializer, out_activation,
-                 **kwargs):
+                 fused_extraction=False, checkpoint_blocks=False, conv_type="dense", **kwargs):
         """
         image is encoded gradually, i from level 0 to E
         then it is decoded gradually, j from level E to D
@@ -21,11 +22,22 @@ class LocalNet(tf.keras.Model):
         :param extract_levels:
         :param out_kernel_initializer:
         :param out_activation:
+        :param fused_extraction: if true, the extractions are not resized to image_size one by one,
+                                 they are summed from the coarsest level while decoding, the sum is
+                                 upsampled to the next level and finally to image_size only once.
+                                 as the coarse extractions are upsampled in multiple x2 steps,
+                                 the output is not identical to the default mode
+        :param checkpoint_blocks: if true, the activations inside the down and up sample blocks are not stored
+                                  for backprop but recomputed, only the block inputs and outputs are kept
+        :param conv_type: conv of the blocks, "dense", "separable" or "pointwise_bottleneck", see layer.get_conv3d
         :param kwargs:
         """
         super(LocalNet, self).__init__(**kwargs)
 
         # save parameters
+        self._image_size = image_size
+        self._fused_extraction = fused_extraction
+        self._checkpoint_blocks = checkpoint_blocks
         self._extract_levels = extract_levels
         self._extract_max_level = max(self._extract_levels)  # E
         self._extract_min_level = min(self._extract_levels)  # D
@@ -33,19 +45,27 @@ class LocalNet(tf.keras.Model):
         # init layer variables
 
         nc = [num_channel_initial * (2 ** level) for level in range(self._extract_max_level + 1)]  # level 0 to E
-        self._downsample_blocks = [layer.DownSampleResnetBlock(filters=nc[i], kernel_size=7 if i == 0 else 3)
+        self._downsample_blocks = [layer.DownSampleResnetBlock(filters=nc[i], kernel_size=7 if i == 0 else 3,
+                                                               conv_type=conv_type)
                                    for i in range(self._extract_max_level)]  # level 0 to E-1
-        self._conv3d_block = layer.Conv3dBlock(filters=nc[-1])  # level E
+        self._conv3d_block = layer.Conv3dBlock(filters=nc[-1], conv_type=conv_type)  # level E
 
-        self._upsample_blocks = [layer.LocalNetUpSampleResnetBlock(nc[level]) for level in
+        self._upsample_blocks = [layer.LocalNetUpSampleResnetBlock(nc[level], conv_type=conv_type) for level in
                                  range(self._extract_max_level - 1, self._extract_min_level - 1, -1)]  # level D to E-1
 
-        self._extract_layers = [
-            # if kernels are not initialized by zeros, with init NN, extract may be too large
-            layer.Conv3dWithResize(output_shape=image_size, filters=out_channels,
-                                   kernel_initializer=out_kernel_initializer,
-                                   activation=out_activation)
-            for _ in self._extract_levels]
+        if self._fused_extraction:
+            self._extract_layers = [
+                layer.Conv3d(filters=out_channels,
+                             kernel_initializer=out_kernel_initializer,
+                             activation=out_activation)
+                for _ in self._extract_levels]
+        else:
+            self._extract_layers = [
+                # if kernels are not initialized by zeros, with init NN, extract may be too large
+                layer.Conv3dWithResize(output_shape=image_size, filters=out_channels,
+                                       kernel_initializer=out_kernel_initializer,
+                                       activation=out_activation)
+                for _ in self._extract_levels]
 
     def call(self, inputs, training=None, mask=None):
         """
@@ -60,7 +80,11 @@ class LocalNet(tf.keras.Model):
         encoded = []  # outputs used for decoding, encoded[i] corresponds to level i, stored only 0 to E-1
         h = inputs
         for level in range(self._extract_max_level):  # level 0 to E - 1
-            h, hc = self._downsample_blocks[level](inputs=h, training=training)
+            if self._checkpoint_blocks:
+                h, hc = tf.recompute_grad(
+                    lambda x, block=self._downsample_blocks[level]: block(inputs=x, training=training))(h)
+            else:
+                h, hc = self._downsample_blocks[level](inputs=h, training=training)
             encoded.append(hc)
         hm = self._conv3d_block(inputs=h, training=training)  # level E of encoding/decoding
 
@@ -68,10 +92,30 @@ class LocalNet(tf.keras.Model):
         decoded = [hm]  # level E
         for idx, level in enumerate(
                 range(self._extract_max_level - 1, self._extract_min_level - 1, -1)):  # level E-1 to D
-            hm = self._upsample_blocks[idx](inputs=[hm, encoded[level]], training=training)
+            if self._checkpoint_blocks:
+                hm = tf.recompute_grad(
+                    lambda x, skip, block=self._upsample_blocks[idx]: block(inputs=[x, skip], training=training))(
+                    hm, encoded[level])
+            else:
+                hm = self._upsample_blocks[idx](inputs=[hm, encoded[level]], training=training)
             decoded.append(hm)
+        if self._checkpoint_blocks:  # blocks are built after their first call
+            layer_util.adjust_batch_norm_momentum_for_recompute(self._downsample_blocks + self._upsample_blocks)
 
         # output
+        if self._fused_extraction:
+            # decoded[self._extract_max_level - level] corresponds to level
+            output = None
+            for level in range(self._extract_max_level, self._extract_min_level - 1, -1):  # level E to D
+                h = decoded[self._extract_max_level - level]
+                if output is not None:
+                    output = layer_util.resize3d(image=output, size=h.shape[1:4])
+                if level in self._extract_levels:
+                    extract = self._extract_layers[self._extract_levels.index(level)](inputs=h)
+                    output = extract if output is None else output + extract
+            output = layer_util.resize3d(image=output, size=self._image_size)
+            return output / len(self._extract_levels)
+
         output = tf.reduce_mean(tf.stack([self._extract_layers[idx](inputs=decoded[self._extract_max_level - level])
                                           for idx, level in enumerate(self._extract_levels)], axis=5), axis=5)
         return output
@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 from deepreg.model import layer as layer
+from deepreg.model import layer_util as layer_util
 
 
 class UNet(tf.keras.Model):
@@ -8,7 +9,8 @@ class UNet(tf.keras.Model):
                  image_size, out_channels,
                  num_channel_initial, depth,
                  out_kernel_initializer, out_activation,
-                 pooling=True, concat_skip=False, **kwargs):
+                 pooling=True, concat_skip=False, checkpoint_blocks=False, conv_type="dense", out_level=0,
+                 **kwargs):
         """
         :param image_size: [f_dim1, f_dim2, f_dim3]
         :param out_channels: number of channels for the output
@@ -17,21 +19,30 @@ class UNet(tf.keras.Model):
         :param out_kernel_initializer:
         :param out_activation:
         :param pooling: true if use pooling to down sample
+        :param checkpoint_blocks: if true, the activations inside the down and up sample blocks are not stored
+                                  for backprop but recomputed, only the block inputs and outputs are kept
+        :param conv_type: conv of the blocks, "dense", "separable" or "pointwise_bottleneck", see layer.get_conv3d
+        :param out_level: the decoder stops at this level, between 0 and depth,
+                          so that the output is predicted at 1/2^out_level of the input resolution
         :param kwargs:
         """
         super(UNet, self).__init__(**kwargs)
+        if not 0 <= out_level <= depth:
+            raise ValueError("out_level should be between 0 and depth %d, got %d" % (depth, out_level))
 
         # init layer variables
         nc = [num_channel_initial * (2 ** d) for d in range(depth + 1)]
 
         self._num_channel_initial = num_channel_initial
         self._depth = depth
-        self._downsample_blocks = [layer.DownSampleResnetBlock(filters=nc[d], pooling=pooling)
+        self._out_level = out_level
+        self._checkpoint_blocks = checkpoint_blocks
+        self._downsample_blocks = [layer.DownSampleResnetBlock(filters=nc[d], pooling=pooling, conv_type=conv_type)
                                    for d in range(depth)]
-        self._bottom_conv3d = layer.Conv3dBlock(filters=nc[depth])
-        self._bottom_res3d = layer.Residual3dBlock(filters=nc[depth])
-        self._upsample_blocks = [layer.UpSampleResnetBlock(filters=nc[d], concat=concat_skip)
-                                 for d in range(depth)]
+        self._bottom_conv3d = layer.Conv3dBlock(filters=nc[depth], conv_type=conv_type)
+        self._bottom_res3d = layer.Residual3dBlock(filters=nc[depth], conv_type=conv_type)
+        self._upsample_blocks = [layer.UpSampleResnetBlock(filters=nc[d], concat=concat_skip, conv_type=conv_type)
+                                 for d in range(out_level, depth)]  # level out_level to D-1
         self._output_conv3d = layer.Conv3dWithResize(output_shape=image_size, filters=out_channels,
                                                      kernel_initializer=out_kernel_initializer,
                                                      activation=out_activation)
@@ -50,7 +61,11 @@ class UNet(tf.keras.Model):
         # down sample
         skips = []
         for d in range(self._depth):  # level 0 to D-1
-            down_sampled, skip = self._downsample_blocks[d](inputs=down_sampled, training=training)
+            if self._checkpoint_blocks:
+                down_sampled, skip = tf.recompute_grad(
+                    lambda x, block=self._downsample_blocks[d]: block(inputs=x, training=training))(down_sampled)
+            else:
+                down_sampled, skip = self._downsample_blocks[d](inputs=down_sampled, training=training)
             skips.append(skip)
 
         # bottom, level D
@@ -58,9 +73,16 @@ class UNet(tf.keras.Model):
                                                                    training=training),
                                         training=training)
 
-        # up sample, level D-1 to 0
-        for d in range(self._depth - 1, -1, -1):
-            up_sampled = self._upsample_blocks[d](inputs=[up_sampled, skips[d]], training=training)
+        # up sample, level D-1 to out_level
+        for d in range(self._depth - 1, self._out_level - 1, -1):
+            block = self._upsample_blocks[d - self._out_level]
+            if self._checkpoint_blocks:
+                up_sampled = tf.recompute_grad(
+                    lambda x, skip, block=block: block(inputs=[x, skip], training=training))(up_sampled, skips[d])
+            else:
+                up_sampled = block(inputs=[up_sampled, skips[d]], training=training)
+        if self._checkpoint_blocks:  # blocks are built after their first call
+            layer_util.adjust_batch_norm_momentum_for_recompute(self._downsample_blocks + self._upsample_blocks)
 
         # output
         output = self._output_conv3d(inputs=up_sampled)
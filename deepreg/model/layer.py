@@ -124,6 +124,127 @@ class Deconv3d(tf.keras.layers.Layer):
         return self._Conv3DTranspose(inputs=inputs)
 
 
+class DepthwiseConv3d(tf.keras.layers.Layer):
+    def __init__(self, kernel_size=3, strides=1, padding="same", kernel_initializer="glorot_uniform", **kwargs):
+        """
+        depthwise conv, each channel is convolved with its own kernel_size^3 kernel
+        tf has no depthwise 3d conv and the grouped Conv3D falls back to very slow kernels on CPU,
+        so the kernel is split along dim1 and applied as depthwise 2d convs on the dim1 slices, which are summed
+        :param kernel_size: int
+        :param strides: int
+        :param padding: "valid" or "same"
+        :param kernel_initializer:
+        :param kwargs:
+        """
+        super(DepthwiseConv3d, self).__init__(**kwargs)
+        # save parameters
+        self._kernel_size = kernel_size
+        self._strides = strides
+        self._padding = padding
+        self._kernel_initializer = kernel_initializer
+        # init layer variables
+        self._kernel = None
+
+    def build(self, input_shape):
+        super(DepthwiseConv3d, self).build(input_shape)
+        self._kernel = self.add_weight(name="kernel",
+                                       shape=[self._kernel_size] * 3 + [input_shape[4], 1],
+                                       initializer=self._kernel_initializer,
+                                       trainable=True)
+
+    def call(self, inputs, **kwargs):
+        """
+        :param inputs: shape = [batch, dim1, dim2, dim3, channels]
+        :param kwargs:
+        :return: shape = [batch, out_dim1, out_dim2, out_dim3, channels]
+        """
+        dim1, dim2, dim3, channels = inputs.shape[1:5]
+        k, s = self._kernel_size, self._strides
+        # padding of dim1 as for a "valid" or "same" conv, dim2 and dim3 are padded by depthwise_conv2d
+        if self._padding == "same":
+            out_dim1 = -(-dim1 // s)
+            pad = max((out_dim1 - 1) * s + k - dim1, 0)
+        else:
+            out_dim1 = (dim1 - k) // s + 1
+            pad = 0
+        padded = tf.pad(inputs, [[0, 0], [pad // 2, pad - pad // 2], [0, 0], [0, 0], [0, 0]])
+        output = []
+        for i in range(k):
+            # slices of the padded input seen by the i-th dim1 offset of the kernel, with the batch
+            sliced = padded[:, i:i + (out_dim1 - 1) * s + 1:s]  # [batch, out_dim1, dim2, dim3, channels]
+            conved = tf.nn.depthwise_conv2d(tf.reshape(sliced, [-1, dim2, dim3, channels]),
+                                            filter=tf.cast(self._kernel[i], inputs.dtype),
+                                            strides=[1, s, s, 1],
+                                            padding=self._padding.upper())  # [batch*out_dim1, ..., channels]
+            output.append(tf.reshape(conved, [-1, out_dim1, *conved.shape[1:4]]))
+        return tf.add_n(output)
+
+
+class SeparableConv3d(tf.keras.layers.Layer):
+    def __init__(self, filters, kernel_size=3, strides=1, padding="same", use_bias=True, **kwargs):
+        """
+        depthwise-separable conv, a depthwise conv followed by a 1x1x1 conv mixing the channels
+        :param filters: number of channels of the output
+        :param kernel_size: int
+        :param strides: int
+        :param padding: "valid" or "same"
+        :param use_bias:
+        :param kwargs:
+        """
+        super(SeparableConv3d, self).__init__(**kwargs)
+        self._depthwise_conv3d = DepthwiseConv3d(kernel_size=kernel_size, strides=strides, padding=padding)
+        self._pointwise_conv3d = Conv3d(filters=filters, kernel_size=1, use_bias=use_bias)
+
+    def call(self, inputs, **kwargs):
+        return self._pointwise_conv3d(inputs=self._depthwise_conv3d(inputs=inputs))
+
+
+class BottleneckConv3d(tf.keras.layers.Layer):
+    def __init__(self, filters, kernel_size=3, strides=1, padding="same", use_bias=True, reduction=4, **kwargs):
+        """
+        bottleneck conv, the channels are reduced by a 1x1x1 conv, convolved by a dense conv and expanded
+        by a 1x1x1 conv
+        :param filters: number of channels of the output
+        :param kernel_size: e.g. (3,3,3) or 3
+        :param strides: e.g. (1,1,1) or 1
+        :param padding: "valid" or "same"
+        :param use_bias:
+        :param reduction: the dense conv has filters // reduction channels, at least one
+        :param kwargs:
+        """
+        super(BottleneckConv3d, self).__init__(**kwargs)
+        reduced = max(filters // reduction, 1)
+        self._reduce_conv3d = Conv3d(filters=reduced, kernel_size=1, use_bias=False)
+        self._conv3d = Conv3d(filters=reduced, kernel_size=kernel_size, strides=strides, padding=padding,
+                              use_bias=False)
+        self._expand_conv3d = Conv3d(filters=filters, kernel_size=1, use_bias=use_bias)
+
+    def call(self, inputs, **kwargs):
+        return self._expand_conv3d(inputs=self._conv3d(inputs=self._reduce_conv3d(inputs=inputs)))
+
+
+def get_conv3d(conv_type, filters, kernel_size=3, strides=1, padding="same", use_bias=True):
+    """
+    return the conv layer of the blocks
+    :param conv_type: "dense", "separable" or "pointwise_bottleneck"
+    :param filters: number of channels of the output
+    :param kernel_size: int
+    :param strides: int
+    :param padding: "valid" or "same"
+    :param use_bias:
+    :return: a layer mapping [batch, dim1, dim2, dim3, channels] to [batch, out_dim1, out_dim2, out_dim3, filters]
+    """
+    kwargs = dict(filters=filters, kernel_size=kernel_size, strides=strides, padding=padding, use_bias=use_bias)
+    if conv_type == "dense":
+        return Conv3d(**kwargs)
+    elif conv_type == "separable":
+        return SeparableConv3d(**kwargs)
+    elif conv_type == "pointwise_bottleneck":
+        return BottleneckConv3d(**kwargs)
+    else:
+        raise ValueError("Unknown conv type")
+
+
 class Resize3d(tf.keras.layers.Layer):
     def __init__(self, size, method=tf.image.ResizeMethod.BILINEAR, **kwargs):
         """
@@ -139,47 +260,30 @@ class Resize3d(tf.keras.layers.Layer):
 
     def call(self, inputs, **kwargs):
         """
-        tensorflow does not have resize 3d, therefore the resize is performed two folds.
-        - resize dim2 and dim3
-        - resize dim1 and dim2
         :param inputs: shape = [batch, dim1, dim2, dim3, channels], assuming channels_last
         :return: shape = [batch, out_dim1, out_dim2, out_dim3, channels]
         """
-
-        input_shape = inputs.shape
-        # merge axis 0 and 1
-        output = tf.reshape(inputs, [-1,
-                                     input_shape[2], input_shape[3],
-                                     input_shape[4]])  # [batch * dim1, dim2, dim3, channels]
-        # resize dim2 and dim3
-        output = tf.image.resize(images=output,
-                                 size=[self._size[1], self._size[2]],
-                                 method=self._method)  # [batch * dim1, out_dim2, out_dim3, channels]
-
-        # split axis 0 and merge axis 3 and 4
-        output = tf.reshape(output,
-                            shape=[-1, input_shape[1], self._size[1],
-                                   self._size[2] * input_shape[4]])  # [batch, dim1, out_dim2, out_dim3 * channels]
-        # resize dim1 and dim2
-        output = tf.image.resize(images=output,
-                                 size=[self._size[0], self._size[1]],
-                                 method=self._method)  # [batch, out_dim1, out_dim2, out_dim3 * channels]
-        # reshape
-        output = tf.reshape(output,
-                            shape=[-1, self._size[0], self._size[1], self._size[2],
-                                   input_shape[4]])  # [batch, out_dim1, out_dim2, out_dim3, channels]
-        return output
+        return layer_util.resize3d(image=inputs, size=self._size, method=self._method)
 
 
 class Conv3dBlock(tf.keras.layers.Layer):
-    def __init__(self, filters, kernel_size=3, strides=1, padding="same", **kwargs):
+    def __init__(self, filters, kernel_size=3, strides=1, padding="same", conv_type="dense", **kwargs):
+        """
+        :param filters:
+        :param kernel_size:
+        :param strides:
+        :param padding:
+        :param conv_type: "dense", "separable" or "pointwise_bottleneck", see get_conv3d
+        :param kwargs:
+        """
         super(Conv3dBlock, self).__init__(**kwargs)
         # init layer variables
-        self._conv3d = Conv3d(filters=filters,
-                              kernel_size=kernel_size,
-                              strides=strides,
-                              padding=padding,
-                              use_bias=False, )
+        self._conv3d = get_conv3d(conv_type=conv_type,
+                                  filters=filters,
+                                  kernel_size=kernel_size,
+                                  strides=strides,
+                                  padding=padding,
+                                  use_bias=False, )
         self._norm = Norm()
         self._act = Activation()
 
@@ -220,11 +324,13 @@ class Deconv3dBlock(tf.keras.layers.Layer):
 
 
 class Residual3dBlock(tf.keras.layers.Layer):
-    def __init__(self, filters, kernel_size=3, strides=1, **kwargs):
+    def __init__(self, filters, kernel_size=3, strides=1, conv_type="dense", **kwargs):
         super(Residual3dBlock, self).__init__(**kwargs)
         # init layer variables
-        self._conv3d_block = Conv3dBlock(filters=filters, kernel_size=kernel_size, strides=strides)
-        self._conv3d = Conv3d(filters=filters, kernel_size=kernel_size, strides=strides, use_bias=False)
+        self._conv3d_block = Conv3dBlock(filters=filters, kernel_size=kernel_size, strides=strides,
+                                         conv_type=conv_type)
+        self._conv3d = get_conv3d(conv_type=conv_type, filters=filters, kernel_size=kernel_size, strides=strides,
+                                  use_bias=False)
         self._norm = Norm()
         self._act = Activation()
 
@@ -234,15 +340,16 @@ class Residual3dBlock(tf.keras.layers.Layer):
 
 
 class DownSampleResnetBlock(tf.keras.layers.Layer):
-    def __init__(self, filters, kernel_size=3, pooling=True, **kwargs):
+    def __init__(self, filters, kernel_size=3, pooling=True, conv_type="dense", **kwargs):
         super(DownSampleResnetBlock, self).__init__(**kwargs)
         # save parameters
         self._pooling = pooling
         # init layer variables
-        self._conv3d_block = Conv3dBlock(filters=filters, kernel_size=kernel_size)
-        self._residual_block = Residual3dBlock(filters=filters, kernel_size=kernel_size)
+        self._conv3d_block = Conv3dBlock(filters=filters, kernel_size=kernel_size, conv_type=conv_type)
+        self._residual_block = Residual3dBlock(filters=filters, kernel_size=kernel_size, conv_type=conv_type)
         self._max_pool3d = MaxPool3d(pool_size=(2, 2, 2), strides=(2, 2, 2)) if pooling else None
-        self._conv3d_block3 = None if pooling else Conv3dBlock(filters=filters, kernel_size=kernel_size, strides=2)
+        self._conv3d_block3 = None if pooling else Conv3dBlock(filters=filters, kernel_size=kernel_size, strides=2,
+                                                               conv_type=conv_type)
 
     def call(self, inputs, training=None, **kwargs):
         conved = self._conv3d_block(inputs=inputs, training=training)  # adjust channel
@@ -253,15 +360,15 @@ class DownSampleResnetBlock(tf.keras.layers.Layer):
 
 
 class UpSampleResnetBlock(tf.keras.layers.Layer):
-    def __init__(self, filters, kernel_size=3, concat=False, **kwargs):
+    def __init__(self, filters, kernel_size=3, concat=False, conv_type="dense", **kwargs):
         super(UpSampleResnetBlock, self).__init__(**kwargs)
         # save parameters
         self._filters = filters
         self._concat = concat
         # init layer variables
         self._deconv3d_block = None
-        self._conv3d_block = Conv3dBlock(filters=filters, kernel_size=kernel_size)
-        self._residual_block = Residual3dBlock(filters=filters, kernel_size=kernel_size)
+        self._conv3d_block = Conv3dBlock(filters=filters, kernel_size=kernel_size, conv_type=conv_type)
+        self._residual_block = Residual3dBlock(filters=filters, kernel_size=kernel_size, conv_type=conv_type)
 
     def build(self, input_shape):
         super(UpSampleResnetBlock, self).build(input_shape)
@@ -307,16 +414,21 @@ class Conv3dWithResize(tf.keras.layers.Layer):
 
 
 class Warping(tf.keras.layers.Layer):
-    def __init__(self, fixed_image_size, **kwargs):
+    def __init__(self, fixed_image_size, interpolation="linear", implicit_grid=False, jit_compile=False, **kwargs):
         """
 
         :param fixed_image_size: shape = [f_dim1, f_dim2, f_dim3]
                                  or [f_dim1, f_dim2, f_dim3, ch] with the last channel for features
+        :param interpolation: "linear" or "nearest", nearest is not differentiable w.r.t. ddf
+        :param implicit_grid: true if the reference grid is not stored but added using broadcast ranges
+        :param jit_compile: true if the resampling is compiled with XLA, which fuses the gathers and the weights
         :param kwargs:
         """
         super(Warping, self).__init__(**kwargs)
-        self._grid_ref = tf.expand_dims(layer_util.get_reference_grid(
-            grid_size=fixed_image_size), axis=0)  # shape = [1, f_dim1, f_dim2, f_dim3, 3]
+        self._interpolation = interpolation
+        self._resample = tf.function(layer_util.resample, jit_compile=True) if jit_compile else layer_util.resample
+        self._grid_ref = None if implicit_grid else layer_util.get_reference_grid(
+            grid_size=fixed_image_size)  # shape = [f_dim1, f_dim2, f_dim3, 3], shared between layers
 
     def call(self, inputs, **kwargs):
         """
@@ -328,27 +440,45 @@ class Warping(tf.keras.layers.Layer):
 
         :param inputs: [ddf, image]
                         ddf.shape = [batch, f_dim1, f_dim2, f_dim3, 3]
-                        image.shape = [batch, m_dim1, m_dim2, m_dim3]
+                        image.shape = [batch, m_dim1, m_dim2, m_dim3] or [batch, m_dim1, m_dim2, m_dim3, ch]
         :param kwargs:
-        :return: shape = [batch, f_dim1, f_dim2, f_dim3]
+        :return: shape = [batch, f_dim1, f_dim2, f_dim3] or [batch, f_dim1, f_dim2, f_dim3, ch]
         """
-        grid_warped = self._grid_ref + inputs[0]  # [batch, f_dim1, f_dim2, f_dim3, 3]
-        image_warped = layer_util.resample(vol=inputs[1],
-                                           loc=grid_warped)  # [batch, f_dim1, f_dim2, f_dim3]
+        if self._grid_ref is None:
+            grid_warped = layer_util.add_implicit_grid(inputs[0])  # [batch, f_dim1, f_dim2, f_dim3, 3]
+        else:
+            grid_warped = self._grid_ref + inputs[0]  # [batch, f_dim1, f_dim2, f_dim3, 3]
+        image_warped = self._resample(vol=inputs[1], loc=grid_warped,
+                                      interpolation=self._interpolation)  # [batch, f_dim1, f_dim2, f_dim3]
         return image_warped
 
 
 class IntDVF(tf.keras.layers.Layer):
-    def __init__(self, fixed_image_size, num_steps=7, **kwargs):
+    def __init__(self, fixed_image_size, num_steps=7, implicit_grid=False, recompute=False, jit_compile=False,
+                 **kwargs):
         """
 
         :param fixed_image_size: shape = [f_dim1, f_dim2, f_dim3]
         :param num_steps: number of steps for integration
+        :param implicit_grid: true if the reference grid is not stored, see Warping
+        :param recompute: true if the intermediate tensors of each step are recomputed during backprop
+                          instead of being stored, only the input ddf of each step is kept
+        :param jit_compile: true if the resampling is compiled with XLA, see Warping
         :param kwargs:
         """
         super(IntDVF, self).__init__(**kwargs)
-        self._warping = Warping(fixed_image_size=fixed_image_size)
+        self._warping = Warping(fixed_image_size=fixed_image_size, implicit_grid=implicit_grid,
+                                jit_compile=jit_compile, dtype=self.dtype_policy)
         self._num_steps = num_steps
+        self._step = tf.recompute_grad(self._integrate) if recompute else self._integrate
+
+    def _integrate(self, ddf):
+        """
+        one step of scaling and squaring
+        :param ddf: shape = [batch, f_dim1, f_dim2, f_dim3, 3]
+        :return: shape = [batch, f_dim1, f_dim2, f_dim3, 3]
+        """
+        return ddf + self._warping(inputs=[ddf, ddf])
 
     def call(self, inputs, **kwargs):
         """
@@ -363,10 +493,49 @@ class IntDVF(tf.keras.layers.Layer):
         """
         ddf = inputs / (2 ** self._num_steps)
         for _ in range(self._num_steps):
-            ddf += self._warping(inputs=[ddf, ddf])
+            ddf = self._step(ddf)
         return ddf
 
 
+class CubicBSplineUpSampling(tf.keras.layers.Layer):
+    def __init__(self, output_shape, spacing, **kwargs):
+        """
+        dense field from cubic b-spline control points, see layer_util.get_cubic_bspline_filter
+
+        :param output_shape: [out_dim1, out_dim2, out_dim3]
+        :param spacing: int, number of voxels between two control points
+        :param kwargs:
+        """
+        super(CubicBSplineUpSampling, self).__init__(**kwargs)
+        self._output_shape = output_shape
+        self._spacing = spacing
+        self._filter = tf.reshape(tf.constant(layer_util.get_cubic_bspline_filter(spacing)),
+                                  [1, 1, 4, 1, spacing])
+
+    def call(self, inputs, **kwargs):
+        """
+        the b-spline is separable, the last axis is upsampled by a polyphase convolution
+        whose output channels are the spacing phases, so that they are interleaved by a reshape,
+        then the axes are rotated, after three times they are back in order.
+        channels are moved to the batch axis so that they are upsampled independently,
+        this is faster than a conv3d_transpose of stride spacing (17 vs 109 ms at 64^3 with spacing 4)
+
+        :param inputs: control points, shape = [batch, c_dim1, c_dim2, c_dim3, ch]
+                       with c_dim = layer_util.get_control_point_size
+        :param kwargs:
+        :return: shape = [batch, out_dim1, out_dim2, out_dim3, ch]
+        """
+        num_channels = inputs.shape[4]
+        output = tf.concat(tf.unstack(inputs, axis=4), axis=0)  # [ch * batch, c_dim1, c_dim2, c_dim3]
+        for out_dim in self._output_shape[::-1]:
+            shape = output.shape  # [ch * batch, a, b, c]
+            output = tf.nn.conv3d(tf.expand_dims(output, axis=4), filters=self._filter,
+                                  strides=[1, 1, 1, 1, 1], padding="VALID")  # [ch * batch, a, b, c-3, spacing]
+            output = tf.reshape(output, [-1, shape[1], shape[2], (shape[3] - 3) * self._spacing])
+            output = tf.transpose(output[..., :out_dim], perm=[0, 3, 1, 2])  # [ch * batch, out, a, b]
+        return tf.stack(tf.split(output, num_or_size_splits=num_channels, axis=0), axis=4)
+
+
 """
 local net
 """
@@ -403,10 +572,11 @@ class AdditiveUpSampling(tf.keras.layers.Layer):
 
 
 class LocalNetResidual3dBlock(tf.keras.layers.Layer):
-    def __init__(self, filters, kernel_size=3, strides=1, **kwargs):
+    def __init__(self, filters, kernel_size=3, strides=1, conv_type="dense", **kwargs):
         super(LocalNetResidual3dBlock, self).__init__(**kwargs)
         # init layer variables
-        self._conv3d = Conv3d(filters=filters, kernel_size=kernel_size, strides=strides, use_bias=False)
+        self._conv3d = get_conv3d(conv_type=conv_type, filters=filters, kernel_size=kernel_size, strides=strides,
+                                  use_bias=False)
         self._norm = Norm()
         self._act = Activation()
 
@@ -418,7 +588,7 @@ class LocalNetResidual3dBlock(tf.keras.layers.Layer):
 
 
 class LocalNetUpSampleResnetBlock(tf.keras.layers.Layer):
-    def __init__(self, filters, use_additive_upsampling=True, **kwargs):
+    def __init__(self, filters, use_additive_upsampling=True, conv_type="dense", **kwargs):
         super(LocalNetUpSampleResnetBlock, self).__init__(**kwargs)
         # save parameters
         self._filters = filters
@@ -426,8 +596,8 @@ class LocalNetUpSampleResnetBlock(tf.keras.layers.Layer):
         # init layer variables
         self._deconv3d_block = None
         self._additive_upsampling = None
-        self._conv3d_block = Conv3dBlock(filters=filters)
-        self._residual_block = LocalNetResidual3dBlock(filters=filters, strides=1)
+        self._conv3d_block = Conv3dBlock(filters=filters, conv_type=conv_type)
+        self._residual_block = LocalNetResidual3dBlock(filters=filters, strides=1, conv_type=conv_type)
 
     def build(self, input_shape):
         super(LocalNetUpSampleResnetBlock, self).build(input_shape)
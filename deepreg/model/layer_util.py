@@ -17,9 +17,13 @@ def check_inputs(inputs, size, msg=""):
         raise ValueError(msg + "Inputs should be a list or tuple of size %d, but received %d" % (size, len(inputs)))
 
 
-def get_reference_grid(grid_size):
+REFERENCE_GRIDS = dict()  # map[(grid_size, dtype)] = grid, shared by all layers, metrics and augmentations
+
+
+def get_reference_grid(grid_size, dtype=tf.float32):
     """
     :param grid_size: list or tuple of size 3, [dim1, dim2, dim3]
+    :param dtype: dtype of the grid
     :return: tf tensor, shape = [dim1, dim2, dim3, 3], grid[i, j, k, :] = [i j k]
 
     for tf.meshgrid, in the 3-D case with inputs of length M, N and P,
@@ -28,12 +32,33 @@ def get_reference_grid(grid_size):
     same function as volshape_to_meshgrid of neuron
     https://github.com/adalca/neuron/blob/master/neuron/utils.py
     neuron modifies meshgrid to make it faster, however local benchmark suggests tf.meshgrid is better
+
+    grids are cached per grid_size and dtype so that only one copy is stored per process,
+    they are created eagerly using init_scope so that they can be captured by any graph
+    """
+    key = (tuple(int(d) for d in grid_size[:3]), tf.as_dtype(dtype).name)
+    if key not in REFERENCE_GRIDS:
+        with tf.init_scope():
+            REFERENCE_GRIDS[key] = tf.cast(tf.stack(tf.meshgrid(
+                tf.range(grid_size[0]),
+                tf.range(grid_size[1]),
+                tf.range(grid_size[2]),
+                indexing='ij'), axis=3), dtype=dtype)
+    return REFERENCE_GRIDS[key]
+
+
+def add_implicit_grid(ddf):
+    """
+    calculate grid + ddf without storing the reference grid,
+    tf.range along each axis is broadcast and added to the corresponding channel
+
+    :param ddf: shape = [batch, dim1, dim2, dim3, 3]
+    :return: shape = [batch, dim1, dim2, dim3, 3]
     """
-    return tf.cast(tf.stack(tf.meshgrid(
-        tf.range(grid_size[0]),
-        tf.range(grid_size[1]),
-        tf.range(grid_size[2]),
-        indexing='ij'), axis=3), dtype=tf.float32)
+    grid_size = ddf.shape[1:4]
+    return tf.stack([ddf[..., d] + tf.reshape(tf.range(grid_size[d], dtype=ddf.dtype),
+                                              [1] + [-1 if i == d else 1 for i in range(3)])
+                     for d in range(3)], axis=4)
 
 
 def get_n_bits_combinations(n):
@@ -55,7 +80,7 @@ def pyramid_combination(x, w_f):
                pyramid_combination(x[1::2], w_f[:-1]) * (1 - w_f[-1])
 
 
-def resample(vol, loc, interpolation="linear"):
+def resample(vol, loc, interpolation="linear", impl="pyramid"):
     """
     for each voxel at [b, l1, ..., ln]
     sample_coords[b, l1, ..., ln, :] = [v1, ..., vn], which is the coordinates of a source voxel
@@ -66,7 +91,10 @@ def resample(vol, loc, interpolation="linear"):
                 with the last channel for features
     :param loc: shape = [batch, l_dim 1, ..., l_dim m, n] = [batch, *loc_shape, n],
                 use `loc` instead of `coords` to make code simpler
-    :param interpolation: TODO support nearest
+    :param interpolation: "linear" or "nearest",
+                          nearest rounds loc to the closest voxel and does not propagate gradient to loc
+    :param impl: "pyramid" gathers each corner separately and combines them recursively,
+                 "gather" gathers all corners at once with flattened indices, see resample_linear_gather
     :return: shape = [batch, s_dim 1, ..., s_dim n]
 
     difference with neuron's interpn https://github.com/adalca/neuron/blob/master/neuron/utils.py
@@ -78,7 +106,7 @@ def resample(vol, loc, interpolation="linear"):
     """
 
     # init
-    batch_size = vol.shape[0]
+    batch_size = vol.shape[0] if vol.shape[0] is not None else tf.shape(vol)[0]  # unknown in keras predict
     loc_shape = loc.shape[1: -1]
     n = loc.shape[-1]  # dimension of vol
     has_ch = False
@@ -91,8 +119,22 @@ def resample(vol, loc, interpolation="linear"):
     else:
         raise ValueError("vol shape inconsistent with loc")
     vol_shape = vol.shape[1:n + 1]
+    if interpolation == "nearest":
+        # only one gather is needed
+        loc_nearest = [tf.cast(tf.round(tf.clip_by_value(_loc, clip_value_min=0, clip_value_max=vol_shape[d] - 1)),
+                               tf.int32)
+                       for d, _loc in enumerate(tf.unstack(loc, axis=-1))]  # n tensors of shape [batch, *loc_shape]
+        batch_coords = tf.tile(tf.reshape(tf.range(batch_size), [batch_size] + [1] * len(loc_shape)),
+                               [1] + loc_shape)  # [batch, *loc_shape]
+        return tf.gather_nd(vol, tf.stack([batch_coords] + loc_nearest, axis=-1))  # [batch, *loc_shape, (ch)]
     if interpolation != "linear":
-        raise ValueError("only linear interpolation is supported")
+        raise ValueError("Unknown interpolation type")
+    if impl == "gather":
+        if has_ch:
+            return resample_linear_gather(vol=vol, loc=loc)
+        return resample_linear_gather(vol=tf.expand_dims(vol, axis=-1), loc=loc)[..., 0]
+    elif impl != "pyramid":
+        raise ValueError("Unknown resample implementation")
 
     # clip loc to get anchors and weights
     loc_unstack = tf.unstack(loc, axis=-1)  # n tensors of shape [batch, s_dim 1, ..., s_dim m]
@@ -127,11 +169,114 @@ def resample(vol, loc, interpolation="linear"):
     return sampled
 
 
-def random_transform_generator(batch_size, scale=0.1):
+def get_linear_corners(loc, vol_shape, with_grad=False):
+    """
+    calculate the flattened indices and the weights of the hypercube corners for linear interpolation
+
+    :param loc: shape = [batch, *loc_shape, n]
+    :param vol_shape: [v_dim 1, ..., v_dim n]
+    :param with_grad: true if the derivatives of the weights w.r.t. loc are also returned
+    :return: (indices, weights) or (indices, weights, weight_grads)
+             indices, shape = [2**n, batch, *loc_shape], indices of a volume reshaped to [batch * prod(vol_shape), ch]
+             weights, shape = [2**n, batch, *loc_shape]
+             weight_grads, a list of n tensors of shape [2**n, batch, *loc_shape],
+                           weight_grads[d] is the derivative of weights w.r.t. loc[..., d]
+    """
+    n = len(vol_shape)
+    loc_shape = loc.shape[1:-1]
+    strides = [int(np.prod(vol_shape[d + 1:])) for d in range(n)]  # strides of each axis in flattened volume
+    batch_offset = tf.reshape(tf.range(tf.shape(loc)[0]) * int(np.prod(vol_shape)),
+                              [-1] + [1] * len(loc_shape))  # [batch, 1, ..., 1]
+
+    loc_floor_ceil, weight_floor_ceil, inside = [], [], []
+    for d, _loc in enumerate(tf.unstack(loc, axis=-1)):
+        clipped = tf.clip_by_value(_loc, clip_value_min=0, clip_value_max=vol_shape[d] - 1)  # [batch, *loc_shape]
+        c_ceil = tf.math.ceil(clipped)
+        c_floor = tf.maximum(c_ceil - 1, 0)
+        w_floor = c_ceil - clipped
+
+        loc_floor_ceil.append([tf.cast(c_floor, tf.int32) * strides[d],
+                               tf.cast(c_ceil, tf.int32) * strides[d]])
+        weight_floor_ceil.append([w_floor, 1 - w_floor])
+        if with_grad:
+            # clip_by_value passes gradient inside [min, max] only
+            inside.append(tf.cast((_loc >= 0) & (_loc <= vol_shape[d] - 1), dtype=loc.dtype))
+
+    indices, weights, weight_grads = [], [], [[] for _ in range(n)]
+    for c in get_n_bits_combinations(n=n):  # for each corner
+        index = batch_offset
+        for d in range(n):
+            index = index + loc_floor_ceil[d][c[d]]  # broadcast batch_offset
+        indices.append(index)
+        weights.append(tf.reduce_prod(tf.stack([weight_floor_ceil[d][c[d]] for d in range(n)]), axis=0))
+        if with_grad:
+            # d w_floor / d loc = -1, d (1-w_floor) / d loc = 1
+            for d in range(n):
+                others = [weight_floor_ceil[e][c[e]] for e in range(n) if e != d]
+                sign = -1.0 if c[d] == 0 else 1.0
+                grad = sign * inside[d]
+                if len(others) > 0:
+                    grad *= tf.reduce_prod(tf.stack(others), axis=0)
+                weight_grads[d].append(grad)
+
+    indices, weights = tf.stack(indices), tf.stack(weights)
+    if with_grad:
+        return indices, weights, [tf.stack(g) for g in weight_grads]
+    return indices, weights
+
+
+def resample_linear_gather(vol, loc):
+    """
+    linear resampling with one gather over all the 2**n corners
+
+    the corner values are gathered from the flattened volume using linear indices,
+    the gradient is defined manually and recomputes the indices and the weights,
+    so that the gathered corners are not kept for backprop
+
+    :param vol: shape = [batch, v_dim 1, ..., v_dim n, ch]
+    :param loc: shape = [batch, l_dim 1, ..., l_dim m, n]
+    :return: shape = [batch, l_dim 1, ..., l_dim m, ch]
+    """
+    n = loc.shape[-1]
+    vol_shape = vol.shape[1:n + 1]
+    num_ch = vol.shape[-1]
+
+    @tf.custom_gradient
+    def _resample(_vol, _loc):
+        vol_flat = tf.reshape(_vol, [-1, num_ch])  # [batch * prod(vol_shape), ch]
+        indices, weights = get_linear_corners(loc=_loc, vol_shape=vol_shape)
+        corner_values = tf.gather(vol_flat, indices)  # [2**n, batch, *loc_shape, ch]
+        sampled = tf.reduce_sum(corner_values * tf.expand_dims(weights, axis=-1), axis=0)  # [batch, *loc_shape, ch]
+
+        def grad(dy):
+            """
+            :param dy: shape = [batch, *loc_shape, ch]
+            :return: gradients w.r.t. vol and loc
+            """
+            _indices, _weights, _weight_grads = get_linear_corners(loc=_loc, vol_shape=vol_shape, with_grad=True)
+            # vol, scatter the weighted dy back to the corners
+            dvol = tf.math.unsorted_segment_sum(tf.expand_dims(dy, axis=0) * tf.expand_dims(_weights, axis=-1),
+                                                segment_ids=_indices,
+                                                num_segments=tf.shape(vol_flat)[0])  # [batch * prod(vol_shape), ch]
+            dvol = tf.reshape(dvol, tf.shape(_vol))
+            # loc
+            dvalues = tf.reduce_sum(tf.gather(vol_flat, _indices) * tf.expand_dims(dy, axis=0),
+                                    axis=-1)  # [2**n, batch, *loc_shape]
+            dloc = tf.stack([tf.reduce_sum(dvalues * g, axis=0) for g in _weight_grads],
+                            axis=-1)  # [batch, *loc_shape, n]
+            return dvol, dloc
+
+        return sampled, grad
+
+    return _resample(vol, loc)
+
+
+def random_transform_generator(batch_size, scale=0.1, seed=None):
     """
 
     :param batch_size:
     :param scale:
+    :param seed: shape = [2], seed for the stateless random op, if None a random seed is drawn
     :return: tf tensor, shape = [batch, 4, 3]
 
     affine transformation
@@ -154,20 +299,23 @@ def random_transform_generator(batch_size, scale=0.1):
     for (x, y, z) the noise is -(x, y, z) .* (r1, r2, r3) where ri is a random number between (0, scale)
     so (x', y', z') = (x, y, z) .* (1-r1, 1-r2, 1-r3)
 
-    this version is faster (0.4ms -> 0.2ms) per call
+    the four corners in old are affinely independent so old is invertible
+    and the least square solution is the closed form T = old^-1 * new,
+    everything is in tf so that a new transform is sampled at every call in graph mode
     """
-    noise = np.random.uniform(1 - scale, 1, [batch_size, 4, 3])  # [batch, 4, 3]
+    if seed is None:
+        seed = tf.random.uniform(shape=[2], maxval=2 ** 31 - 1, dtype=tf.int64)
+    noise = tf.random.stateless_uniform(shape=[batch_size, 4, 3], seed=seed,
+                                        minval=1 - scale, maxval=1)  # [batch, 4, 3]
 
-    old = np.tile([[[-1, -1, -1, 1],
-                    [-1, -1, 1, 1],
-                    [-1, 1, -1, 1],
-                    [1, -1, -1, 1]]], [batch_size, 1, 1])  # [batch, 4, 4], [0, 0, :] = [-1,-1,-1,1]
-    new = old[:, :, :3] * noise  # [batch, 4, 3]
+    old = tf.constant([[-1, -1, -1, 1],
+                       [-1, -1, 1, 1],
+                       [-1, 1, -1, 1],
+                       [1, -1, -1, 1]], dtype=tf.float32)  # [4, 4]
+    new = old[None, :, :3] * noise  # [batch, 4, 3]
 
-    theta = np.array([np.linalg.lstsq(old[k], new[k], rcond=-1)[0]
-                      for k in range(batch_size)])  # [batch, 4, 3]
-
-    return tf.cast(theta, dtype=tf.float32)
+    theta = tf.einsum("ij,bjk->bik", tf.linalg.inv(old), new)  # [batch, 4, 3]
+    return theta
 
 
 def warp_grid(grid, theta):
@@ -188,3 +336,91 @@ def warp_grid(grid, theta):
     grid = tf.concat([grid, tf.ones(grid_size[:3] + [1])], axis=3)  # [dim1, dim2, dim3, 4]
     grid_warped = tf.einsum("ijkq,bqp->bijkp", grid, theta)  # [batch, dim1, dim2, dim3, 3]
     return grid_warped
+
+
+def resize3d(image, size, method=tf.image.ResizeMethod.BILINEAR):
+    """
+    tensorflow does not have resize 3d, therefore the resize is performed two folds.
+    - resize dim2 and dim3
+    - resize dim1, the other axes are merged into the channels
+    a resize is skipped if the sizes of its axes do not change, as it is an identity
+
+    :param image: shape = [batch, dim1, dim2, dim3, channels], assuming channels_last
+    :param size: [out_dim1, out_dim2, out_dim3], list or tuple
+    :param method: method of tf.image.resize
+    :return: shape = [batch, out_dim1, out_dim2, out_dim3, channels], same dtype as image
+
+    the reshapes do not copy the tensor, and a 3-D resize built from other tf ops
+    (gather, shifted slices or conv3d_transpose stencils for integer factors) was measured
+    slower than the two tf.image.resize, mostly in the backward pass, see benchmark/resize3d.py
+    """
+    input_shape = image.shape.as_list()
+    size = [int(d) for d in size]
+    if size == input_shape[1:4]:
+        return image
+    output = image
+    if size[1:] != input_shape[2:4]:
+        output = tf.reshape(output, [-1, input_shape[2], input_shape[3],
+                                     input_shape[4]])  # [batch * dim1, dim2, dim3, channels]
+        output = tf.image.resize(images=output, size=size[1:],
+                                 method=method)  # [batch * dim1, out_dim2, out_dim3, channels]
+    if size[0] != input_shape[1]:
+        # [batch, dim1, 1, out_dim2 * out_dim3 * channels]
+        output = tf.reshape(output, [-1, input_shape[1], 1, size[1] * size[2] * input_shape[4]])
+        # [batch, out_dim1, 1, out_dim2 * out_dim3 * channels]
+        output = tf.image.resize(images=output, size=[size[0], 1], method=method)
+    output = tf.cast(output, dtype=image.dtype)  # tf.image.resize returns float32, except for nearest
+    return tf.reshape(output, [-1, *size, input_shape[4]])  # [batch, out_dim1, out_dim2, out_dim3, channels]
+
+
+def get_cubic_bspline_filter(spacing):
+    """
+    polyphase filter of the cubic b-spline upsampling of control points by spacing
+
+    :param spacing: int, number of voxels between two control points
+    :return: np array of shape [4, spacing], filter[k, r] = B_k(r / spacing)
+
+    control point j is at voxel (j - 1) * spacing, voxel x = spacing * i + r with 0 <= r < spacing
+    depends on control points i to i+3 with weights B_k(r / spacing), k = 0..3, where
+        B_0(u) = (1 - u)^3 / 6
+        B_1(u) = (3u^3 - 6u^2 + 4) / 6
+        B_2(u) = (-3u^3 + 3u^2 + 3u + 1) / 6
+        B_3(u) = u^3 / 6
+    so a valid convolution of the control points with the filter gives voxel spacing * i + r at [i, r]
+    """
+    u = np.arange(spacing) / spacing
+    return np.stack([(1 - u) ** 3 / 6,
+                     (3 * u ** 3 - 6 * u ** 2 + 4) / 6,
+                     (-3 * u ** 3 + 3 * u ** 2 + 3 * u + 1) / 6,
+                     u ** 3 / 6]).astype(np.float32)
+
+
+def get_control_point_size(image_size, spacing):
+    """
+    number of cubic b-spline control points per axis to cover image_size, see get_cubic_bspline_filter
+    :param image_size: [dim1, dim2, dim3]
+    :param spacing: int
+    :return: [c_dim1, c_dim2, c_dim3]
+    """
+    return [(dim - 1) // spacing + 4 for dim in image_size]
+
+
+def adjust_batch_norm_momentum_for_recompute(layers):
+    """
+    layers wrapped in tf.recompute_grad are called twice per training step, in the forward and in the backward pass,
+    so their batch norm moving statistics are updated twice with the same batch statistics,
+    two updates with momentum sqrt(m) are equal to one update with momentum m
+
+    some layers are only created when their parent is built, so this should be called once the layers are built,
+    each batch norm layer is adjusted only once
+
+    the keras config of the adjusted layers holds sqrt(m), the models are rebuilt from the yaml config
+    and restored from weights only, so it is never reused to build a layer
+
+    :param layers: list of tf.keras.layers.Layer, modified in place
+    """
+    for _layer in layers:
+        for module in _layer.submodules:
+            if isinstance(module, tf.keras.layers.BatchNormalization) and not getattr(module, "_recompute", False):
+                module.momentum = module.momentum ** 0.5
+                module._recompute = True
@@ -25,17 +25,36 @@ def local_displacement_energy(ddf, energy_type, **kwargs):
         return tf.reduce_mean(norms, [1, 2, 3, 4])
 
     def compute_bending_energy(displacement):
-        dTdx = gradient_txyz(displacement, gradient_dx)
-        dTdy = gradient_txyz(displacement, gradient_dy)
-        dTdz = gradient_txyz(displacement, gradient_dz)
-        dTdxx = gradient_txyz(dTdx, gradient_dx)
-        dTdyy = gradient_txyz(dTdy, gradient_dy)
-        dTdzz = gradient_txyz(dTdz, gradient_dz)
-        dTdxy = gradient_txyz(dTdx, gradient_dy)
-        dTdyz = gradient_txyz(dTdy, gradient_dz)
-        dTdxz = gradient_txyz(dTdx, gradient_dz)
-        return tf.reduce_mean(dTdxx ** 2 + dTdyy ** 2 + dTdzz ** 2 + 2 * dTdxy ** 2 + 2 * dTdxz ** 2 + 2 * dTdyz ** 2,
-                              [1, 2, 3, 4])
+        """
+        the second order derivatives are computed with 1-D finite difference stencils applied as VALID conv3d,
+        equivalent to applying the first order central differences twice as in compute_gradient_norm,
+        the three displacement channels are moved to the batch axis so that they are filtered independently
+
+        :param displacement: shape = [batch, dim1, dim2, dim3, 3]
+        :return: shape = [batch]
+        """
+
+        def filter1d(x, kernel, axis):
+            shape = [1, 1, 1, 1, 1]
+            shape[axis] = 5
+            return tf.nn.conv3d(x, filters=tf.reshape(kernel, shape), strides=[1, 1, 1, 1, 1], padding="VALID")
+
+        d0 = tf.constant([0, 0, 1, 0, 0], dtype=displacement.dtype)  # identity, only crops
+        d1 = tf.constant([0, -1, 0, 1, 0], dtype=displacement.dtype) / 2  # first order
+        d2 = tf.constant([1, 0, -2, 0, 1], dtype=displacement.dtype) / 4  # second order
+
+        batch_size = tf.shape(displacement)[0]
+        T = tf.expand_dims(tf.concat(tf.unstack(displacement, axis=4), axis=0), axis=4)  # [3*batch, ..., 1]
+        Tx, Txx, T0 = filter1d(T, d1, 0), filter1d(T, d2, 0), filter1d(T, d0, 0)
+        T0y = filter1d(T0, d1, 1)
+        dTdxx = filter1d(filter1d(Txx, d0, 1), d0, 2)
+        dTdyy = filter1d(filter1d(T0, d2, 1), d0, 2)
+        dTdzz = filter1d(filter1d(T0, d0, 1), d2, 2)
+        dTdxy = filter1d(filter1d(Tx, d1, 1), d0, 2)
+        dTdxz = filter1d(filter1d(Tx, d0, 1), d1, 2)
+        dTdyz = filter1d(T0y, d1, 2)
+        energy = dTdxx ** 2 + dTdyy ** 2 + dTdzz ** 2 + 2 * dTdxy ** 2 + 2 * dTdxz ** 2 + 2 * dTdyz ** 2
+        return tf.reduce_mean(tf.reshape(energy, [3, batch_size, -1]), axis=[0, 2])
 
     if energy_type == "bending":
         return compute_bending_energy(ddf)
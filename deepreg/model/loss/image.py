@@ -3,30 +3,56 @@ import tensorflow as tf
 EPS = 1.0e-6  # epsilon to prevent NaN
 
 
-def similarity_fn(y_true, y_pred, name, **kwargs):
+def similarity_fn(y_true, y_pred, name, kernel_size=9, **kwargs):
     """
 
     :param y_true: fixed_image, shape = [batch, f_dim1, f_dim2, f_dim3]
     :param y_pred: warped_moving_image, shape = [batch, f_dim1, f_dim2, f_dim3]
     :param name:
+    :param kernel_size: size of the window for lncc
     :return: shape = [batch]
     """
     y_true = tf.expand_dims(y_true, axis=4)
     y_pred = tf.expand_dims(y_pred, axis=4)
     if name == "lncc":
-        return -local_normalized_cross_correlation(y_true, y_pred)
+        return -local_normalized_cross_correlation(y_true, y_pred, kernel_size=kernel_size)
     elif name == "ssd":
         return ssd(y_true, y_pred)
     else:
         raise ValueError("Unknown loss type.")
 
 
+def box_filter3d(x, kernel_size):
+    """
+    sum x in a cubic window with zero padding,
+    equivalent to tf.nn.conv3d with an all-ones kernel of shape [kernel_size] * 3 and padding "SAME"
+    but the filter is separable so three 1-D convolutions are performed, O(kernel_size) per voxel
+    channels are moved to the batch axis so that they are filtered independently
+
+    :param x: shape = [batch, dim1, dim2, dim3, ch]
+    :param kernel_size:
+    :return: shape = [batch, dim1, dim2, dim3, ch]
+    """
+    shape = tf.shape(x)
+    num_ch = x.shape[4]
+    strides = [1, 1, 1, 1, 1]
+    if num_ch != 1:
+        x = tf.reshape(tf.transpose(x, [0, 4, 1, 2, 3]), [-1, shape[1], shape[2], shape[3], 1])
+    for filter_shape in [[kernel_size, 1, 1, 1, 1], [1, kernel_size, 1, 1, 1], [1, 1, kernel_size, 1, 1]]:
+        x = tf.nn.conv3d(x, filters=tf.ones(shape=filter_shape, dtype=x.dtype), strides=strides, padding="SAME")
+    if num_ch != 1:
+        x = tf.transpose(tf.reshape(x, [-1, num_ch, shape[1], shape[2], shape[3]]), [0, 2, 3, 4, 1])
+    return x
+
+
 def local_normalized_cross_correlation(y_true, y_pred, kernel_size=9):
     """
     moving a kernel/window on the y_true/y_pred
     then calculate the ncc in the window of y_true/y_pred
     average over all windows in the end
 
+    the five moments are stacked along the batch axis and box filtered in one call
+
     :param y_true: shape = [batch, dim1, dim2, dim3, ch]
     :param y_pred: shape = [batch, dim1, dim2, dim3, ch]
     :param kernel_size:
@@ -34,20 +60,15 @@ def local_normalized_cross_correlation(y_true, y_pred, kernel_size=9):
     """
 
     kernel_vol = kernel_size ** 3
-    filters = tf.ones(shape=[kernel_size, kernel_size, kernel_size, 1, 1])  # [dim1, dim2, dim3, d_in, d_out]
-    strides = [1, 1, 1, 1, 1]
-    padding = "SAME"
 
     # t = y_true, p = y_pred
     t2 = y_true * y_true
     p2 = y_pred * y_pred
     tp = y_true * y_pred
 
-    t_sum = tf.nn.conv3d(y_true, filters=filters, strides=strides, padding=padding)
-    p_sum = tf.nn.conv3d(y_pred, filters=filters, strides=strides, padding=padding)
-    t2_sum = tf.nn.conv3d(t2, filters=filters, strides=strides, padding=padding)
-    p2_sum = tf.nn.conv3d(p2, filters=filters, strides=strides, padding=padding)
-    tp_sum = tf.nn.conv3d(tp, filters=filters, strides=strides, padding=padding)
+    t_sum, p_sum, t2_sum, p2_sum, tp_sum = tf.split(
+        box_filter3d(tf.concat([y_true, y_pred, t2, p2, tp], axis=0), kernel_size=kernel_size),
+        num_or_size_splits=5, axis=0)
 
     t_avg = t_sum / kernel_vol
     p_avg = p_sum / kernel_vol
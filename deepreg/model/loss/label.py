@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 EPS = 1.0e-6  # epsilon to prevent NaN
+FFT_KERNEL_SIZE_THRESHOLD = 97  # kernels at least this long are applied with fft, see benchmark/separable_filter3d.py
 
 """
 similarity
@@ -39,6 +40,9 @@ def multi_scale_loss(y_true, y_pred, loss_type, loss_scales):
     :param loss_type:
     :param loss_scales:
     :return: [batch]
+
+    y_true and y_pred are not stacked into one tensor for smoothing,
+    otherwise the backprop goes through the smoothing of y_true too, which doubles the cost
     """
     assert len(y_true.shape) == 4
     assert len(y_pred.shape) == 4
@@ -154,22 +158,29 @@ def gauss_kernel1d(sigma):
 
 def cauchy_kernel1d(sigma):  # this is an approximation
     if sigma == 0:
-        return 0
+        return tf.constant(0)
     else:
         tail = int(sigma * 5)
         k = tf.math.reciprocal([((x / sigma) ** 2 + 1) for x in range(-tail, tail + 1)])
         return k / tf.reduce_sum(k)
 
 
-def separable_filter3d(x, kernel):
+def separable_filter3d(x, kernel, method="auto"):
     """
     :param x: shape = [batch, dim1, dim2, dim3]
-    :param kernel:
+    :param kernel: 1-D kernel applied along each axis, a scalar means no filtering
+    :param method: "conv" applies three 1-D convolutions,
+                   "fft" multiplies in the frequency domain, cheaper for large kernels,
+                   "auto" uses fft if the kernel has at least FFT_KERNEL_SIZE_THRESHOLD elements
     :return: shape = [batch, dim1, dim2, dim3]
     """
     if len(kernel.shape) == 0:
         return x
-    else:
+    if method == "auto":
+        method = "fft" if kernel.shape[0] >= FFT_KERNEL_SIZE_THRESHOLD else "conv"
+    if method == "fft":
+        return separable_filter3d_fft(x, kernel)
+    elif method == "conv":
         strides = [1, 1, 1, 1, 1]
         x = tf.nn.conv3d(tf.nn.conv3d(tf.nn.conv3d(
             tf.expand_dims(x, axis=4),
@@ -177,6 +188,53 @@ def separable_filter3d(x, kernel):
             filters=tf.reshape(kernel, [1, -1, 1, 1, 1]), strides=strides, padding="SAME"),
             filters=tf.reshape(kernel, [1, 1, -1, 1, 1]), strides=strides, padding="SAME")
         return x[:, :, :, :, 0]
+    else:
+        raise ValueError("Unknown filter method.")
+
+
+def get_fft_length(n):
+    """
+    smallest length >= n which has only 2, 3 and 5 as prime factors, fft is efficient for these lengths
+    :param n:
+    :return:
+    """
+    while True:
+        m = n
+        for p in [2, 3, 5]:
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def separable_filter3d_fft(x, kernel):
+    """
+    same as separable_filter3d with conv but each 1-D filtering is computed in the frequency domain,
+    the signal is zero padded to at least the full linear convolution size so there is no circular aliasing
+
+    :param x: shape = [batch, dim1, dim2, dim3]
+    :param kernel: shape = [kernel_size]
+    :return: shape = [batch, dim1, dim2, dim3]
+    """
+    kernel_size = kernel.shape[0]
+    pad_before = (kernel_size - 1) // 2  # same as padding "SAME" of conv3d
+    for axis in [1, 2, 3]:
+        # move the axis to the last as fft is performed on the inner-most axis
+        perm = [0, 1, 2, 3]
+        perm[axis], perm[3] = perm[3], perm[axis]
+        x = tf.transpose(x, perm)
+        dim = x.shape[3]
+
+        # taps further than dim - 1 from the center never overlap with the volume
+        begin, end = max(0, pad_before - dim + 1), min(kernel_size, pad_before + dim)
+        k = tf.reverse(kernel[begin:end], axis=[0])  # conv3d computes cross-correlation
+        fft_length = [get_fft_length(dim + end - begin - 1)]
+        x = tf.signal.irfft(tf.signal.rfft(x, fft_length=fft_length) * tf.signal.rfft(k, fft_length=fft_length),
+                            fft_length=fft_length)
+        start = end - 1 - pad_before
+        x = tf.transpose(x[..., start:start + dim], perm)
+    return x
 
 
 """
@@ -191,10 +249,11 @@ def compute_centroid(mask, grid):
     :param grid: shape = [dim1, dim2, dim3, 3]
     :return: shape = [batch, 3]
     """
-    bool_mask = tf.expand_dims(tf.cast(mask >= 0.5, dtype=tf.float32), axis=4)  # [batch, dim1, dim2, dim3, 1]
-    masked_grid = bool_mask * tf.expand_dims(grid, axis=0)  # [batch, dim1, dim2, dim3, 3]
-    numerator = tf.reduce_sum(masked_grid, axis=[1, 2, 3]) + EPS  # [batch, 3]
-    denominator = tf.reduce_sum(bool_mask, axis=[1, 2, 3]) + EPS  # [batch, 1]
+    # the masked grid is summed by a matmul, without storing a [batch, dim1, dim2, dim3, 3] tensor
+    bool_mask = tf.reshape(tf.cast(mask >= 0.5, dtype=tf.float32), [tf.shape(mask)[0], -1])  # [batch, num_voxels]
+    grid = tf.reshape(tf.cast(grid, dtype=tf.float32), [-1, 3])  # [num_voxels, 3]
+    numerator = tf.matmul(bool_mask, grid) + EPS  # [batch, 3]
+    denominator = tf.reduce_sum(bool_mask, axis=1, keepdims=True) + EPS  # [batch, 1]
     return numerator / denominator  # [batch, 3]
 
 
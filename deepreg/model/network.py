@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 import deepreg.model.layer as layer
+import deepreg.model.layer_util as layer_util
 import deepreg.model.loss.deform
 import deepreg.model.loss.image as image_loss
 import deepreg.model.loss.label as label_loss
@@ -8,13 +9,32 @@ from deepreg.model.backbone.local_net import LocalNet
 from deepreg.model.backbone.u_net import UNet
 
 
-def build_backbone(image_size, out_channels, tf_model_config):
+def set_precision(precision):
+    """
+    set the global keras mixed precision policy, it has to be called before building the model
+    with a mixed policy, the backbone computes in float16 or bfloat16 while its variables stay in float32
+    mixed_float16 targets GPUs, tensorflow has no float16 kernel of MaxPool3D on CPU
+    :param precision: "float32", "mixed_float16" or "mixed_bfloat16"
+    """
+    if precision not in ["float32", "mixed_float16", "mixed_bfloat16"]:
+        raise ValueError("Unknown precision")
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
+def build_backbone(image_size, out_channels, tf_model_config, stride=1):
     """
     backbone model accepts a single input of shape [batch, dim1, dim2, dim3, ch_in]
                and returns a single output of shape [batch, dim1, dim2, dim3, ch_out]
+    the backbone follows the global keras mixed precision policy, see set_precision,
+    its output is cast to float32 by the callers, and the other layers and losses are always in float32
     :param image_size: [dim1, dim2, dim3]
     :param out_channels: ch_out
     :param tf_model_config:
+    :param stride: the output is at about 1/stride of the input resolution, image_size is the output size,
+                   e.g. ddf_stride or control_point_spacing,
+                   the unet decoder stops at level log2(stride) so stride should be a power of 2,
+                   the local net decoder stops at min(extract_levels), which should be at least log2(stride),
+                   otherwise the finer levels would be decoded only to be resized down
     :return:
     """
 
@@ -22,15 +42,24 @@ def build_backbone(image_size, out_channels, tf_model_config):
     if tf_model_config["backbone"]["out_activation"] == "":
         tf_model_config["backbone"]["out_activation"] = None
 
+    out_level = stride.bit_length() - 1  # floor(log2(stride))
     if tf_model_config["backbone"]["name"] == "local":
+        if min(tf_model_config["local"]["extract_levels"]) < out_level:
+            raise ValueError("With a local backbone and a stride of %d, extract_levels should start at %d or above, "
+                             "got %s" % (stride, out_level, tf_model_config["local"]["extract_levels"]))
         return LocalNet(image_size=image_size, out_channels=out_channels,
                         out_kernel_initializer=tf_model_config["backbone"]["out_kernel_initializer"],
                         out_activation=tf_model_config["backbone"]["out_activation"],
+                        conv_type=tf_model_config["backbone"].get("conv_type", "dense"),
                         **tf_model_config["local"])
     elif tf_model_config["backbone"]["name"] == "unet":
+        if stride != 2 ** out_level:
+            raise ValueError("With a unet backbone, the stride should be a power of 2, got %s" % stride)
         return UNet(image_size=image_size, out_channels=out_channels,
                     out_kernel_initializer=tf_model_config["backbone"]["out_kernel_initializer"],
                     out_activation=tf_model_config["backbone"]["out_activation"],
+                    conv_type=tf_model_config["backbone"].get("conv_type", "dense"),
+                    out_level=out_level,
                     **tf_model_config["unet"])
     else:
         raise ValueError("Unknown model name")
@@ -48,6 +77,104 @@ def build_inputs(moving_image_size, fixed_image_size, index_size, batch_size):
     return moving_image, fixed_image, moving_label, indices
 
 
+def warp_image_and_label(ddf, moving_image, moving_label, fixed_image_size, label_interpolation, implicit_grid,
+                         jit_compile=False):
+    """
+    warp moving image and label using the same ddf
+    if the label is interpolated linearly, image and label are stacked as channels and warped in one call
+    :param ddf: [batch, f_dim1, f_dim2, f_dim3, 3]
+    :param moving_image: [batch, m_dim1, m_dim2, m_dim3]
+    :param moving_label: [batch, m_dim1, m_dim2, m_dim3]
+    :param fixed_image_size: [f_dim1, f_dim2, f_dim3]
+    :param label_interpolation: "linear" or "nearest"
+    :param implicit_grid: true if the reference grid is not stored, see layer.Warping
+    :param jit_compile: true if the resampling is compiled with XLA, see layer.Warping
+    :return: pred_fixed_image, pred_fixed_label, both of shape [batch, f_dim1, f_dim2, f_dim3]
+    """
+    if label_interpolation == "linear":
+        pred_fixed = layer.Warping(fixed_image_size=fixed_image_size, implicit_grid=implicit_grid,
+                                   jit_compile=jit_compile, dtype=tf.float32)(
+            [ddf, tf.stack([moving_image, moving_label], axis=4)])  # [batch, f_dim1, f_dim2, f_dim3, 2]
+        pred_fixed_image, pred_fixed_label = tf.unstack(pred_fixed, axis=4)
+    else:
+        pred_fixed_image = layer.Warping(fixed_image_size=fixed_image_size,
+                                         implicit_grid=implicit_grid, jit_compile=jit_compile,
+                                         dtype=tf.float32)([ddf, moving_image])
+        pred_fixed_label = layer.Warping(fixed_image_size=fixed_image_size,
+                                         interpolation=label_interpolation,
+                                         implicit_grid=implicit_grid, jit_compile=jit_compile,
+                                         dtype=tf.float32)([ddf, moving_label])
+    return pred_fixed_image, pred_fixed_label
+
+
+def get_ddf_size(fixed_image_size, ddf_stride):
+    """
+    size of the ddf predicted by the backbone
+    :param fixed_image_size: [f_dim1, f_dim2, f_dim3]
+    :param ddf_stride: positive int, the ddf is predicted at 1/ddf_stride of the fixed image resolution
+    :return: [d_dim1, d_dim2, d_dim3]
+    """
+    if not (isinstance(ddf_stride, int) and ddf_stride >= 1):
+        raise ValueError("ddf_stride should be a positive integer, got %s" % ddf_stride)
+    return [-(-dim // ddf_stride) for dim in fixed_image_size]
+
+
+def upsample_ddf(ddf, fixed_image_size):
+    """
+    resize a ddf predicted at a lower resolution to the fixed image size
+    the ddf is in voxel units of its own grid, so it is also scaled by the resize ratio,
+    with half pixel centers, a displacement of 1 voxel on the coarse grid is (f_dim / d_dim) voxels on the fine grid
+    :param ddf: [batch, d_dim1, d_dim2, d_dim3, 3]
+    :param fixed_image_size: [f_dim1, f_dim2, f_dim3]
+    :return: [batch, f_dim1, f_dim2, f_dim3, 3]
+    """
+    ddf_size = ddf.shape[1:4]
+    if list(ddf_size) == list(fixed_image_size):
+        return ddf
+    scale = tf.constant([f / d for f, d in zip(fixed_image_size, ddf_size)], dtype=ddf.dtype)
+    return layer.Resize3d(size=fixed_image_size, dtype=tf.float32)(inputs=ddf) * scale
+
+
+def add_ddf_loss_metric(model, tf_loss_config,
+                        fixed_image, pred_fixed_image, ddf, fixed_label, pred_fixed_label, suffix):
+    """
+    add image similarity, regularization and label losses and their metrics to a model predicting a ddf
+    :param model: tf.keras.Model
+    :param tf_loss_config:
+    :param fixed_image:      [batch, f_dim1, f_dim2, f_dim3]
+    :param pred_fixed_image: [batch, f_dim1, f_dim2, f_dim3]
+    :param ddf:              [batch, d_dim1, d_dim2, d_dim3, 3], regularization is computed at the ddf resolution
+    :param fixed_label:      [batch, f_dim1, f_dim2, f_dim3]
+    :param pred_fixed_label: [batch, f_dim1, f_dim2, f_dim3]
+    :param suffix:
+    :return:
+    """
+    # image loss
+    if tf_loss_config["similarity"]["image"]["weight"] > 0:
+        loss_image = tf.reduce_mean(image_loss.similarity_fn(
+            y_true=fixed_image, y_pred=pred_fixed_image,
+            **tf_loss_config["similarity"]["image"]))
+        weighted_loss_image = loss_image * tf_loss_config["similarity"]["image"]["weight"]
+        model.add_loss(weighted_loss_image)
+        model.add_metric(loss_image, name="loss/image_similarity" + suffix, aggregation="mean")
+        model.add_metric(weighted_loss_image, name="loss/weighted_image_similarity" + suffix, aggregation="mean")
+
+    # regularization loss
+    loss_reg = tf.reduce_mean(
+        deepreg.model.loss.deform.local_displacement_energy(ddf, **tf_loss_config["regularization"]))
+    weighted_loss_reg = loss_reg * tf_loss_config["regularization"]["weight"]
+    model.add_loss(weighted_loss_reg)
+    model.add_metric(loss_reg, name="loss/regularization" + suffix, aggregation="mean")
+    model.add_metric(weighted_loss_reg, name="loss/weighted_regularization" + suffix, aggregation="mean")
+
+    # label loss
+    if fixed_label is not None:
+        label_loss_fn = label_loss.get_similarity_fn(config=tf_loss_config["similarity"]["label"])
+        loss_label = label_loss_fn(y_true=fixed_label, y_pred=pred_fixed_label)
+        model.add_loss(loss_label)
+        model.add_metric(loss_label, name="loss/label" + suffix, aggregation="mean")
+
+
 def build_ddf_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_model_config, tf_loss_config):
     """
 
@@ -69,80 +196,62 @@ def build_ddf_model(moving_image_size, fixed_image_size, index_size, batch_size,
         :return:
         """
         # ddf
-        backbone_input = tf.concat([layer.Resize3d(size=fixed_image_size)(inputs=tf.expand_dims(_moving_image, axis=4)),
-                                    tf.expand_dims(_fixed_image, axis=4)],
-                                   axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 2]
-        _ddf = _backbone(inputs=backbone_input)  # [batch, f_dim1, f_dim2, f_dim3, 3]
+        backbone_input = tf.concat([
+            layer.Resize3d(size=fixed_image_size, dtype=tf.float32)(inputs=tf.expand_dims(_moving_image, axis=4)),
+            tf.expand_dims(_fixed_image, axis=4)],
+            axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 2]
+        _ddf = tf.cast(_backbone(inputs=backbone_input), tf.float32)  # [batch, d_dim1, d_dim2, d_dim3, 3]
+        _fixed_ddf = upsample_ddf(ddf=_ddf, fixed_image_size=fixed_image_size)  # [batch, f_dim1, f_dim2, f_dim3, 3]
 
         # prediction image ang label shape = [batch, f_dim1, f_dim2, f_dim3]
-        _pred_fixed_image = layer.Warping(fixed_image_size=fixed_image_size)([_ddf, _moving_image])
-        _pred_fixed_label = layer.Warping(fixed_image_size=fixed_image_size)([_ddf, _moving_label])
-
-        return _ddf, _pred_fixed_image, _pred_fixed_label
-
-    def add_loss_metric(_fixed_image, _pred_fixed_image, _ddf, _fixed_label, _pred_fixed_label, suffix):
-        """
-
-        :param _fixed_image:      [batch, f_dim1, f_dim2, f_dim3]
-        :param _pred_fixed_image: [batch, f_dim1, f_dim2, f_dim3]
-        :param _ddf:              [batch, f_dim1, f_dim2, f_dim3, 3]
-        :param _fixed_label:      [batch, f_dim1, f_dim2, f_dim3]
-        :param _pred_fixed_label: [batch, f_dim1, f_dim2, f_dim3]
-        :param suffix:
-        :return:
-        """
-        # image loss
-        if tf_loss_config["similarity"]["image"]["weight"] > 0:
-            loss_image = tf.reduce_mean(image_loss.similarity_fn(
-                y_true=_fixed_image, y_pred=_pred_fixed_image,
-                **tf_loss_config["similarity"]["image"]))
-            weighted_loss_image = loss_image * tf_loss_config["similarity"]["image"]["weight"]
-            model.add_loss(weighted_loss_image)
-            model.add_metric(loss_image, name="loss/image_similarity" + suffix, aggregation="mean")
-            model.add_metric(weighted_loss_image, name="loss/weighted_image_similarity" + suffix, aggregation="mean")
-
-        # regularization loss
-        loss_reg = tf.reduce_mean(
-            deepreg.model.loss.deform.local_displacement_energy(_ddf, **tf_loss_config["regularization"]))
-        weighted_loss_reg = loss_reg * tf_loss_config["regularization"]["weight"]
-        model.add_loss(weighted_loss_reg)
-        model.add_metric(loss_reg, name="loss/regularization" + suffix, aggregation="mean")
-        model.add_metric(weighted_loss_reg, name="loss/weighted_regularization" + suffix, aggregation="mean")
-
-        # label loss
-        if _fixed_label is not None:
-            label_loss_fn = label_loss.get_similarity_fn(config=tf_loss_config["similarity"]["label"])
-            loss_label = label_loss_fn(y_true=_fixed_label, y_pred=_pred_fixed_label)
-            model.add_loss(loss_label)
-            model.add_metric(loss_label, name="loss/label" + suffix, aggregation="mean")
+        _pred_fixed_image, _pred_fixed_label = warp_image_and_label(ddf=_fixed_ddf,
+                                                                    moving_image=_moving_image,
+                                                                    moving_label=_moving_label,
+                                                                    fixed_image_size=fixed_image_size,
+                                                                    label_interpolation=label_interpolation,
+                                                                    implicit_grid=implicit_grid,
+                                                                    jit_compile=jit_warping)
+
+        return _ddf, _fixed_ddf, _pred_fixed_image, _pred_fixed_label
+
+    # nearest interpolation is not differentiable, it should only be used for prediction
+    label_interpolation = tf_model_config.get("label_interpolation", "linear")
+    # reference grids are shared between layers, or not stored at all if implicit
+    implicit_grid = tf_model_config.get("implicit_grid", False)
+    # only the resampling of the warpings is compiled with xla, see set_jit_compile for the whole model
+    jit_warping = tf_model_config.get("xla", "none") == "warping"
+    # the backbone predicts the ddf at a lower resolution, it is upsampled for warping only
+    ddf_size = get_ddf_size(fixed_image_size, ddf_stride=tf_model_config.get("ddf_stride", 1))
 
     # inputs
     moving_image, fixed_image, moving_label, indices = build_inputs(
         moving_image_size, fixed_image_size, index_size, batch_size)
 
     # backbone
-    backbone = build_backbone(image_size=fixed_image_size, out_channels=3,
-                              tf_model_config=tf_model_config)
+    backbone = build_backbone(image_size=ddf_size, out_channels=3,
+                              tf_model_config=tf_model_config, stride=tf_model_config.get("ddf_stride", 1))
 
     # forward
-    ddf, pred_fixed_image, pred_fixed_label = forward(_backbone=backbone,
-                                                      _moving_image=moving_image,
-                                                      _moving_label=moving_label,
-                                                      _fixed_image=fixed_image)
+    ddf, fixed_ddf, pred_fixed_image, pred_fixed_label = forward(_backbone=backbone,
+                                                                 _moving_image=moving_image,
+                                                                 _moving_label=moving_label,
+                                                                 _fixed_image=fixed_image)
 
     # build model
     model = tf.keras.Model(inputs=[moving_image, fixed_image, moving_label, indices],
                            outputs=[pred_fixed_label],
                            name="DDFRegModel")
-    model.ddf = ddf
+    model.ddf = fixed_ddf
+    model.pred_fixed_image = pred_fixed_image
 
     # loss and metric
-    add_loss_metric(_fixed_image=fixed_image,
-                    _pred_fixed_image=pred_fixed_image,
-                    _ddf=ddf,
-                    _fixed_label=None,
-                    _pred_fixed_label=None,
-                    suffix="")
+    add_ddf_loss_metric(model=model, tf_loss_config=tf_loss_config,
+                        fixed_image=fixed_image,
+                        pred_fixed_image=pred_fixed_image,
+                        ddf=ddf,
+                        fixed_label=None,
+                        pred_fixed_label=None,
+                        suffix="")
 
     return model
 
@@ -168,82 +277,154 @@ def build_dvf_model(moving_image_size, fixed_image_size, index_size, batch_size,
         :return:
         """
         # ddf
-        backbone_input = tf.concat([layer.Resize3d(size=fixed_image_size)(inputs=tf.expand_dims(_moving_image, axis=4)),
-                                    tf.expand_dims(_fixed_image, axis=4)],
-                                   axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 2]
-        _dvf = _backbone(inputs=backbone_input)  # [batch, f_dim1, f_dim2, f_dim3, 3]
-        _ddf = layer.IntDVF(fixed_image_size=fixed_image_size)(_dvf)
+        backbone_input = tf.concat([
+            layer.Resize3d(size=fixed_image_size, dtype=tf.float32)(inputs=tf.expand_dims(_moving_image, axis=4)),
+            tf.expand_dims(_fixed_image, axis=4)],
+            axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 2]
+        _dvf = tf.cast(_backbone(inputs=backbone_input), tf.float32)  # [batch, d_dim1, d_dim2, d_dim3, 3]
+        # integration on the grid of the dvf
+        # [batch, d_dim1, d_dim2, d_dim3, 3]
+        _ddf = layer.IntDVF(fixed_image_size=ddf_size, implicit_grid=implicit_grid, jit_compile=jit_warping,
+                            dtype=tf.float32, **tf_model_config.get("dvf", dict()))(_dvf)
+        _fixed_ddf = upsample_ddf(ddf=_ddf, fixed_image_size=fixed_image_size)  # [batch, f_dim1, f_dim2, f_dim3, 3]
 
         # prediction image ang label shape = [batch, f_dim1, f_dim2, f_dim3]
-        _pred_fixed_image = layer.Warping(fixed_image_size=fixed_image_size)([_ddf, _moving_image])
-        _pred_fixed_label = layer.Warping(fixed_image_size=fixed_image_size)([_ddf, _moving_label])
+        _pred_fixed_image, _pred_fixed_label = warp_image_and_label(ddf=_fixed_ddf,
+                                                                    moving_image=_moving_image,
+                                                                    moving_label=_moving_label,
+                                                                    fixed_image_size=fixed_image_size,
+                                                                    label_interpolation=label_interpolation,
+                                                                    implicit_grid=implicit_grid,
+                                                                    jit_compile=jit_warping)
+
+        return _dvf, _ddf, _fixed_ddf, _pred_fixed_image, _pred_fixed_label
+
+    # nearest interpolation is not differentiable, it should only be used for prediction
+    label_interpolation = tf_model_config.get("label_interpolation", "linear")
+    # reference grids are shared between layers, or not stored at all if implicit
+    implicit_grid = tf_model_config.get("implicit_grid", False)
+    # only the resampling of the warpings is compiled with xla, see set_jit_compile for the whole model
+    jit_warping = tf_model_config.get("xla", "none") == "warping"
+    # the backbone predicts the ddf at a lower resolution, it is upsampled for warping only
+    ddf_size = get_ddf_size(fixed_image_size, ddf_stride=tf_model_config.get("ddf_stride", 1))
 
-        return _dvf, _ddf, _pred_fixed_image, _pred_fixed_label
+    # inputs
+    moving_image, fixed_image, moving_label, indices = build_inputs(
+        moving_image_size, fixed_image_size, index_size, batch_size)
+
+    # backbone
+    backbone = build_backbone(image_size=ddf_size, out_channels=3,
+                              tf_model_config=tf_model_config, stride=tf_model_config.get("ddf_stride", 1))
 
-    def add_loss_metric(_fixed_image, _pred_fixed_image, _ddf, _fixed_label, _pred_fixed_label, suffix):
+    # forward
+    dvf, ddf, fixed_ddf, pred_fixed_image, pred_fixed_label = forward(_backbone=backbone,
+                                                                      _moving_image=moving_image,
+                                                                      _moving_label=moving_label,
+                                                                      _fixed_image=fixed_image)
+
+    # build model
+    model = tf.keras.Model(inputs=[moving_image, fixed_image, moving_label, indices],
+                           outputs=[pred_fixed_label],
+                           name="DDFRegModel")
+    model.dvf = dvf
+    model.ddf = fixed_ddf
+    model.pred_fixed_image = pred_fixed_image
+
+    # loss and metric
+    add_ddf_loss_metric(model=model, tf_loss_config=tf_loss_config,
+                        fixed_image=fixed_image,
+                        pred_fixed_image=pred_fixed_image,
+                        ddf=ddf,
+                        fixed_label=None,
+                        pred_fixed_label=None,
+                        suffix="")
+
+    return model
+
+
+def build_bspline_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_model_config,
+                        tf_loss_config):
+    """
+    the backbone predicts the displacements of a sparse grid of cubic b-spline control points,
+    they are upsampled to a dense ddf which is used for warping and regularization
+
+    :param moving_image_size: [m_dim1, m_dim2, m_dim3]
+    :param fixed_image_size: [f_dim1, f_dim2, f_dim3]
+    :param batch_size:
+    :param tf_model_config:
+    :param tf_loss_config:
+    :return:
+    """
+
+    def forward(_backbone, _moving_image, _moving_label, _fixed_image):
         """
 
-        :param _fixed_image:      [batch, f_dim1, f_dim2, f_dim3]
-        :param _pred_fixed_image: [batch, f_dim1, f_dim2, f_dim3]
-        :param _ddf:              [batch, f_dim1, f_dim2, f_dim3, 3]
-        :param _fixed_label:      [batch, f_dim1, f_dim2, f_dim3]
-        :param _pred_fixed_label: [batch, f_dim1, f_dim2, f_dim3]
-        :param suffix:
+        :param _backbone:
+        :param _moving_image: [batch, m_dim1, m_dim2, m_dim3]
+        :param _moving_label: [batch, m_dim1, m_dim2, m_dim3]
+        :param _fixed_image:  [batch, f_dim1, f_dim2, f_dim3]
         :return:
         """
-        # image loss
-        if tf_loss_config["similarity"]["image"]["weight"] > 0:
-            loss_image = tf.reduce_mean(image_loss.similarity_fn(
-                y_true=_fixed_image, y_pred=_pred_fixed_image,
-                **tf_loss_config["similarity"]["image"]))
-            weighted_loss_image = loss_image * tf_loss_config["similarity"]["image"]["weight"]
-            model.add_loss(weighted_loss_image)
-            model.add_metric(loss_image, name="loss/image_similarity" + suffix, aggregation="mean")
-            model.add_metric(weighted_loss_image, name="loss/weighted_image_similarity" + suffix, aggregation="mean")
-
-        # regularization loss
-        loss_reg = tf.reduce_mean(
-            deepreg.model.loss.deform.local_displacement_energy(_ddf, **tf_loss_config["regularization"]))
-        weighted_loss_reg = loss_reg * tf_loss_config["regularization"]["weight"]
-        model.add_loss(weighted_loss_reg)
-        model.add_metric(loss_reg, name="loss/regularization" + suffix, aggregation="mean")
-        model.add_metric(weighted_loss_reg, name="loss/weighted_regularization" + suffix, aggregation="mean")
-
-        # label loss
-        if _fixed_label is not None:
-            label_loss_fn = label_loss.get_similarity_fn(config=tf_loss_config["similarity"]["label"])
-            loss_label = label_loss_fn(y_true=_fixed_label, y_pred=_pred_fixed_label)
-            model.add_loss(loss_label)
-            model.add_metric(loss_label, name="loss/label" + suffix, aggregation="mean")
+        # control points
+        backbone_input = tf.concat([
+            layer.Resize3d(size=fixed_image_size, dtype=tf.float32)(inputs=tf.expand_dims(_moving_image, axis=4)),
+            tf.expand_dims(_fixed_image, axis=4)],
+            axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 2]
+        _control_points = tf.cast(_backbone(inputs=backbone_input), tf.float32)  # [batch, c_dim1, c_dim2, c_dim3, 3]
+        _ddf = layer.CubicBSplineUpSampling(output_shape=fixed_image_size, spacing=spacing, dtype=tf.float32)(
+            inputs=_control_points)  # [batch, f_dim1, f_dim2, f_dim3, 3]
+
+        # prediction image ang label shape = [batch, f_dim1, f_dim2, f_dim3]
+        _pred_fixed_image, _pred_fixed_label = warp_image_and_label(ddf=_ddf,
+                                                                    moving_image=_moving_image,
+                                                                    moving_label=_moving_label,
+                                                                    fixed_image_size=fixed_image_size,
+                                                                    label_interpolation=label_interpolation,
+                                                                    implicit_grid=implicit_grid,
+                                                                    jit_compile=jit_warping)
+
+        return _control_points, _ddf, _pred_fixed_image, _pred_fixed_label
+
+    # nearest interpolation is not differentiable, it should only be used for prediction
+    label_interpolation = tf_model_config.get("label_interpolation", "linear")
+    # reference grids are shared between layers, or not stored at all if implicit
+    implicit_grid = tf_model_config.get("implicit_grid", False)
+    # only the resampling of the warpings is compiled with xla, see set_jit_compile for the whole model
+    jit_warping = tf_model_config.get("xla", "none") == "warping"
+    # number of voxels between two control points
+    spacing = tf_model_config["bspline"]["control_point_spacing"]
 
     # inputs
     moving_image, fixed_image, moving_label, indices = build_inputs(
         moving_image_size, fixed_image_size, index_size, batch_size)
 
     # backbone
-    backbone = build_backbone(image_size=fixed_image_size, out_channels=3,
-                              tf_model_config=tf_model_config)
+    # the decoder stops at 1/spacing of the fixed image resolution, a few voxels less than the control points
+    backbone = build_backbone(image_size=layer_util.get_control_point_size(fixed_image_size, spacing),
+                              out_channels=3, tf_model_config=tf_model_config, stride=spacing)
 
     # forward
-    dvf, ddf, pred_fixed_image, pred_fixed_label = forward(_backbone=backbone,
-                                                           _moving_image=moving_image,
-                                                           _moving_label=moving_label,
-                                                           _fixed_image=fixed_image)
+    control_points, ddf, pred_fixed_image, pred_fixed_label = forward(_backbone=backbone,
+                                                                      _moving_image=moving_image,
+                                                                      _moving_label=moving_label,
+                                                                      _fixed_image=fixed_image)
 
     # build model
     model = tf.keras.Model(inputs=[moving_image, fixed_image, moving_label, indices],
                            outputs=[pred_fixed_label],
                            name="DDFRegModel")
-    model.dvf = dvf
+    model.control_points = control_points
     model.ddf = ddf
+    model.pred_fixed_image = pred_fixed_image
 
     # loss and metric
-    add_loss_metric(_fixed_image=fixed_image,
-                    _pred_fixed_image=pred_fixed_image,
-                    _ddf=ddf,
-                    _fixed_label=None,
-                    _pred_fixed_label=None,
-                    suffix="")
+    add_ddf_loss_metric(model=model, tf_loss_config=tf_loss_config,
+                        fixed_image=fixed_image,
+                        pred_fixed_image=pred_fixed_image,
+                        ddf=ddf,
+                        fixed_label=None,
+                        pred_fixed_label=None,
+                        suffix="")
 
     return model
 
@@ -261,18 +442,19 @@ def build_cond_model(moving_image_size, fixed_image_size, index_size, batch_size
     # inputs
     moving_image, fixed_image, moving_label, indices = build_inputs(
         moving_image_size, fixed_image_size, index_size, batch_size)
-    backbone_input = tf.concat([layer.Resize3d(size=fixed_image_size)(inputs=tf.expand_dims(moving_image, axis=4)),
-                                tf.expand_dims(fixed_image, axis=4),
-                                layer.Resize3d(size=fixed_image_size)(inputs=tf.expand_dims(moving_label, axis=4)),
-                                ],
-                               axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 3]
+    backbone_input = tf.concat([
+        layer.Resize3d(size=fixed_image_size, dtype=tf.float32)(inputs=tf.expand_dims(moving_image, axis=4)),
+        tf.expand_dims(fixed_image, axis=4),
+        layer.Resize3d(size=fixed_image_size, dtype=tf.float32)(inputs=tf.expand_dims(moving_label, axis=4)),
+    ],
+        axis=4)  # [batch, f_dim1, f_dim2, f_dim3, 3]
 
     # backbone
     backbone = build_backbone(image_size=fixed_image_size, out_channels=1,
                               tf_model_config=tf_model_config)
 
     # prediction
-    pred_fixed_label = backbone(inputs=backbone_input)  # [batch, f_dim1, f_dim2, f_dim3, 1]
+    pred_fixed_label = tf.cast(backbone(inputs=backbone_input), tf.float32)  # [batch, f_dim1, f_dim2, f_dim3, 1]
     pred_fixed_label = tf.squeeze(pred_fixed_label, axis=4)
 
     # build model
@@ -303,7 +485,7 @@ def build_seg_model(moving_image_size, fixed_image_size, index_size, batch_size,
                               tf_model_config=tf_model_config)
 
     # prediction
-    pred_fixed_label = backbone(inputs=backbone_input)  # [batch, f_dim1, f_dim2, f_dim3, 1]
+    pred_fixed_label = tf.cast(backbone(inputs=backbone_input), tf.float32)  # [batch, f_dim1, f_dim2, f_dim3, 1]
     pred_fixed_label = tf.squeeze(pred_fixed_label, axis=4)
 
     # build model
@@ -321,6 +503,9 @@ def build_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_
     elif tf_model_config["method"] == "dvf":
         return build_dvf_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_model_config,
                                tf_loss_config)
+    elif tf_model_config["method"] == "bspline":
+        return build_bspline_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_model_config,
+                                   tf_loss_config)
     elif tf_model_config["method"] == "conditional":
         return build_cond_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_model_config,
                                 tf_loss_config)
@@ -329,3 +514,39 @@ def build_model(moving_image_size, fixed_image_size, index_size, batch_size, tf_
                                tf_loss_config)
     else:
         raise ValueError("Unknown model method")
+
+
+def set_jit_compile(model, inputs, labels=None):
+    """
+    compile the train, test and predict steps of the model with XLA, it has to be called after model.compile
+    XLA fuses the many small ops of the models, e.g. the resample gathers and the stencils of the losses,
+    but not all tensorflow ops have an XLA kernel, so the test step, or the predict step if labels are not given,
+    is first run on a sample batch, it does not update the weights,
+    if it fails, the model keeps the default tensorflow graphs
+    on CPU, the conv3d of XLA are much slower than the default kernels, only the warpings benefit from XLA,
+    see the xla option "warping" of the models and benchmark/xla.py
+    :param model: tf.keras.Model
+    :param inputs: a batch of model inputs
+    :param labels: a batch of labels, None if the model is only used for prediction
+    :return: bool, True if the steps are compiled with XLA
+    """
+    model.jit_compile = True
+    try:
+        if labels is None:
+            model.predict_on_batch(x=inputs)
+        else:
+            model.test_on_batch(x=inputs, y=labels)
+            model.reset_metrics()
+    except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+        print("XLA can not compile the model, it falls back to tensorflow graphs: %s" % get_xla_error_message(e))
+        model.jit_compile = False
+    return model.jit_compile
+
+
+def get_xla_error_message(error):
+    """
+    :param error: tf.errors.OpError raised when compiling a function with XLA
+    :return: the line of the message listing the unsupported operations, or the whole message
+    """
+    lines = [line for line in error.message.splitlines() if "unsupported operations" in line] or [error.message]
+    return lines[0]
@@ -13,106 +13,247 @@ import deepreg.model.loss.label as label_loss
 import deepreg.model.metric as metric
 import deepreg.model.network as network
 import deepreg.model.optimizer as opt
+from deepreg.writer import VOLUME_FORMATS, AsyncWriter, MetricTable, save_volume
 
 
-def predict(data_loader, dataset, fixed_grid_ref, model, save_dir):
-    metric_map = dict()  # map[image_index][label_index][metric_name] = metric_value
-    for i, (inputs, labels) in enumerate(dataset):
+class InferenceEngine:
+    def __init__(self, model, jit_compile=False):
+        """
+        the outputs of a model are predicted by a tf.function which is traced once per input signature
+        and reused for all batches, avoiding the setup of model.predict at every call
+        :param model: tf.keras.Model built by network.build_model, with weights loaded
+        :param jit_compile: true if the prediction is compiled with XLA, if the model has ops without XLA kernels,
+                            the engine falls back to tensorflow graphs
+        """
+        # pred_fixed_label [batch, f_dim1, f_dim2, f_dim3]
+        # pred_fixed_image [batch, f_dim1, f_dim2, f_dim3], if the model predicts a ddf
+        # ddf              [batch, f_dim1, f_dim2, f_dim3, 3], if the model predicts a ddf
+        # control_points   [batch, c_dim1, c_dim2, c_dim3, 3], if the model predicts b-spline control points
+        outputs = dict(pred_fixed_label=model.outputs[0])
+        for name in ["pred_fixed_image", "ddf", "control_points"]:
+            if hasattr(model, name):
+                outputs[name] = getattr(model, name)
+        self._model = tf.keras.Model(inputs=model.inputs, outputs=outputs)
+        self._jit_compile = jit_compile
+        self._predict_fn = self._trace()
+        self._signatures = set()
+
+    def _trace(self):
+        return tf.function(lambda inputs: self._model(inputs, training=False), jit_compile=self._jit_compile)
+
+    @property
+    def num_traces(self):
+        """
+        :return: number of times the prediction has been traced, one per input signature
+        """
+        return self._predict_fn.experimental_get_tracing_count()
+
+    def __call__(self, inputs):
+        """
+        :param inputs: (moving_image, fixed_image, moving_label, indices)
+        :return: dict of numpy arrays, with keys pred_fixed_label and, if the model predicts them,
+                 pred_fixed_image, ddf and control_points
+        """
+        signature = tuple((tuple(x.shape), x.dtype.name) for x in inputs)
+        try:
+            outputs = self._predict_fn(inputs)
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+            if not self._jit_compile or signature in self._signatures:
+                raise
+            print("XLA can not compile the model, it falls back to tensorflow graphs: %s"
+                  % network.get_xla_error_message(e))
+            self._jit_compile = False
+            self._predict_fn = self._trace()
+            outputs = self._predict_fn(inputs)
+        self._signatures.add(signature)
+        return {name: value.numpy() for name, value in outputs.items()}
+
+    def stream(self, dataset):
+        """
+        :param dataset: tf.data.Dataset of (inputs, labels)
+        :return: generator of (inputs, labels, outputs), one per batch
+        """
+        for inputs, labels in dataset:
+            yield inputs, labels, self(inputs)
+
+
+def save_sample(image_dir, fixed_image, fixed_label, pred_fixed_label, pred_fixed_image,
+                moving_image, moving_label, ddf, control_points):
+    """
+    save the depth slices of one sample as png, it is run by the writer threads of predict
+    :param image_dir: directory of the sample, created if it does not exist
+    :param fixed_image:      [f_dim1, f_dim2, f_dim3]
+    :param fixed_label:      [f_dim1, f_dim2, f_dim3]
+    :param pred_fixed_label: [f_dim1, f_dim2, f_dim3]
+    :param pred_fixed_image: [f_dim1, f_dim2, f_dim3], or None
+    :param moving_image:     [m_dim1, m_dim2, m_dim3]
+    :param moving_label:     [m_dim1, m_dim2, m_dim3]
+    :param ddf:              [f_dim1, f_dim2, f_dim3, 3], or None
+    :param control_points:   [c_dim1, c_dim2, c_dim3, 3], or None
+    :return:
+    """
+    filename_format = image_dir + "/depth{depth_index:d}_{name:s}.png"
+    os.makedirs(image_dir, exist_ok=True)
+
+    # save fixed
+    for fixed_depth_index in range(fixed_image.shape[2]):
+        fixed_image_d = fixed_image[:, :, fixed_depth_index]
+        fixed_label_d = fixed_label[:, :, fixed_depth_index]
+        fixed_pred_d = pred_fixed_label[:, :, fixed_depth_index]
+        plt.imsave(
+            filename_format.format(depth_index=fixed_depth_index, name="fixed_image"),
+            fixed_image_d, cmap='gray')  # value range for h5 and nifti might be different
+        plt.imsave(
+            filename_format.format(depth_index=fixed_depth_index, name="fixed_label"),
+            fixed_label_d, vmin=0, vmax=1, cmap='gray')
+        plt.imsave(
+            filename_format.format(depth_index=fixed_depth_index, name="fixed_pred"),
+            fixed_pred_d, vmin=0, vmax=1, cmap='gray')
+        if pred_fixed_image is not None:
+            plt.imsave(
+                filename_format.format(depth_index=fixed_depth_index, name="fixed_pred_image"),
+                pred_fixed_image[:, :, fixed_depth_index], cmap='gray')
+
+    # save moving
+    for moving_depth_index in range(moving_image.shape[2]):
+        moving_image_d = moving_image[:, :, moving_depth_index]
+        moving_label_d = moving_label[:, :, moving_depth_index]
+        plt.imsave(
+            filename_format.format(depth_index=moving_depth_index, name="moving_image"),
+            moving_image_d, cmap='gray')  # value range for h5 and nifti might be different
+        plt.imsave(
+            filename_format.format(depth_index=moving_depth_index, name="moving_label"),
+            moving_label_d, vmin=0, vmax=1, cmap='gray')
+
+    # save ddf if exists
+    if ddf is not None:
+        for fixed_depth_index in range(fixed_image.shape[2]):
+            ddf_d = ddf[:, :, fixed_depth_index, :]  # [f_dim1, f_dim2,  3]
+            ddf_max, ddf_min = np.max(ddf_d), np.min(ddf_d)
+            ddf_d = (ddf_d - ddf_min) / (ddf_max - ddf_min)
+            plt.imsave(
+                filename_format.format(depth_index=fixed_depth_index, name="ddf"),
+                ddf_d)
+
+    # save b-spline control points if exist, the dense ddf can be recovered from them
+    if control_points is not None:
+        np.save(image_dir + "/control_points.npy", control_points)
+
+
+def save_sample_volumes(image_dir, volumes, output_format, float16, compress):
+    """
+    save the predictions of one sample as one file per volume, it is run by the writer threads of predict
+    :param image_dir: directory of the sample, created if it does not exist
+    :param volumes: dict of name to volume, volumes which are None are skipped
+    :param output_format: "nifti", "npz" or "chunked", see writer.save_volume
+    :param float16:
+    :param compress:
+    :return:
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    for name, volume in volumes.items():
+        if volume is not None:
+            save_volume(file_prefix=image_dir + "/" + name, volume=volume, output_format=output_format,
+                        float16=float16, compress=compress)
+
+
+def predict(data_loader, dataset, fixed_grid_ref, model, save_dir, jit_compile=False, num_writers=4,
+            output_format="png", float16=False, compress=True, metric_format="csv"):
+    """
+    predict the test set, the files are written by background threads while the next batches are predicted
+    :param data_loader:
+    :param dataset:
+    :param fixed_grid_ref:
+    :param model:
+    :param save_dir:
+    :param jit_compile: true if the prediction is compiled with XLA, see InferenceEngine
+    :param num_writers: number of threads writing the files, 0 to write them in the main thread
+    :param output_format: "png" to save the depth slices of the inputs and predictions as images,
+                          "nifti", "npz" or "chunked" to save each prediction as a single file, see writer.save_volume
+    :param float16: true to save the volumes in 2 bytes per value, not used for png
+    :param compress: true to compress the volumes, not used for png
+    :param metric_format: "csv" or "jsonl", the metrics of each batch are appended to save_dir/metric.csv or .jsonl,
+                          metric.log is written at the end with the samples sorted
+    :return:
+    """
+    if output_format not in ["png"] + VOLUME_FORMATS:
+        raise ValueError("Unknown output format %s" % output_format)
+    engine = InferenceEngine(model=model, jit_compile=jit_compile)
+    # at most two samples per thread wait to be written, the prediction blocks while the queue is full
+    writer = AsyncWriter(num_workers=num_writers, max_queue_size=2 * max(num_writers, 1))
+
+    @tf.function
+    def compute_metrics(y_true, y_pred):
+        # shape = [batch] for all metrics
+        return dict(dice=label_loss.dice_score(y_true=y_true, y_pred=y_pred, binary=True),
+                    dist=label_loss.compute_centroid_distance(y_true=y_true, y_pred=y_pred, grid=fixed_grid_ref))
+
+    os.makedirs(save_dir, exist_ok=True)
+    metric_table = MetricTable(path=save_dir + "/metric." + metric_format,
+                               columns=["image_dir", "label_index", "dice", "dist"], metric_format=metric_format)
+    sample_keys = []  # (image_index, label_index) of the rows of metric_table
+    sample_key_set = set()
+    for i, (inputs, labels, outputs) in enumerate(engine.stream(dataset)):
         # pred_fixed_label [batch, f_dim1, f_dim2, f_dim3]
         # moving_image     [batch, m_dim1, m_dim2, m_dim3]
         # fixed_image      [batch, f_dim1, f_dim2, f_dim3]
         # moving_label     [batch, m_dim1, m_dim2, m_dim3]
         # fixed_label      [batch, f_dim1, f_dim2, f_dim3]
-        if hasattr(model, "ddf"):
-            model_ddf = tf.keras.Model(inputs=model.inputs,
-                                       outputs=model.outputs + [model.ddf])
-            pred_fixed_label, ddf = model_ddf.predict(x=inputs)
-        else:
-            pred_fixed_label = model.predict(x=inputs)
-            ddf = None
-
-        moving_image, fixed_image, moving_label, indices = inputs
-        fixed_label = labels
+        pred_fixed_label = outputs["pred_fixed_label"]
+        pred_fixed_image = outputs.get("pred_fixed_image")
+        ddf = outputs.get("ddf")
+        control_points = outputs.get("control_points")
+
+        # numpy arrays are passed to the writer threads
+        moving_image, fixed_image, moving_label, indices = [x.numpy() for x in inputs]
+        fixed_label = labels.numpy()
         num_samples = moving_image.shape[0]
-        moving_depth = moving_image.shape[3]
-        fixed_depth = fixed_image.shape[3]
 
         image_dir_format = save_dir + "/{image_dir:s}/label{label_index:d}"
+        image_dirs, label_indices = [], []  # columns of the metric table
         for sample_index in range(num_samples):
-            image_index, label_index = data_loader.split_indices(indices[sample_index, :].numpy().astype(int).tolist())
+            image_index, label_index = data_loader.split_indices(indices[sample_index, :].astype(int).tolist())
+            assert (image_index, label_index) not in sample_key_set  # label should not be repeated
+            sample_key_set.add((image_index, label_index))
+            sample_keys.append((image_index, label_index))
+            image_dirs.append(data_loader.image_index_to_dir(image_index))
+            label_indices.append(label_index)
 
-            # save fixed
-            image_dir = image_dir_format.format(image_dir=data_loader.image_index_to_dir(image_index),
-                                                label_index=label_index)
-            filename_format = image_dir + "/depth{depth_index:d}_{name:s}.png"
-            if not os.path.exists(image_dir):
-                os.makedirs(image_dir)
-            for fixed_depth_index in range(fixed_depth):
-                fixed_image_d = fixed_image[sample_index, :, :, fixed_depth_index]
-                fixed_label_d = fixed_label[sample_index, :, :, fixed_depth_index]
-                fixed_pred_d = pred_fixed_label[sample_index, :, :, fixed_depth_index]
-                plt.imsave(
-                    filename_format.format(depth_index=fixed_depth_index, name="fixed_image"),
-                    fixed_image_d, cmap='gray')  # value range for h5 and nifti might be different
-                plt.imsave(
-                    filename_format.format(depth_index=fixed_depth_index, name="fixed_label"),
-                    fixed_label_d, vmin=0, vmax=1, cmap='gray')
-                plt.imsave(
-                    filename_format.format(depth_index=fixed_depth_index, name="fixed_pred"),
-                    fixed_pred_d, vmin=0, vmax=1, cmap='gray')
-
-            # save moving
+            # save images
             image_dir = image_dir_format.format(image_dir=data_loader.image_index_to_dir(image_index),
                                                 label_index=label_index)
-            filename_format = image_dir + "/depth{depth_index:d}_{name:s}.png"
-            if not os.path.exists(image_dir):
-                os.makedirs(image_dir)
-            for moving_depth_index in range(moving_depth):
-                moving_image_d = moving_image[sample_index, :, :, moving_depth_index]
-                moving_label_d = moving_label[sample_index, :, :, moving_depth_index]
-                plt.imsave(
-                    filename_format.format(depth_index=moving_depth_index, name="moving_image"),
-                    moving_image_d, cmap='gray')  # value range for h5 and nifti might be different
-                plt.imsave(
-                    filename_format.format(depth_index=moving_depth_index, name="moving_label"),
-                    moving_label_d, vmin=0, vmax=1, cmap='gray')
-
-            # save ddf if exists
-            if ddf is not None:
-                image_dir = image_dir_format.format(image_dir=data_loader.image_index_to_dir(image_index),
-                                                    label_index=label_index)
-                filename_format = image_dir + "/depth{depth_index:d}_{name:s}.png"
-                if not os.path.exists(image_dir):
-                    os.makedirs(image_dir)
-                for fixed_depth_index in range(fixed_depth):
-                    ddf_d = ddf[sample_index, :, :, fixed_depth_index, :]  # [f_dim1, f_dim2,  3]
-                    ddf_max, ddf_min = np.max(ddf_d), np.min(ddf_d)
-                    ddf_d = (ddf_d - ddf_min) / (ddf_max - ddf_min)
-                    plt.imsave(
-                        filename_format.format(depth_index=fixed_depth_index, name="ddf"),
-                        ddf_d)
-
-            # calculate metric
-            label = fixed_label[sample_index:(sample_index + 1), :, :, :]
-            pred = pred_fixed_label[sample_index:(sample_index + 1), :, :, :]
-            dice = label_loss.dice_score(y_true=label, y_pred=pred, binary=True)
-            dist = label_loss.compute_centroid_distance(y_true=label, y_pred=pred,
-                                                        grid=fixed_grid_ref)
-
-            # save metric
-            if image_index not in metric_map.keys():
-                metric_map[image_index] = dict()
-            assert label_index not in metric_map[image_index].keys()  # label should not be repeated
-            metric_map[image_index][label_index] = dict(dice=dice.numpy()[0], dist=dist.numpy()[0])
+            if output_format == "png":
+                writer.submit(save_sample, image_dir=image_dir,
+                              fixed_image=fixed_image[sample_index],
+                              fixed_label=fixed_label[sample_index],
+                              pred_fixed_label=pred_fixed_label[sample_index],
+                              pred_fixed_image=None if pred_fixed_image is None else pred_fixed_image[sample_index],
+                              moving_image=moving_image[sample_index],
+                              moving_label=moving_label[sample_index],
+                              ddf=None if ddf is None else ddf[sample_index],
+                              control_points=None if control_points is None else control_points[sample_index])
+            else:
+                volumes = {name: None if value is None else value[sample_index]
+                           for name, value in outputs.items()}
+                writer.submit(save_sample_volumes, image_dir=image_dir, volumes=volumes,
+                              output_format=output_format, float16=float16, compress=compress)
+
+        # calculate metric, all samples of the batch at once
+        metrics = {name: value.numpy() for name, value in compute_metrics(labels, pred_fixed_label).items()}
+
+        # save metric
+        metric_table.append(image_dir=image_dirs, label_index=label_indices, **metrics)
+        metric_table.flush()
+
+    # wait for the files to be written and stop the threads
+    writer.shutdown()
 
     # print metric
     line_format = "{image_dir:s}, label {label_index:d}, dice {dice:.4f}, dist {dist:.4f}\n"
+    rows = metric_table.rows()
     with open(save_dir + "/metric.log", "w+") as f:
-        for image_index in sorted(metric_map.keys()):
-            for label_index in sorted(metric_map[image_index].keys()):
-                f.write(line_format.format(image_dir=data_loader.image_index_to_dir(image_index),
-                                           label_index=label_index,
-                                           **metric_map[image_index][label_index]))
+        for row_index in sorted(range(len(rows)), key=lambda j: sample_keys[j]):
+            f.write(line_format.format(**rows[row_index]))
 
 
 @click.command()
@@ -154,7 +295,53 @@ def predict(data_loader, dataset, fixed_grid_ref, model, save_dir):
     show_default=True,
     type=str,
 )
-def main(gpu, gpu_allow_growth, ckpt_path, mode, batch_size, log):
+@click.option(
+    "--label_interpolation",
+    help="Interpolation used to warp the moving label, nearest needs only one gather per voxel",
+    type=click.Choice(["linear", "nearest"], case_sensitive=False),
+    default="linear",
+    show_default=True,
+)
+@click.option(
+    "--xla",
+    help="Compile the warpings or the whole prediction steps with XLA, overrides xla in the tf config",
+    type=click.Choice(["none", "warping", "all"], case_sensitive=False),
+    default=None,
+)
+@click.option(
+    "--num_writers",
+    help="Number of threads writing the predictions while the next batches are predicted, 0 to write them in turn",
+    default=4,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--output_format",
+    help="png saves the depth slices of the inputs and predictions, "
+         "nifti, npz and chunked (hdf5) save each prediction of a sample as a single volume file",
+    type=click.Choice(["png"] + VOLUME_FORMATS, case_sensitive=False),
+    default="png",
+    show_default=True,
+)
+@click.option(
+    "--float16/--float32",
+    help="Precision of the saved volumes, not used for png",
+    default=False,
+    show_default=True)
+@click.option(
+    "--compress/--not_compress",
+    help="Compress the saved volumes, not used for png",
+    default=True,
+    show_default=True)
+@click.option(
+    "--metric_format",
+    help="Format of the metric file, the metrics are appended after each batch, metric.log is written at the end",
+    type=click.Choice(["csv", "jsonl"], case_sensitive=False),
+    default="csv",
+    show_default=True,
+)
+def main(gpu, gpu_allow_growth, ckpt_path, mode, batch_size, log, label_interpolation, xla, num_writers,
+         output_format, float16, compress, metric_format):
     # sanity check
     if not ckpt_path.endswith(".ckpt"):  # should be like log_folder/save/xxx.ckpt
         raise ValueError("checkpoint path should end with .ckpt")
@@ -173,6 +360,8 @@ def main(gpu, gpu_allow_growth, ckpt_path, mode, batch_size, log):
     tf_data_config["batch_size"] = batch_size
     tf_opt_config = config["tf"]["opt"]
     tf_model_config = config["tf"]["model"]
+    tf_model_config["label_interpolation"] = label_interpolation
+    tf_model_config["xla"] = xla or config["tf"].get("xla", "none")
     tf_loss_config = config["tf"]["loss"]
     log_folder_name = log if log != "" else datetime.now().strftime("%Y%m%d-%H%M%S")
     log_dir = config["log_dir"][:-1] if config["log_dir"][-1] == "/" else config["log_dir"]
@@ -186,6 +375,7 @@ def main(gpu, gpu_allow_growth, ckpt_path, mode, batch_size, log):
     optimizer = opt.get_optimizer(tf_opt_config)
 
     # model
+    network.set_precision(config["tf"].get("precision", "float32"))
     model = network.build_model(moving_image_size=data_loader.moving_image_shape,
                                 fixed_image_size=data_loader.fixed_image_shape,
                                 index_size=data_loader.num_indices,
@@ -205,7 +395,8 @@ def main(gpu, gpu_allow_growth, ckpt_path, mode, batch_size, log):
     # predict
     fixed_grid_ref = layer_util.get_reference_grid(grid_size=data_loader.fixed_image_shape)
     predict(data_loader=data_loader, dataset=dataset, fixed_grid_ref=fixed_grid_ref, model=model,
-            save_dir=log_dir + "/test")
+            save_dir=log_dir + "/test", jit_compile=tf_model_config["xla"] == "all", num_writers=num_writers,
+            output_format=output_format, float16=float16, compress=compress, metric_format=metric_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,407 @@
+import collections
+import http.client
+import http.server
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import click
+import numpy as np
+
+import deepreg.config.parser as config_parser
+import deepreg.data.load as load
+import deepreg.model.network as network
+from deepreg.predict import InferenceEngine
+
+NUM_LATENCIES = 1000  # number of recent requests used for the latency metrics
+
+
+class DynamicBatcher:
+    def __init__(self, engine, batch_size, moving_image_size, fixed_image_size, index_size, max_latency_ms=20):
+        """
+        group the registration requests of concurrent clients into batches of the model
+        a batch is run as soon as it has batch_size samples, or max_latency_ms after its first request,
+        it is padded to batch_size so that the engine is traced only once
+        :param engine: InferenceEngine
+        :param batch_size: batch size of the model
+        :param moving_image_size: [m_dim1, m_dim2, m_dim3]
+        :param fixed_image_size: [f_dim1, f_dim2, f_dim3]
+        :param index_size: number of indices of the model inputs, they are zeros
+        :param max_latency_ms: maximum time a request waits for other requests before its batch is run
+        """
+        self._engine = engine
+        self._batch_size = batch_size
+        self._moving_image_size = tuple(moving_image_size)
+        self._fixed_image_size = tuple(fixed_image_size)
+        self._index_size = index_size
+        self._max_latency = max_latency_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=NUM_LATENCIES)  # seconds, from submit to result
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_errors = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, moving_image, fixed_image, moving_label=None):
+        """
+        :param moving_image: [m_dim1, m_dim2, m_dim3]
+        :param fixed_image: [f_dim1, f_dim2, f_dim3]
+        :param moving_label: [m_dim1, m_dim2, m_dim3], or None to warp the moving image only
+        :return: Future of a dict of numpy arrays without batch dimension, see InferenceEngine
+        """
+        if moving_image.shape != self._moving_image_size or fixed_image.shape != self._fixed_image_size:
+            raise ValueError("The moving and fixed images should have shapes %s and %s, got %s and %s"
+                             % (self._moving_image_size, self._fixed_image_size, moving_image.shape, fixed_image.shape))
+        if moving_label is None:
+            moving_label = np.zeros(self._moving_image_size, dtype=np.float32)
+        elif moving_label.shape != self._moving_image_size:
+            raise ValueError("The moving label should have shape %s, got %s"
+                             % (self._moving_image_size, moving_label.shape))
+        # converted here, so that an invalid request is rejected instead of failing its batch
+        arrays = [moving_image, fixed_image, moving_label]
+        for array in arrays:
+            if not (np.issubdtype(array.dtype, np.integer) or np.issubdtype(array.dtype, np.floating)
+                    or array.dtype == bool):
+                raise ValueError("The images and label should be real numbers, got dtype %s" % array.dtype)
+        moving_image, fixed_image, moving_label = [array.astype(np.float32) for array in arrays]
+        future = Future()
+        self._queue.put((time.time(), future, moving_image, fixed_image, moving_label))
+        return future
+
+    def _get_batch(self):
+        """
+        :return: list of requests, empty if the batcher is stopped
+        """
+        batch = []
+        while self._running and len(batch) == 0:
+            try:
+                batch.append(self._queue.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        deadline = time.time() + self._max_latency
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while self._running:
+            batch = self._get_batch()
+            if len(batch) == 0:
+                continue
+            try:
+                # padded with the last request
+                padded = batch + [batch[-1]] * (self._batch_size - len(batch))
+                inputs = tuple(np.stack([request[i] for request in padded]) for i in [2, 3, 4]) + (
+                    np.zeros([self._batch_size, self._index_size], dtype=np.float32),)
+                outputs = self._engine(inputs)
+            except Exception as e:  # returned to the clients of the batch, the next batches are still run
+                for _, future, *_ in batch:
+                    future.set_exception(e)
+                with self._lock:
+                    self._num_errors += len(batch)
+                continue
+            now = time.time()
+            for sample_index, (start, future, *_) in enumerate(batch):
+                future.set_result({name: value[sample_index] for name, value in outputs.items()})
+            with self._lock:
+                self._latencies.extend(now - start for start, *_ in batch)
+                self._num_requests += len(batch)
+                self._num_batches += 1
+
+    def get_metrics(self):
+        """
+        :return: dict of the queue depth, the numbers of requests, batches and errors,
+                 the mean batch size and the latency percentiles in ms of the recent requests
+        """
+        with self._lock:
+            latencies = np.asarray(self._latencies) * 1000
+            metrics = dict(queue_depth=self._queue.qsize(),
+                           num_requests=self._num_requests,
+                           num_batches=self._num_batches,
+                           num_errors=self._num_errors,
+                           mean_batch_size=self._num_requests / max(self._num_batches, 1))
+        for percentile in [50, 95, 99]:
+            metrics["latency_ms_p%d" % percentile] = (float(np.percentile(latencies, percentile))
+                                                      if len(latencies) > 0 else None)
+        return metrics
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+
+def load_arrays(data):
+    """
+    :param data: bytes of a npz file
+    :return: dict of numpy arrays
+    """
+    with np.load(io.BytesIO(data)) as f:
+        return {name: f[name] for name in f.files}
+
+
+def dump_arrays(arrays):
+    """
+    :param arrays: dict of numpy arrays
+    :return: bytes of a npz file
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /register, the body is a npz file with moving_image, fixed_image and optionally moving_label,
+        the response is a npz file with ddf, pred_fixed_label (the warped moving label)
+        and pred_fixed_image (the warped moving image), as float32 arrays without batch dimension
+    GET /metrics, the response is a json of DynamicBatcher.get_metrics
+    the batcher and the result timeout are attributes of the server
+    """
+
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(200, json.dumps(self.server.batcher.get_metrics()).encode(), "application/json")
+        else:
+            self._send(404, b"Unknown path", "text/plain")
+
+    def do_POST(self):
+        if self.path != "/register":
+            self._send(404, b"Unknown path", "text/plain")
+            return
+        if self.headers["Content-Length"] is None:
+            self._send(411, b"Content-Length is required", "text/plain")
+            return
+        try:
+            arrays = load_arrays(self.rfile.read(int(self.headers["Content-Length"])))
+            future = self.server.batcher.submit(moving_image=arrays["moving_image"],
+                                                fixed_image=arrays["fixed_image"],
+                                                moving_label=arrays.get("moving_label"))
+        except (KeyError, ValueError, OSError, zipfile.BadZipFile) as e:  # invalid request
+            self._send(400, str(e).encode(), "text/plain")
+            return
+        try:
+            outputs = future.result(timeout=self.server.result_timeout)
+        except FutureTimeoutError:
+            self._send(504, b"Registration timed out", "text/plain")
+            return
+        except Exception as e:
+            self._send(500, str(e).encode(), "text/plain")
+            return
+        self._send(200, dump_arrays(outputs), "application/octet-stream")
+
+    def log_message(self, format, *args):
+        pass  # requests are reported by the metrics
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # the client address of unix sockets is empty, the request handler expects a (host, port)
+        request, _ = super(ThreadingUnixHTTPServer, self).get_request()
+        return request, ("unix", 0)
+
+
+def build_server(batcher, host="127.0.0.1", port=8000, unix_socket="", result_timeout=60):
+    """
+    :param batcher: DynamicBatcher
+    :param host: host of the http server, not used if unix_socket is given
+    :param port: port of the http server, not used if unix_socket is given
+    :param unix_socket: path of a unix socket to listen on instead of a tcp port
+    :param result_timeout: maximum time in seconds a request waits for its result
+    :return: server, call serve_forever to handle the requests
+    """
+    if unix_socket != "":
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    server.batcher = batcher
+    server.result_timeout = result_timeout
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, unix_socket, **kwargs):
+        super(UnixHTTPConnection, self).__init__("localhost", **kwargs)
+        self._unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._unix_socket)
+
+
+def register(moving_image, fixed_image, moving_label=None, host="127.0.0.1", port=8000, unix_socket=""):
+    """
+    client of the server
+    :param moving_image: [m_dim1, m_dim2, m_dim3]
+    :param fixed_image: [f_dim1, f_dim2, f_dim3]
+    :param moving_label: [m_dim1, m_dim2, m_dim3], or None
+    :param host:
+    :param port:
+    :param unix_socket: path of the unix socket of the server, if given host and port are not used
+    :return: dict of numpy arrays with ddf, pred_fixed_label and pred_fixed_image
+    """
+    arrays = dict(moving_image=moving_image, fixed_image=fixed_image)
+    if moving_label is not None:
+        arrays["moving_label"] = moving_label
+    connection = UnixHTTPConnection(unix_socket) if unix_socket != "" else http.client.HTTPConnection(host, port)
+    try:
+        connection.request("POST", "/register", body=dump_arrays(arrays))
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError("Registration failed with status %d: %s" % (response.status, body.decode()))
+    return load_arrays(body)
+
+
+@click.command()
+@click.option(
+    "--gpu", "-g",
+    help="GPU index",
+    type=str,
+    required=True,
+)
+@click.option(
+    "--gpu_allow_growth/--not_gpu_allow_growth",
+    help="Do not take all GPU memory",
+    default=False,
+    show_default=True)
+@click.option(
+    "--ckpt_path",
+    help="Path of checkpoint to load",
+    default="",
+    show_default=True,
+    type=str,
+    required=True,
+)
+@click.option(
+    "--batch_size", "-b",
+    help="Maximum number of requests registered together",
+    default=4,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--max_latency_ms",
+    help="Maximum time in ms a request waits for other requests to fill a batch",
+    default=20,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--result_timeout",
+    help="Maximum time in seconds a request waits for its result",
+    default=60,
+    show_default=True,
+    type=float,
+)
+@click.option(
+    "--host",
+    help="Host of the http server",
+    default="127.0.0.1",
+    show_default=True,
+    type=str,
+)
+@click.option(
+    "--port",
+    help="Port of the http server",
+    default=8000,
+    show_default=True,
+    type=int,
+)
+@click.option(
+    "--unix_socket",
+    help="Path of a unix socket to listen on instead of host and port",
+    default="",
+    type=str,
+)
+@click.option(
+    "--label_interpolation",
+    help="Interpolation used to warp the moving label, nearest needs only one gather per voxel",
+    type=click.Choice(["linear", "nearest"], case_sensitive=False),
+    default="linear",
+    show_default=True,
+)
+@click.option(
+    "--xla",
+    help="Compile the warpings or the whole prediction with XLA, overrides xla in the tf config",
+    type=click.Choice(["none", "warping", "all"], case_sensitive=False),
+    default=None,
+)
+def main(gpu, gpu_allow_growth, ckpt_path, batch_size, max_latency_ms, result_timeout, host, port, unix_socket,
+         label_interpolation, xla):
+    # sanity check
+    if not ckpt_path.endswith(".ckpt"):  # should be like log_folder/save/xxx.ckpt
+        raise ValueError("checkpoint path should end with .ckpt")
+
+    # env vars
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+    os.environ["TF_FORCE_GPU_ALLOW_GROWTH"] = "false" if gpu_allow_growth else "true"
+
+    # load config
+    config = config_parser.load("/".join(ckpt_path.split("/")[:-2]) + "/config.yaml")
+    tf_model_config = config["tf"]["model"]
+    tf_model_config["label_interpolation"] = label_interpolation
+    tf_model_config["xla"] = xla or config["tf"].get("xla", "none")
+
+    # the image shapes are those of the test data of the config
+    data_loader = load.get_data_loader(config["data"], "test")
+
+    # model
+    network.set_precision(config["tf"].get("precision", "float32"))
+    model = network.build_model(moving_image_size=data_loader.moving_image_shape,
+                                fixed_image_size=data_loader.fixed_image_shape,
+                                index_size=data_loader.num_indices,
+                                batch_size=batch_size,
+                                tf_model_config=tf_model_config,
+                                tf_loss_config=config["tf"]["loss"])
+    model.load_weights(ckpt_path).expect_partial()  # the optimizer is not restored
+
+    # serve, the engine is traced before the first request
+    engine = InferenceEngine(model=model, jit_compile=tf_model_config["xla"] == "all")
+    engine(tuple(np.zeros([batch_size, *shape], dtype=np.float32) for shape in [
+        data_loader.moving_image_shape, data_loader.fixed_image_shape, data_loader.moving_image_shape,
+        [data_loader.num_indices]]))
+    batcher = DynamicBatcher(engine=engine, batch_size=batch_size,
+                             moving_image_size=data_loader.moving_image_shape,
+                             fixed_image_size=data_loader.fixed_image_shape,
+                             index_size=data_loader.num_indices,
+                             max_latency_ms=max_latency_ms)
+    server = build_server(batcher=batcher, host=host, port=port, unix_socket=unix_socket,
+                          result_timeout=result_timeout)
+    print("Serving on %s" % (unix_socket if unix_socket != "" else "http://%s:%d" % (host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == "__main__":
+    main()
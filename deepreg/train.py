@@ -12,6 +12,106 @@ import deepreg.model.network as network
 import deepreg.model.optimizer as opt
 
 
+def fit_with_accumulation(model, dataset_train, dataset_val, steps_per_epoch, validation_steps, epochs,
+                          accumulation_steps, callbacks, verbose=1):
+    """
+    custom training loop with the same losses, metrics and callbacks as model.fit,
+    the gradients of accumulation_steps consecutive batches are averaged before each update of the weights,
+    the effective batch size is accumulation_steps * batch_size, but only one batch is in memory at a time
+    :param model: compiled tf.keras.Model
+    :param dataset_train: repeated dataset of training batches
+    :param dataset_val: repeated dataset of validation batches, None to skip the validation
+    :param steps_per_epoch: number of training batches per epoch, at least accumulation_steps,
+                            an epoch runs steps_per_epoch // accumulation_steps updates, so the last
+                            steps_per_epoch % accumulation_steps batches are not used by the epoch,
+                            the next epoch continues from the following batch of dataset_train
+    :param validation_steps: number of validation batches per epoch
+    :param epochs: number of epochs
+    :param accumulation_steps: positive int, number of batches per update
+    :param callbacks: list of tf.keras.callbacks.Callback
+    :param verbose: 0 or 1, same as model.fit
+    :return: tf.keras.callbacks.History
+    """
+    if not isinstance(accumulation_steps, int) or accumulation_steps < 1:
+        raise ValueError("accumulation_steps should be a positive integer")
+    strategy = model.distribute_strategy
+    optimizer = model.optimizer
+    loss_scale = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+    variables = model.trainable_variables
+    if steps_per_epoch < accumulation_steps:
+        raise ValueError("steps_per_epoch %d should be at least accumulation_steps %d"
+                         % (steps_per_epoch, accumulation_steps))
+    num_updates = steps_per_epoch // accumulation_steps
+    if steps_per_epoch % accumulation_steps > 0:
+        print("%d of the %d training batches per epoch are not used, as steps_per_epoch is not a multiple of "
+              "accumulation_steps %d" % (steps_per_epoch % accumulation_steps, steps_per_epoch, accumulation_steps))
+
+    def compute_gradients(inputs, labels):
+        with tf.GradientTape() as tape:
+            pred = model(inputs, training=True)
+            loss = model.compute_loss(x=inputs, y=labels, y_pred=pred)
+            if loss_scale:
+                loss = optimizer.get_scaled_loss(loss)
+        grads = tape.gradient(loss, variables)
+        if loss_scale:
+            grads = optimizer.get_unscaled_gradients(grads)
+        model.compute_metrics(x=inputs, y=labels, y_pred=pred, sample_weight=None)
+        return [tf.zeros_like(v) if g is None else g for g, v in zip(grads, variables)]
+
+    # the gradients are summed per replica, the replicas are only synchronised by the update
+    with strategy.scope():
+        accumulators = [tf.Variable(tf.zeros_like(v), trainable=False,
+                                    synchronization=tf.VariableSynchronization.ON_READ,
+                                    aggregation=tf.VariableAggregation.SUM) for v in variables]
+
+    def accumulate(inputs, labels):
+        for accumulator, grad in zip(accumulators, compute_gradients(inputs, labels)):
+            accumulator.assign_add(grad)
+
+    def apply():
+        optimizer.apply_gradients(zip([accumulator / accumulation_steps for accumulator in accumulators], variables))
+        for accumulator in accumulators:
+            accumulator.assign(tf.zeros_like(accumulator))
+
+    replica_accumulate = tf.function(accumulate, jit_compile=True) if model.jit_compile else accumulate
+
+    # the batches are accumulated by a python loop, a tf.range loop around the model was measured twice slower on CPU
+    @tf.function
+    def accumulate_step(iterator):
+        strategy.run(replica_accumulate, args=next(iterator))
+
+    @tf.function
+    def apply_step():
+        strategy.run(apply)
+        return {metric.name: metric.result() for metric in model.metrics}
+
+    iterator = iter(strategy.experimental_distribute_dataset(dataset_train))
+    callbacks = tf.keras.callbacks.CallbackList(callbacks, add_history=True, add_progbar=verbose != 0, model=model,
+                                                verbose=verbose, epochs=epochs, steps=num_updates)
+    model.stop_training = False
+    logs = dict()
+    callbacks.on_train_begin()
+    for epoch in range(epochs):
+        model.reset_metrics()
+        callbacks.on_epoch_begin(epoch)
+        for step in range(num_updates):
+            callbacks.on_train_batch_begin(step)
+            for _ in range(accumulation_steps):
+                accumulate_step(iterator)
+            logs = apply_step()
+            callbacks.on_train_batch_end(step, logs)
+        logs = {name: float(value) for name, value in logs.items()}
+        # evaluate resets the metrics, so the training logs are read before
+        if dataset_val is not None:
+            val_logs = model.evaluate(x=dataset_val, steps=validation_steps, verbose=0, return_dict=True)
+            logs.update({"val_" + name: value for name, value in val_logs.items()})
+        callbacks.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
+    callbacks.on_train_end(logs)
+    return model.history
+
+
 @click.command()
 @click.option(
     "--gpu", "-g",
@@ -44,7 +144,13 @@ import deepreg.model.optimizer as opt
     show_default=True,
     type=str,
 )
-def main(gpu, config_path, gpu_allow_growth, ckpt_path, log):
+@click.option(
+    "--xla",
+    help="Compile the warpings or the whole training steps with XLA, overrides xla in the tf config",
+    type=click.Choice(["none", "warping", "all"], case_sensitive=False),
+    default=None,
+)
+def main(gpu, config_path, gpu_allow_growth, ckpt_path, log, xla):
     # env vars
     os.environ["CUDA_VISIBLE_DEVICES"] = gpu
     os.environ["TF_FORCE_GPU_ALLOW_GROWTH"] = "true" if gpu_allow_growth else "false"
@@ -59,6 +165,10 @@ def main(gpu, config_path, gpu_allow_growth, ckpt_path, log):
     num_epochs = config["tf"]["epochs"]
     save_period = config["tf"]["save_period"]
     histogram_freq = config["tf"]["histogram_freq"]
+    precision = config["tf"].get("precision", "float32")
+    xla = xla or config["tf"].get("xla", "none")
+    accumulation_steps = config["tf"].get("accumulation_steps", 1)
+    tf_model_config["xla"] = xla
     log_dir = config["log_dir"][:-1] if config["log_dir"][-1] == "/" else config["log_dir"]
 
     # output
@@ -85,6 +195,8 @@ def main(gpu, config_path, gpu_allow_growth, ckpt_path, log):
 
     # optimizer
     optimizer = opt.get_optimizer(tf_opt_config)
+    if precision == "mixed_float16":  # small float16 gradients underflow without loss scaling
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
     # callbacks
     tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=histogram_freq)
@@ -92,6 +204,9 @@ def main(gpu, config_path, gpu_allow_growth, ckpt_path, log):
         filepath=log_dir + "/save/weights-epoch{epoch:d}.ckpt", save_weights_only=True,
         period=save_period)
 
+    # precision policy of the backbone
+    network.set_precision(precision)
+
     strategy = tf.distribute.MirroredStrategy()
     with strategy.scope():
         # model
@@ -112,6 +227,11 @@ def main(gpu, config_path, gpu_allow_growth, ckpt_path, log):
                                ])
         print(model.summary())
 
+        # xla, the ops are checked on a sample batch, the model falls back to tensorflow graphs if they fail
+        if xla == "all":
+            inputs, labels = next(iter(dataset_train))
+            network.set_jit_compile(model=model, inputs=inputs, labels=labels)
+
         # load weights
         if checkpoint_init_path != "":
             model.load_weights(checkpoint_init_path)
@@ -119,14 +239,26 @@ def main(gpu, config_path, gpu_allow_growth, ckpt_path, log):
         # train
         # it's necessary to define the steps_per_epoch and validation_steps to prevent errors like
         # BaseCollectiveExecutor::StartAbort Out of range: End of sequence
-        model.fit(
-            x=dataset_train,
-            steps_per_epoch=dataset_size_train // tf_data_config["batch_size"],
-            epochs=num_epochs,
-            validation_data=dataset_val,
-            validation_steps=dataset_size_val // tf_data_config["batch_size"],
-            callbacks=[tensorboard_callback, checkpoint_callback],
-        )
+        if accumulation_steps > 1:
+            fit_with_accumulation(
+                model=model,
+                dataset_train=dataset_train,
+                dataset_val=dataset_val,
+                steps_per_epoch=dataset_size_train // tf_data_config["batch_size"],
+                validation_steps=dataset_size_val // tf_data_config["batch_size"],
+                epochs=num_epochs,
+                accumulation_steps=accumulation_steps,
+                callbacks=[tensorboard_callback, checkpoint_callback],
+            )
+        else:
+            model.fit(
+                x=dataset_train,
+                steps_per_epoch=dataset_size_train // tf_data_config["batch_size"],
+                epochs=num_epochs,
+                validation_data=dataset_val,
+                validation_steps=dataset_size_val // tf_data_config["batch_size"],
+                callbacks=[tensorboard_callback, checkpoint_callback],
+            )
 
 
 if __name__ == "__main__":
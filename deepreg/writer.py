@@ -0,0 +1,185 @@
+import csv
+import json
+import queue
+import threading
+
+import h5py
+import nibabel as nib
+import numpy as np
+
+
+class AsyncWriter:
+    def __init__(self, num_workers=4, max_queue_size=8):
+        """
+        run the write tasks of predict in background threads, so that inference does not wait on the disk
+        the tasks wait in a bounded queue, submit blocks when it is full, so that at most
+        max_queue_size tasks and their arrays are held in memory
+        the png compression and the file writes release the GIL, so threads are enough
+        :param num_workers: number of threads, if 0 the tasks are run in the calling thread by submit
+        :param max_queue_size: maximum number of tasks waiting in the queue
+        """
+        if not (isinstance(num_workers, int) and num_workers >= 0):
+            raise ValueError("num_workers should be a non-negative integer, got %s" % num_workers)
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._errors = []
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:  # shutdown
+                    return
+                fn, args, kwargs = task
+                fn(*args, **kwargs)
+            except Exception as e:  # raised in the main thread by submit or flush
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        queue fn(*args, **kwargs), it blocks while the queue is full
+        the arguments should not be modified after submission, e.g. pass numpy arrays, not buffers reused later
+        :param fn: function writing files
+        """
+        self._raise_error()
+        if len(self._threads) == 0:
+            fn(*args, **kwargs)
+        else:
+            self._queue.put((fn, args, kwargs))
+
+    def flush(self):
+        """
+        wait until all submitted tasks are done, and raise the first error of the tasks if any
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def shutdown(self):
+        """
+        flush and stop the threads, the writer can not be used afterwards
+        """
+        try:
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+VOLUME_FORMATS = ["nifti", "npz", "chunked"]
+
+
+def save_volume(file_prefix, volume, output_format, float16=False, compress=True):
+    """
+    save one volume as a single file
+    :param file_prefix: path of the file without extension
+    :param volume: [dim1, dim2, dim3] or [dim1, dim2, dim3, channels], e.g. a predicted label or a ddf
+    :param output_format: "nifti", "npz" or "chunked"
+        - nifti, file_prefix.nii(.gz), with an identity affine, it can be read by nibabel
+        - npz, file_prefix.npz, with the array under the key "volume", it can be read by numpy
+        - chunked, file_prefix.h5, with the dataset "volume" stored in chunks of up to 32^3 voxels,
+          a region is read without decompressing the whole volume, it can be read by h5py
+    :param float16: true to store the values in 2 bytes, as NIfTI has no float16,
+                    the nifti volumes are stored as int16 with a scaling slope and intercept
+    :param compress: true to compress the file, with gzip for nifti and chunked, with zip for npz
+    :return: path of the file
+    """
+    dtype = np.float16 if float16 else np.float32
+    if output_format == "nifti":
+        path = file_prefix + (".nii.gz" if compress else ".nii")
+        image = nib.Nifti1Image(np.asarray(volume, dtype=np.float32), affine=np.eye(4))
+        if float16:
+            image.set_data_dtype(np.int16)  # scaled by nibabel
+        nib.save(image, path)
+    elif output_format == "npz":
+        path = file_prefix + ".npz"
+        save_fn = np.savez_compressed if compress else np.savez
+        save_fn(path, volume=np.asarray(volume, dtype=dtype))
+    elif output_format == "chunked":
+        path = file_prefix + ".h5"
+        chunks = tuple(min(dim, 32) for dim in volume.shape[:3]) + tuple(volume.shape[3:])
+        with h5py.File(path, "w") as f:
+            f.create_dataset("volume", data=np.asarray(volume, dtype=dtype), chunks=chunks,
+                             compression="gzip" if compress else None, shuffle=compress)
+    else:
+        raise ValueError("Unknown output format %s, it should be one of %s" % (output_format, VOLUME_FORMATS))
+    return path
+
+
+class MetricTable:
+    def __init__(self, path, columns, metric_format="csv"):
+        """
+        columnar table of metrics, one row per sample, the rows are appended by batch
+        and flushed incrementally to a csv or json lines file, so that the results are kept if predict stops
+        :param path: path of the file, it is overwritten
+        :param columns: list of column names
+        :param metric_format: "csv" or "jsonl"
+        """
+        if metric_format not in ["csv", "jsonl"]:
+            raise ValueError("Unknown metric format %s, it should be csv or jsonl" % metric_format)
+        self._path = path
+        self._metric_format = metric_format
+        self._columns = {name: [] for name in columns}
+        self._num_flushed = 0  # number of rows already written
+        with open(path, "w") as f:
+            if metric_format == "csv":
+                csv.writer(f).writerow(columns)
+
+    def __len__(self):
+        return len(next(iter(self._columns.values())))
+
+    def append(self, **columns):
+        """
+        append a batch of rows
+        :param columns: column name to list or 1d array of values, all columns have the same length
+        """
+        if sorted(columns.keys()) != sorted(self._columns.keys()):
+            raise ValueError("The columns should be %s, got %s" % (list(self._columns.keys()), list(columns.keys())))
+        if len(set(len(values) for values in columns.values())) != 1:
+            raise ValueError("All columns should have the same length")
+        for name, values in columns.items():
+            # numpy scalars are converted to python types for json
+            self._columns[name].extend(value.item() if isinstance(value, np.generic) else value for value in values)
+
+    def column(self, name):
+        """
+        :param name: column name
+        :return: list of the values of the column
+        """
+        return self._columns[name]
+
+    def rows(self, start=0):
+        """
+        :param start: index of the first row
+        :return: list of dict, one per row
+        """
+        names = list(self._columns.keys())
+        return [dict(zip(names, values)) for values in zip(*[self._columns[name][start:] for name in names])]
+
+    def flush(self):
+        """
+        append the rows which are not written yet to the file
+        """
+        rows = self.rows(start=self._num_flushed)
+        with open(self._path, "a") as f:
+            if self._metric_format == "csv":
+                csv.DictWriter(f, fieldnames=list(self._columns.keys())).writerows(rows)
+            else:
+                f.writelines(json.dumps(row) + "\n" for row in rows)
+        self._num_flushed += len(rows)
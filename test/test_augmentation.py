@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+
+from deepreg.data.loader import preprocess
+
+
+class Test(TestCase):
+    def test_preprocess_label_interpolation(self):
+        moving_image_shape, fixed_image_shape = [8, 10, 6], [6, 8, 10]
+        num_samples, batch_size = 4, 2
+        rng = np.random.RandomState(0)
+        moving_label = (rng.rand(num_samples, *moving_image_shape) > 0.5).astype(np.float32)
+        fixed_label = (rng.rand(num_samples, *fixed_image_shape) > 0.5).astype(np.float32)
+        dataset = tf.data.Dataset.from_tensor_slices((
+            (rng.rand(num_samples, *moving_image_shape).astype(np.float32),
+             rng.rand(num_samples, *fixed_image_shape).astype(np.float32),
+             moving_label,
+             np.zeros([num_samples, 2], dtype=np.float32)),
+            fixed_label))
+
+        for label_interpolation in ["linear", "nearest"]:
+            augmented = preprocess(dataset=dataset,
+                                   moving_image_shape=moving_image_shape, fixed_image_shape=fixed_image_shape,
+                                   training=True, shuffle_buffer_num_batch=0, repeat=False, batch_size=batch_size,
+                                   label_interpolation=label_interpolation)
+            labels = []
+            for (_, _, moving_label_aug, _), fixed_label_aug in augmented:
+                self.assertEqual(moving_label_aug.shape, [batch_size] + moving_image_shape)
+                self.assertEqual(fixed_label_aug.shape, [batch_size] + fixed_image_shape)
+                labels += [moving_label_aug.numpy().ravel(), fixed_label_aug.numpy().ravel()]
+            labels = np.concatenate(labels)
+            is_binary = np.all(np.isin(labels, [0, 1]))
+            # nearest keeps the labels binary, linear blends the neighbouring voxels
+            self.assertEqual(is_binary, label_interpolation == "nearest")
@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+import tensorflow as tf
+
+import deepreg.model.layer as layer
+import deepreg.model.layer_util as layer_util
+
+
+class Test(TestCase):
+    @staticmethod
+    def check_equal(x, y, tol=1e-5):
+        """
+        given two tf tensors return True/False (not tf tensor)
+        tolerate small errors
+        :param x:
+        :param y:
+        :param tol:
+        :return:
+        """
+        return tf.reduce_max(tf.abs(x - y)).numpy() < tol
+
+    def test_cubic_bspline_upsampling(self):
+        spacing = 3
+        image_size = [7, 8, 9]
+        control_point_size = layer_util.get_control_point_size(image_size, spacing)
+        self.assertEqual(control_point_size, [6, 6, 6])
+        upsampling = layer.CubicBSplineUpSampling(output_shape=image_size, spacing=spacing)
+
+        # partition of unity
+        get = upsampling(tf.ones([2, *control_point_size, 3]))
+        self.assertEqual(get.shape, (2, *image_size, 3))
+        self.assertTrue(self.check_equal(tf.ones_like(get), get))
+
+        # linear fields are reproduced, control point j is at voxel (j - 1) * spacing
+        control_points = tf.cast(layer_util.get_reference_grid(control_point_size) - 1, tf.float32) * spacing
+        get = upsampling(tf.expand_dims(control_points, axis=0))
+        want = tf.expand_dims(layer_util.get_reference_grid(image_size), axis=0)
+        self.assertTrue(self.check_equal(want, get))
+
+    def test_depthwise_conv3d(self):
+        # same as a grouped conv with one group per channel
+        channels = 3
+        for padding in ["same", "valid"]:
+            for strides in [1, 2]:
+                x = tf.random.uniform([2, 7, 8, 9, channels])
+                depthwise = layer.DepthwiseConv3d(kernel_size=3, strides=strides, padding=padding)
+                get = depthwise(x)
+                grouped = tf.keras.layers.Conv3D(filters=channels, kernel_size=3, strides=strides, padding=padding,
+                                                 groups=channels, use_bias=False)
+                grouped.build(x.shape)
+                grouped.set_weights([tf.transpose(depthwise.get_weights()[0], [0, 1, 2, 4, 3])])
+                want = grouped(x)
+                self.assertEqual(want.shape, get.shape)
+                self.assertTrue(self.check_equal(want, get))
+
+    def test_get_conv3d(self):
+        x = tf.random.uniform([2, 8, 8, 8, 3])
+        for conv_type in ["dense", "separable", "pointwise_bottleneck"]:
+            conv3d = layer.get_conv3d(conv_type=conv_type, filters=8, strides=2)
+            self.assertEqual(conv3d(x).shape, (2, 4, 4, 4, 8))
+        with self.assertRaises(ValueError):
+            layer.get_conv3d(conv_type="grouped", filters=8)
+
+    def test_int_dvf_recompute(self):
+        # recomputing the steps during backprop does not change the outputs and the gradients
+        image_size = [6, 7, 8]
+        dvf = tf.random.uniform([2, *image_size, 3], minval=-2, maxval=2, seed=0)
+        results = []
+        for recompute in [False, True]:
+            int_dvf = layer.IntDVF(fixed_image_size=image_size, recompute=recompute)
+            with tf.GradientTape() as tape:
+                tape.watch(dvf)
+                ddf = int_dvf(dvf)
+                loss = tf.reduce_sum(ddf ** 2)
+            results.append((ddf, tape.gradient(loss, dvf)))
+        (want_ddf, want_grad), (get_ddf, get_grad) = results
+        self.assertTrue(self.check_equal(want_ddf, get_ddf))
+        self.assertTrue(self.check_equal(want_grad, get_grad))
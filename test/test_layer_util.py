@@ -30,6 +30,16 @@ class Test(TestCase):
         get = layer_util.get_reference_grid(grid_size=[1, 2, 3])
         self.check_equal(want, get)
 
+        # grids are cached
+        self.assertIs(get, layer_util.get_reference_grid(grid_size=(1, 2, 3)))
+        self.assertEqual(layer_util.get_reference_grid(grid_size=[1, 2, 3], dtype=tf.float16).dtype, tf.float16)
+
+    def test_add_implicit_grid(self):
+        ddf = tf.random.uniform([2, 3, 4, 5, 3])
+        want = layer_util.get_reference_grid(grid_size=[3, 4, 5]) + ddf
+        get = layer_util.add_implicit_grid(ddf)
+        self.assertTrue(self.check_equal(want, get))
+
     def test_resample(self):
         # linear, vol has no feature channel
         interpolation = "linear"
@@ -98,3 +108,105 @@ class Test(TestCase):
             dtype=np.float32))  # shape = [1,3,3,2]
         get = layer_util.resample(vol=vol, loc=loc, interpolation=interpolation)
         self.check_equal(want, get)
+
+    def test_random_transform_generator(self):
+        batch_size = 3
+        scale = 0.1
+        seed = tf.constant([1, 2], dtype=tf.int64)
+        theta = layer_util.random_transform_generator(batch_size=batch_size, scale=scale, seed=seed)
+        self.assertEqual(theta.shape, (batch_size, 4, 3))
+
+        # same seed gives same transforms
+        self.assertTrue(self.check_equal(
+            theta, layer_util.random_transform_generator(batch_size=batch_size, scale=scale, seed=seed)))
+
+        # corners are scaled by a factor between (1-scale, 1)
+        old = tf.constant([[-1, -1, -1, 1],
+                           [-1, -1, 1, 1],
+                           [-1, 1, -1, 1],
+                           [1, -1, -1, 1]], dtype=tf.float32)
+        ratio = tf.einsum("ij,bjk->bik", old, theta) / old[None, :, :3]  # [batch, 4, 3]
+        self.assertTrue(tf.reduce_all(ratio >= 1 - scale - 1e-6).numpy())
+        self.assertTrue(tf.reduce_all(ratio <= 1 + 1e-6).numpy())
+
+        # a new transform is sampled at each call inside tf.function
+        fn = tf.function(lambda: layer_util.random_transform_generator(batch_size=batch_size, scale=scale))
+        self.assertFalse(self.check_equal(fn(), fn()))
+
+    def test_resample_gather(self):
+        # gather implementation should be consistent with the pyramid one, including gradients
+        for vol_shape, n in [([2, 4, 5], 2), ([2, 4, 5, 3], 2), ([2, 3, 4, 5], 3), ([2, 3, 4, 5, 2], 3)]:
+            vol = tf.random.uniform(vol_shape)
+            loc = tf.random.uniform([2, 3, 4, n], minval=-1.5, maxval=5.5)
+            loc = tf.concat([tf.round(loc[..., :1]), loc[..., 1:]], axis=-1)  # integer coordinates
+            results = []
+            for impl in ["pyramid", "gather"]:
+                with tf.GradientTape() as tape:
+                    tape.watch([vol, loc])
+                    sampled = layer_util.resample(vol=vol, loc=loc, impl=impl)
+                    loss = tf.reduce_sum(sampled * tf.random.stateless_uniform(sampled.shape, seed=[1, 2]))
+                results.append([sampled] + tape.gradient(loss, [vol, loc]))
+            for want, get in zip(*results):
+                self.assertTrue(self.check_equal(want, get))
+
+    def test_resample_nearest(self):
+        interpolation = "nearest"
+        vol = tf.constant(np.array(
+            [[[0, 1, 2],
+              [3, 4, 5],
+              ]],
+            dtype=np.float32))  # shape = [1,2,3]
+        loc = tf.constant(np.array(
+            [[[[0, 0],
+               [0, 1],
+               [0, 3]],  # outside frame
+              [[0.4, 0],
+               [0.6, 1],
+               [0.6, 2]],
+              [[-1, 0.7],
+               [0.4, 1.4],
+               [0.6, 1.6]],
+              ]],
+            dtype=np.float32))  # shape = [1,3,3,2]
+        want = tf.constant(np.array(
+            [[[0, 1, 2],
+              [0, 4, 5],
+              [1, 1, 5],
+              ]],
+            dtype=np.float32))  # shape = [1,3,3]
+        get = layer_util.resample(vol=vol, loc=loc, interpolation=interpolation)
+        self.assertTrue(self.check_equal(want, get))
+
+        # vol has feature channel
+        get = layer_util.resample(vol=tf.stack([vol, vol], axis=3), loc=loc, interpolation=interpolation)
+        self.assertTrue(self.check_equal(tf.stack([want, want], axis=3), get))
+
+    def test_resample_dynamic_batch(self):
+        # the batch size is unknown when tracing, e.g. in keras predict
+        for vol_shape, n in [([2, 3, 4, 5], 3), ([2, 3, 4, 5, 2], 3)]:
+            vol = tf.random.uniform(vol_shape)
+            loc = tf.random.uniform([2, 3, 4, 5, n], minval=-1.5, maxval=5.5)
+            for interpolation, impl in [("linear", "pyramid"), ("linear", "gather"), ("nearest", "pyramid")]:
+                resample = tf.function(
+                    lambda _vol, _loc: layer_util.resample(vol=_vol, loc=_loc, interpolation=interpolation, impl=impl),
+                    input_signature=[tf.TensorSpec([None] + vol_shape[1:]), tf.TensorSpec([None, 3, 4, 5, n])])
+                want = layer_util.resample(vol=vol, loc=loc, interpolation=interpolation, impl=impl)
+                get = resample(vol, loc)
+                self.assertTrue(self.check_equal(want, get))
+
+    def test_resize3d(self):
+        def resize3d_2d(image, size):
+            # reference, resize dim2 and dim3 then dim1 with tf.image.resize
+            shape = image.shape
+            output = tf.image.resize(tf.reshape(image, [-1, shape[2], shape[3], shape[4]]), size=size[1:])
+            output = tf.reshape(output, [-1, shape[1], size[1], size[2] * shape[4]])
+            output = tf.image.resize(output, size=size[:2])
+            return tf.reshape(output, [-1, *size, shape[4]])
+
+        image = tf.random.uniform([2, 4, 5, 6, 3])
+        # identity, only dim1, only dim2 and dim3, all dims
+        for size in [[4, 5, 6], [8, 5, 6], [4, 3, 9], [2, 10, 4]]:
+            want = resize3d_2d(image, size)
+            get = layer_util.resize3d(image, size)
+            self.assertEqual(get.shape, want.shape)
+            self.assertTrue(self.check_equal(want, get))
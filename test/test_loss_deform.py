@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import tensorflow as tf
+
+import deepreg.model.loss.deform as deform_loss
+
+
+class Test(TestCase):
+    def test_bending_energy(self):
+        def gradient_dx(fv):
+            return (fv[:, 2:, 1:-1, 1:-1] - fv[:, :-2, 1:-1, 1:-1]) / 2
+
+        def gradient_dy(fv):
+            return (fv[:, 1:-1, 2:, 1:-1] - fv[:, 1:-1, :-2, 1:-1]) / 2
+
+        def gradient_dz(fv):
+            return (fv[:, 1:-1, 1:-1, 2:] - fv[:, 1:-1, 1:-1, :-2]) / 2
+
+        # reference with sliced finite differences
+        ddf = tf.random.normal([2, 10, 11, 12, 3])
+        dTdx, dTdy, dTdz = gradient_dx(ddf), gradient_dy(ddf), gradient_dz(ddf)
+        want = tf.reduce_mean(gradient_dx(dTdx) ** 2 + gradient_dy(dTdy) ** 2 + gradient_dz(dTdz) ** 2
+                              + 2 * gradient_dy(dTdx) ** 2 + 2 * gradient_dz(dTdx) ** 2 + 2 * gradient_dz(dTdy) ** 2,
+                              [1, 2, 3, 4])
+        get = deform_loss.local_displacement_energy(ddf, energy_type="bending")
+        self.assertEqual(get.shape, (2,))
+        self.assertTrue((tf.reduce_max(tf.abs(get - want) / want)).numpy() < 1e-5)
+
+        # affine displacement has no bending energy
+        grid = tf.stack(tf.meshgrid(*[tf.range(n, dtype=tf.float32) for n in [10, 11, 12]], indexing="ij"), axis=3)
+        ddf = tf.expand_dims(tf.einsum("xyzi,ij->xyzj", grid, tf.random.normal([3, 3])), axis=0)
+        get = deform_loss.local_displacement_energy(ddf, energy_type="bending")
+        self.assertTrue(get.numpy()[0] < 1e-6)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+import tensorflow as tf
+
+import deepreg.model.loss.image as image_loss
+
+
+class Test(TestCase):
+    @staticmethod
+    def check_equal(x, y, tol=1e-5):
+        """
+        given two tf tensors return True/False (not tf tensor)
+        tolerate small relative errors
+        :param x:
+        :param y:
+        :param tol:
+        :return:
+        """
+        return (tf.reduce_max(tf.abs(x - y)) / (tf.reduce_max(tf.abs(y)) + 1e-6)).numpy() < tol
+
+    def test_box_filter3d(self):
+        for kernel_size in [3, 4, 9]:
+            x = tf.random.uniform([2, 10, 11, 12, 1])
+            want = tf.nn.conv3d(x, filters=tf.ones([kernel_size] * 3 + [1, 1]), strides=[1] * 5, padding="SAME")
+            get = image_loss.box_filter3d(x, kernel_size=kernel_size)
+            self.assertTrue(self.check_equal(get, want))
+
+            # channels are filtered independently
+            get = image_loss.box_filter3d(tf.concat([x, 2 * x], axis=4), kernel_size=kernel_size)
+            self.assertTrue(self.check_equal(get, tf.concat([want, 2 * want], axis=4)))
+
+    def test_local_normalized_cross_correlation(self):
+        y_true = tf.random.uniform([2, 10, 11, 12, 1])
+        y_pred = tf.random.uniform([2, 10, 11, 12, 1])
+        # identical images have a perfect correlation
+        get = image_loss.local_normalized_cross_correlation(y_true, y_true, kernel_size=5)
+        self.assertTrue(self.check_equal(get, tf.ones([2]), tol=1e-4))
+        # negative loss
+        get = image_loss.similarity_fn(y_true[..., 0], y_pred[..., 0], name="lncc", kernel_size=5, weight=1.0)
+        self.assertEqual(get.shape, (2,))
+        self.assertTrue(tf.reduce_all(get < 0).numpy())
@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+import tensorflow as tf
+
+import deepreg.model.layer_util as layer_util
+import deepreg.model.loss.label as label_loss
+
+
+class Test(TestCase):
+    @staticmethod
+    def check_equal(x, y, tol=1e-5):
+        """
+        given two tf tensors return True/False (not tf tensor)
+        tolerate small relative errors
+        :param x:
+        :param y:
+        :param tol:
+        :return:
+        """
+        return (tf.reduce_max(tf.abs(x - y)) / (tf.reduce_max(tf.abs(y)) + 1e-6)).numpy() < tol
+
+    def test_separable_filter3d_fft(self):
+        x = tf.random.uniform([2, 10, 11, 12])
+        # odd and even kernels, and a kernel longer than the volume
+        for kernel in [label_loss.gauss_kernel1d(1), tf.random.uniform([6]), label_loss.gauss_kernel1d(4)]:
+            want = label_loss.separable_filter3d(x, kernel, method="conv")
+            get = label_loss.separable_filter3d(x, kernel, method="fft")
+            self.assertTrue(self.check_equal(get, want))
+
+        with self.assertRaises(ValueError):
+            label_loss.separable_filter3d(x, label_loss.gauss_kernel1d(1), method="unknown")
+
+    def test_separable_filter3d_fft_gradient(self):
+        # the training losses use fft for the large sigmas, so the gradients should match the conv ones
+        for shape in [[2, 10, 11, 12], [1, 7, 13, 9]]:
+            x = tf.random.uniform(shape)
+            weights = tf.random.uniform(shape)  # so that the gradient is not uniform
+            # odd and even kernels, and the kernels of sigma 16 and 32, longer than the volume
+            for kernel in [label_loss.gauss_kernel1d(1), tf.random.uniform([6]),
+                           label_loss.gauss_kernel1d(16), label_loss.gauss_kernel1d(32)]:
+                grads = []
+                for method in ["conv", "fft"]:
+                    with tf.GradientTape() as tape:
+                        tape.watch(x)
+                        loss = tf.reduce_sum(label_loss.separable_filter3d(x, kernel, method=method) ** 2 * weights)
+                    grads.append(tape.gradient(loss, x))
+                want, get = grads
+                self.assertTrue(self.check_equal(get, want))
+
+    def test_multi_scale_loss_fft(self):
+        # the multi-scale loss of the training configs, with fft for the large sigmas, or conv only
+        y_true = tf.cast(tf.random.uniform([2, 9, 10, 11]) > 0.5, tf.float32)
+        y_pred = tf.random.uniform([2, 9, 10, 11])
+        threshold = label_loss.FFT_KERNEL_SIZE_THRESHOLD
+        self.addCleanup(setattr, label_loss, "FFT_KERNEL_SIZE_THRESHOLD", threshold)
+        results = []
+        for fft_threshold in [threshold, float("inf")]:
+            label_loss.FFT_KERNEL_SIZE_THRESHOLD = fft_threshold
+            with tf.GradientTape() as tape:
+                tape.watch(y_pred)
+                loss = label_loss.multi_scale_loss(y_true=y_true, y_pred=y_pred, loss_type="dice",
+                                                   loss_scales=[0, 1, 2, 4, 8, 16, 32])
+            results.append((loss, tape.gradient(loss, y_pred)))
+        (got_loss, got_grad), (want_loss, want_grad) = results
+        self.assertTrue(self.check_equal(got_loss, want_loss))
+        self.assertTrue(self.check_equal(got_grad, want_grad))
+
+    def test_compute_centroid(self):
+        mask = tf.random.uniform([2, 5, 6, 7])
+        grid = tf.cast(layer_util.get_reference_grid([5, 6, 7]), tf.float32)
+        bool_mask = tf.expand_dims(tf.cast(mask >= 0.5, tf.float32), axis=4)
+        want = tf.reduce_sum(bool_mask * grid, axis=[1, 2, 3]) / tf.reduce_sum(bool_mask, axis=[1, 2, 3])
+        get = label_loss.compute_centroid(mask=mask, grid=grid)
+        self.assertTrue(self.check_equal(get, want))
@@ -0,0 +1,167 @@
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+
+
+class Test(TestCase):
+    def test_get_ddf_size(self):
+        self.assertEqual(network.get_ddf_size([8, 9, 10], ddf_stride=1), [8, 9, 10])
+        self.assertEqual(network.get_ddf_size([8, 9, 10], ddf_stride=2), [4, 5, 5])
+        with self.assertRaises(ValueError):
+            network.get_ddf_size([8, 9, 10], ddf_stride=0)
+
+    def test_upsample_ddf(self):
+        # a translation of 1 voxel on the coarse grid is a translation of 2 voxels on the fine grid
+        ddf = tf.ones([2, 4, 5, 6, 3])
+        get = network.upsample_ddf(ddf, fixed_image_size=[8, 10, 12])
+        self.assertEqual(get.shape, (2, 8, 10, 12, 3))
+        self.assertTrue((tf.reduce_max(tf.abs(get - 2))).numpy() < 1e-6)
+
+    def test_set_jit_compile(self):
+        inputs = tf.keras.Input(shape=[4])
+        model = tf.keras.Model(inputs=inputs, outputs=tf.keras.layers.Dense(1)(inputs))
+        model.compile(optimizer="sgd", loss="mse")
+        x, y = tf.ones([2, 4]), tf.ones([2, 1])
+        self.assertTrue(network.set_jit_compile(model=model, inputs=x, labels=y))
+        self.assertTrue(model.jit_compile)
+
+        # strings have no xla kernel, the model falls back to tensorflow graphs
+        outputs = tf.keras.layers.Lambda(lambda t: tf.strings.to_number(tf.strings.as_string(t)))(inputs)
+        model = tf.keras.Model(inputs=inputs, outputs=tf.keras.layers.Dense(1)(outputs))
+        model.compile(optimizer="sgd", loss="mse")
+        self.assertFalse(network.set_jit_compile(model=model, inputs=x, labels=y))
+        self.assertFalse(model.jit_compile)
+        model.train_on_batch(x=x, y=y)
+
+    def test_checkpoint_blocks(self):
+        # one training step with recomputed blocks gives the same outputs, gradients and moving statistics
+        tf_model_config = dict(backbone=dict(name="local", out_kernel_initializer="glorot_uniform", out_activation=""),
+                               local=dict(num_channel_initial=2, extract_levels=[0, 1, 2]),
+                               unet=dict(num_channel_initial=2, depth=2))
+        inputs = tf.random.uniform([2, 8, 8, 8, 2], seed=0)
+        for name in ["local", "unet"]:
+            tf_model_config["backbone"]["name"] = name
+            backbones = []
+            for checkpoint_blocks in [False, True]:
+                tf_model_config[name]["checkpoint_blocks"] = checkpoint_blocks
+                backbone = network.build_backbone(image_size=[8, 8, 8], out_channels=3,
+                                                  tf_model_config=tf_model_config)
+                backbone(inputs, training=False)  # build, the moving statistics are not updated
+                backbones.append(backbone)
+            backbones[1].set_weights(backbones[0].get_weights())
+
+            results = []
+            for backbone in backbones:
+                @tf.function
+                def train_step():
+                    with tf.GradientTape() as tape:
+                        outputs = backbone(inputs, training=True)
+                        loss = tf.reduce_sum(outputs ** 2)
+                    return outputs, tape.gradient(loss, backbone.trainable_variables)
+
+                outputs, grads = train_step()
+                moving_stats = [v.numpy() for v in backbone.non_trainable_variables if "moving" in v.name]
+                self.assertGreater(len(moving_stats), 0)
+                results.append((outputs.numpy(), [g.numpy() for g in grads], moving_stats))
+
+            (want_outputs, want_grads, want_stats), (got_outputs, got_grads, got_stats) = results
+            self.assertTrue(np.allclose(got_outputs, want_outputs, atol=1e-5))
+            for got, want in zip(got_grads, want_grads):
+                self.assertTrue(np.allclose(got, want, rtol=1e-4, atol=1e-5 * np.abs(want).max()))
+            for got, want in zip(got_stats, want_stats):
+                self.assertTrue(np.allclose(got, want, atol=1e-6))
+
+    def test_unet_stride(self):
+        # the unet decoder stops at the level of the ddf resolution
+        tf_model_config = dict(backbone=dict(name="unet", out_kernel_initializer="zeros", out_activation=""),
+                               unet=dict(num_channel_initial=2, depth=2))
+        inputs = tf.zeros([2, 8, 10, 12, 2])
+        for stride, num_upsample_blocks in [(1, 2), (2, 1), (4, 0)]:
+            ddf_size = network.get_ddf_size([8, 10, 12], ddf_stride=stride)
+            backbone = network.build_backbone(image_size=ddf_size, out_channels=3, tf_model_config=tf_model_config,
+                                              stride=stride)
+            self.assertEqual(backbone(inputs).shape, (2, *ddf_size, 3))
+            self.assertEqual(len(backbone._upsample_blocks), num_upsample_blocks)
+        for stride in [3, 8]:  # not a power of 2, deeper than the unet
+            with self.assertRaises(ValueError):
+                network.build_backbone(image_size=[4, 4, 4], out_channels=3, tf_model_config=tf_model_config,
+                                       stride=stride)
+
+    def test_local_net_fused_extraction(self):
+        # the output has the image size, also for odd sizes, and all the extractions get gradients
+        tf_model_config = dict(backbone=dict(name="local", out_kernel_initializer="glorot_uniform", out_activation=""),
+                               local=dict(num_channel_initial=2, extract_levels=[0, 1, 2], fused_extraction=True))
+        for image_size in [[8, 8, 8], [15, 17, 13]]:
+            backbone = network.build_backbone(image_size=image_size, out_channels=3, tf_model_config=tf_model_config)
+            inputs = tf.random.uniform([2, *image_size, 2], seed=0)
+            with tf.GradientTape() as tape:
+                outputs = backbone(inputs, training=True)
+                loss = tf.reduce_sum(outputs ** 2)
+            self.assertEqual(outputs.shape, (2, *image_size, 3))
+            grads = tape.gradient(loss, backbone.trainable_variables)
+            self.assertEqual(len(grads), len(backbone.trainable_variables))
+            for extract_layer in backbone._extract_layers:
+                self.assertGreater(len(extract_layer.trainable_variables), 0)
+            for variable, grad in zip(backbone.trainable_variables, grads):
+                self.assertIsNotNone(grad, variable.name)
+                self.assertTrue(np.all(np.isfinite(grad.numpy())))
+                self.assertGreater(np.abs(grad.numpy()).max(), 0, variable.name)
+
+    def test_set_precision(self):
+        # the backbone computes in bfloat16, the ddf, the warping and the losses stay in float32
+        self.addCleanup(network.set_precision, "float32")
+        config = yaml.safe_load(open("deepreg/config/mr_us_ddf.yaml"))["tf"]
+        network.set_precision("mixed_bfloat16")
+        model = network.build_model(moving_image_size=[8, 8, 8], fixed_image_size=[8, 8, 8], index_size=2,
+                                    batch_size=2, tf_model_config=config["model"], tf_loss_config=config["loss"])
+        backbones = [submodule for submodule in model.submodules if isinstance(submodule, network.LocalNet)]
+        self.assertEqual(len(backbones), 1)
+        self.assertEqual(backbones[0].compute_dtype, "bfloat16")
+        self.assertTrue(all(v.dtype == tf.float32 for v in backbones[0].variables))
+        self.assertEqual(model.ddf.dtype, tf.float32)
+        self.assertTrue(all(output.dtype == tf.float32 for output in model.outputs))
+        self.assertTrue(all(loss.dtype == tf.float32 for loss in model.losses))
+
+        inputs = tuple(tf.random.uniform([2, 8, 8, 8], seed=0) for _ in range(3)) + (tf.zeros([2, 2]),)
+        outputs = model(inputs, training=False)
+        self.assertTrue(all(output.dtype == tf.float32 for output in tf.nest.flatten(outputs)))
+
+        network.set_precision("float32")
+        self.assertEqual(tf.keras.mixed_precision.global_policy().name, "float32")
+        with self.assertRaises(ValueError):
+            network.set_precision("float16")
+
+    def test_bspline_backbone_stride(self):
+        # the decoder stops at 1/spacing of the image resolution, the head only pads to the control point size
+        config = yaml.safe_load(open("deepreg/config/mr_us_ddf.yaml"))["tf"]
+        config["model"]["method"] = "bspline"
+        config["model"]["bspline"]["control_point_spacing"] = 4
+        config["model"]["unet"]["depth"] = 3
+        config["model"]["local"]["extract_levels"] = [2, 3]
+        image_size = [16, 16, 16]
+        for name, backbone_type in [("unet", network.UNet), ("local", network.LocalNet)]:
+            config["model"]["backbone"]["name"] = name
+            model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                        batch_size=2, tf_model_config=config["model"], tf_loss_config=config["loss"])
+            self.assertEqual(model.control_points.shape, (2, 7, 7, 7, 3))
+            backbone = [submodule for submodule in model.submodules if isinstance(submodule, backbone_type)][0]
+            # input shapes of the output heads, i.e. the finest decoded level
+            heads = [backbone._output_conv3d] if name == "unet" else backbone._extract_layers
+            finest = max(head._build_input_shape[1] for head in heads)
+            self.assertEqual(finest, 4)
+
+        # the local net would decode levels finer than the control points
+        config["model"]["local"]["extract_levels"] = [0, 1, 2, 3]
+        with self.assertRaises(ValueError):
+            network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=2, tf_model_config=config["model"], tf_loss_config=config["loss"])
+        # the unet stops at level log2(spacing)
+        config["model"]["backbone"]["name"] = "unet"
+        config["model"]["bspline"]["control_point_spacing"] = 3
+        with self.assertRaises(ValueError):
+            network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                batch_size=2, tf_model_config=config["model"], tf_loss_config=config["loss"])
@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+from deepreg.predict import InferenceEngine
+
+
+class Test(TestCase):
+    def test_inference_engine(self):
+        config = yaml.safe_load(open("deepreg/config/mr_us_ddf.yaml"))["tf"]
+        image_size = [8, 8, 8]
+        model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                    batch_size=2, tf_model_config=config["model"], tf_loss_config=config["loss"])
+        engine = InferenceEngine(model=model)
+        for _ in range(3):
+            inputs = tuple([tf.random.uniform([2, *image_size]) for _ in range(3)] + [tf.zeros([2, 2])])
+            outputs = engine(inputs)
+            self.assertEqual(sorted(outputs.keys()), ["ddf", "pred_fixed_image", "pred_fixed_label"])
+            want_label, want_ddf = tf.keras.Model(inputs=model.inputs,
+                                                  outputs=model.outputs + [model.ddf]).predict_on_batch(inputs)
+            self.assertTrue(np.allclose(outputs["pred_fixed_label"], want_label, atol=1e-5))
+            self.assertTrue(np.allclose(outputs["ddf"], want_ddf, atol=1e-5))
+        self.assertEqual(engine.num_traces, 1)  # traced once for the same input signature
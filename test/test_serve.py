@@ -0,0 +1,107 @@
+import tempfile
+import threading
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+import yaml
+
+import deepreg.model.network as network
+from deepreg.predict import InferenceEngine
+from deepreg.serve import DynamicBatcher, UnixHTTPConnection, build_server, dump_arrays, register
+
+
+class Test(TestCase):
+    def test_serve(self):
+        config = yaml.safe_load(open("deepreg/config/mr_us_ddf.yaml"))["tf"]
+        config["model"]["backbone"]["out_kernel_initializer"] = "glorot_uniform"  # non zero ddf
+        image_size = [8, 8, 8]
+        model = network.build_model(moving_image_size=image_size, fixed_image_size=image_size, index_size=2,
+                                    batch_size=2, tf_model_config=config["model"], tf_loss_config=config["loss"])
+        engine = InferenceEngine(model=model)
+        batcher = DynamicBatcher(engine=engine, batch_size=2, moving_image_size=image_size,
+                                 fixed_image_size=image_size, index_size=2, max_latency_ms=100)
+        with tempfile.TemporaryDirectory() as socket_dir:
+            unix_socket = socket_dir + "/serve.sock"
+            server = build_server(batcher=batcher, unix_socket=unix_socket)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+
+            # concurrent requests
+            samples = [[np.random.rand(*image_size).astype(np.float32) for _ in range(3)] for _ in range(3)]
+            results = [None] * len(samples)
+
+            def request(index):
+                results[index] = register(*samples[index], unix_socket=unix_socket)
+
+            threads = [threading.Thread(target=request, args=(i,)) for i in range(len(samples))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for sample, result in zip(samples, results):
+                self.assertEqual(sorted(result.keys()), ["ddf", "pred_fixed_image", "pred_fixed_label"])
+                want = engine(tuple(tf.constant(np.stack([x, x])) for x in sample) + (tf.zeros([2, 2]),))
+                for name in result.keys():
+                    self.assertTrue(np.allclose(result[name], want[name][0], atol=1e-5))
+            metrics = batcher.get_metrics()
+            self.assertEqual(metrics["num_requests"], 3)
+            self.assertLessEqual(metrics["num_batches"], 3)
+            self.assertEqual(metrics["queue_depth"], 0)
+
+            # invalid shape
+            with self.assertRaises(RuntimeError):
+                register(np.zeros([4, 4, 4]), np.zeros([4, 4, 4]), unix_socket=unix_socket)
+
+            # non numeric arrays are rejected, and the batcher still serves the next request
+            with self.assertRaisesRegex(RuntimeError, "status 400"):
+                register(np.full(image_size, "abc"), np.full(image_size, "abc"), unix_socket=unix_socket)
+            result = register(*samples[0], unix_socket=unix_socket)
+            self.assertTrue(np.allclose(result["ddf"], results[0]["ddf"], atol=1e-5))
+
+            # missing content length
+            connection = UnixHTTPConnection(unix_socket)
+            connection.putrequest("POST", "/register")
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, 411)
+            connection.close()
+
+            server.shutdown()
+            server.server_close()
+            batcher.stop()
+
+    def test_serve_failed_batch(self):
+        # an error of the engine fails the requests of its batch only
+        calls = []
+
+        def engine(inputs):
+            calls.append(inputs)
+            if len(calls) == 1:
+                raise RuntimeError("engine error")
+            return dict(ddf=inputs[0])
+
+        image_size = [4, 4, 4]
+        batcher = DynamicBatcher(engine=engine, batch_size=2, moving_image_size=image_size,
+                                 fixed_image_size=image_size, index_size=2, max_latency_ms=1)
+        image = np.ones(image_size, dtype=np.int32)
+        with self.assertRaises(RuntimeError):
+            batcher.submit(image, image).result(timeout=10)
+        result = batcher.submit(image, image).result(timeout=10)
+        self.assertEqual(result["ddf"].dtype, np.float32)
+        self.assertEqual(batcher.get_metrics()["num_errors"], 1)
+        with self.assertRaises(ValueError):
+            batcher.submit(np.full(image_size, "abc"), image)
+        with tempfile.TemporaryDirectory() as socket_dir:
+            unix_socket = socket_dir + "/serve.sock"
+            server = build_server(batcher=batcher, unix_socket=unix_socket, result_timeout=1)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            # the batcher is stopped, so the request times out
+            batcher.stop()
+            connection = UnixHTTPConnection(unix_socket)
+            connection.request("POST", "/register", body=dump_arrays(dict(moving_image=image, fixed_image=image)))
+            self.assertEqual(connection.getresponse().status, 504)
+            connection.close()
+            server.shutdown()
+            server.server_close()
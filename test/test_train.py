@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+import numpy as np
+import tensorflow as tf
+
+from deepreg.train import fit_with_accumulation
+
+
+class Test(TestCase):
+    def build_model(self):
+        inputs = tf.keras.Input(shape=[4])
+        model = tf.keras.Model(inputs=inputs,
+                               outputs=tf.keras.layers.Dense(1, kernel_initializer="ones")(inputs))
+        model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.1), loss="mse")
+        return model
+
+    def test_fit_with_accumulation(self):
+        # two batches of 1 accumulated give the same update as one batch of 2
+        x = np.arange(8, dtype=np.float32).reshape([2, 4]) / 8
+        y = np.array([[1], [-1]], dtype=np.float32)
+        expected = self.build_model()
+        expected.fit(x=x, y=y, batch_size=2, epochs=1, verbose=0)
+
+        got = self.build_model()
+        dataset = tf.data.Dataset.from_tensor_slices((x, y)).batch(1).repeat()
+        history = fit_with_accumulation(model=got, dataset_train=dataset, dataset_val=dataset, steps_per_epoch=2,
+                                        validation_steps=2, epochs=1, accumulation_steps=2, callbacks=[])
+        for w_got, w_expected in zip(got.get_weights(), expected.get_weights()):
+            self.assertTrue(np.allclose(w_got, w_expected, atol=1e-6))
+        self.assertEqual(got.optimizer.iterations.numpy(), 1)
+        self.assertIn("val_loss", history.history)
+
+        with self.assertRaises(ValueError):
+            fit_with_accumulation(model=got, dataset_train=dataset, dataset_val=dataset, steps_per_epoch=2,
+                                  validation_steps=2, epochs=1, accumulation_steps=0, callbacks=[])
+        with self.assertRaises(ValueError):  # fewer batches than one update
+            fit_with_accumulation(model=got, dataset_train=dataset, dataset_val=dataset, steps_per_epoch=2,
+                                  validation_steps=2, epochs=1, accumulation_steps=3, callbacks=[])
+
+        # the remaining batch of each epoch is not used
+        got = self.build_model()
+        fit_with_accumulation(model=got, dataset_train=dataset, dataset_val=None, steps_per_epoch=5,
+                              validation_steps=0, epochs=2, accumulation_steps=2, callbacks=[], verbose=0)
+        self.assertEqual(got.optimizer.iterations.numpy(), 4)
@@ -0,0 +1,88 @@
+import json
+import tempfile
+import threading
+from unittest import TestCase
+
+import h5py
+import nibabel as nib
+import numpy as np
+
+from deepreg.writer import AsyncWriter, MetricTable, save_volume
+
+
+class Test(TestCase):
+    def test_async_writer(self):
+        for num_workers in [0, 1, 3]:
+            results = []
+            writer = AsyncWriter(num_workers=num_workers, max_queue_size=2)
+            for i in range(10):
+                writer.submit(results.append, i)
+            writer.shutdown()
+            self.assertEqual(sorted(results), list(range(10)))
+
+    def test_async_writer_back_pressure(self):
+        # the worker is blocked, so submit blocks once the queue is full
+        event = threading.Event()
+        writer = AsyncWriter(num_workers=1, max_queue_size=1)
+        writer.submit(event.wait)  # taken by the worker
+        writer.submit(event.wait)  # fills the queue
+        submitted = threading.Event()
+        thread = threading.Thread(target=lambda: (writer.submit(event.wait), submitted.set()))
+        thread.start()
+        self.assertFalse(submitted.wait(timeout=0.2))
+        event.set()
+        self.assertTrue(submitted.wait(timeout=5))
+        thread.join()
+        writer.shutdown()
+
+    def test_async_writer_error(self):
+        def fail():
+            raise IOError("disk full")
+
+        writer = AsyncWriter(num_workers=2)
+        writer.submit(fail)
+        with self.assertRaises(IOError):
+            writer.flush()
+        with self.assertRaises(ValueError):
+            AsyncWriter(num_workers=-1)
+
+    def test_save_volume(self):
+        volume = np.random.rand(5, 6, 7, 3).astype(np.float32)
+        with tempfile.TemporaryDirectory() as save_dir:
+            for output_format in ["nifti", "npz", "chunked"]:
+                for float16 in [False, True]:
+                    path = save_volume(file_prefix=save_dir + "/ddf", volume=volume, output_format=output_format,
+                                       float16=float16, compress=True)
+                    if output_format == "nifti":
+                        get = np.asarray(nib.load(path).dataobj)
+                    elif output_format == "npz":
+                        get = np.load(path)["volume"]
+                    else:
+                        with h5py.File(path, "r") as f:
+                            get = f["volume"][()]
+                    self.assertEqual(get.shape, volume.shape)
+                    self.assertTrue(np.allclose(get, volume, atol=1e-3 if float16 else 1e-6))
+            with self.assertRaises(ValueError):
+                save_volume(file_prefix=save_dir + "/ddf", volume=volume, output_format="png")
+
+    def test_metric_table(self):
+        with tempfile.TemporaryDirectory() as save_dir:
+            for metric_format in ["csv", "jsonl"]:
+                path = save_dir + "/metric." + metric_format
+                table = MetricTable(path=path, columns=["image_dir", "dice"], metric_format=metric_format)
+                table.append(image_dir=["image0", "image1"], dice=np.asarray([0.5, 0.25], dtype=np.float32))
+                table.flush()
+                table.append(image_dir=["image2"], dice=[1.0])
+                table.flush()
+                self.assertEqual(len(table), 3)
+                self.assertEqual(table.column("dice"), [0.5, 0.25, 1.0])
+                with open(path) as f:
+                    lines = f.read().splitlines()
+                if metric_format == "csv":
+                    self.assertEqual(lines, ["image_dir,dice", "image0,0.5", "image1,0.25", "image2,1.0"])
+                else:
+                    self.assertEqual([json.loads(line) for line in lines], table.rows())
+            with self.assertRaises(ValueError):
+                table.append(image_dir=["image3"])
+            with self.assertRaises(ValueError):
+                MetricTable(path=path, columns=["dice"], metric_format="log")